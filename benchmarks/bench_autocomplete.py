@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Micro-benchmark of name and phone number completion.
+
+Compares autocomplete.Completions with a scan of all records, on synthetic
+users; also reports the build time and memory of the completion lists,
+and the cost of updating a record.
+
+Usage: python benchmarks/bench_autocomplete.py [--users N] [--repeat N]
+"""
+
+import argparse
+import os.path
+import random
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from granadilla import autocomplete  # noqa: E402
+
+
+FIRST_NAMES = ['Jean', 'Marie', 'Étienne', 'Hélène', 'Luc', 'Anaïs', 'Paul', 'Zoé', 'Léa', 'Hugo']
+LAST_NAMES = ['Dupont', 'Martin', 'Lefèvre', 'Bernard', 'Moreau', 'Durand', 'Garnier', 'Rousseau']
+
+
+def make_records(count):
+    rng = random.Random(42)
+    records = []
+    for i in range(count):
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = '%s%d' % (rng.choice(LAST_NAMES), i)
+        records.append({
+            'username': '%s.%s' % (first_name.lower(), last_name.lower()),
+            'full_name': '%s %s' % (first_name, last_name),
+            'phone': '+33 1 %02d %02d %02d %02d' % (i // 1000000, i // 10000 % 100, i // 100 % 100, i % 100),
+            'mobile_phone': '+33 6 %02d %02d %02d %02d' % tuple(rng.randrange(100) for _ in range(4)),
+            'internal_phone': '%d' % (1000 + i % 9000),
+        })
+    return records
+
+
+def scan(records, query, limit):
+    """Completion by testing every record, without an index."""
+    key, is_phone = autocomplete.query_key(query)
+    if not key:
+        return []
+    results = []
+    for record in records:
+        if is_phone:
+            keys = [k for name in autocomplete.PHONE_FIELDS for k in autocomplete.phone_keys(record[name])]
+        else:
+            keys = autocomplete.name_keys(record['full_name'])
+        if any(k.startswith(key) for k in keys):
+            results.append(record)
+            if len(results) >= limit:
+                break
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    records = make_records(args.users)
+
+    build = min(timeit.repeat(lambda: autocomplete.Completions(records), number=1, repeat=args.repeat))
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    completions = autocomplete.Completions(records)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    # Typing sessions: each prefix of a few names and numbers
+    typed = ['Hélène Lef', 'rousseau12', '01 00 00 4', '+33 6 5', '1234', 'zz']
+    queries = [text[:length] for text in typed for length in range(1, len(text) + 1)]
+
+    for query in queries:
+        if len(completions.complete(query, args.limit)) != len(scan(records, query, args.limit)):
+            sys.stderr.write("Result mismatch for %r!\n" % query)
+            return 1
+
+    print("%d users, %d queries, best of %d runs" % (args.users, len(queries), args.repeat))
+    update = min(timeit.repeat(lambda: completions.add(records[len(records) // 2]), number=1, repeat=args.repeat))
+    print("build: %.1f ms, %d keys, %.1f MB" % (build * 1000, len(completions.keys), size / 1e6))
+    print("update: %.3f ms" % (update * 1000))
+    timings = [
+        ('scan', lambda: [scan(records, query, args.limit) for query in queries]),
+        ('completions', lambda: [completions.complete(query, args.limit) for query in queries]),
+    ]
+    baseline = None
+    for name, func in timings:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        baseline = baseline or best
+        print("%-20s %8.3f ms/query  %8.1fx" % (name, best * 1000 / len(queries), baseline / best))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""Startup time of granadilla-admin.
+
+Compares a command that doesn't need LDAP (``help``) with a full load of
+Django and the models, as done by all commands before Django setup was
+made lazy.  Each run is a new interpreter.
+
+Usage: python benchmarks/bench_cli_startup.py [--repeat N]
+"""
+
+import argparse
+import os
+import os.path
+import subprocess
+import sys
+import time
+
+CHECKOUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+COMMANDS = [
+    ('python (baseline)', ['-c', 'pass']),
+    ('help', ['-m', 'granadilla.cli', 'help']),
+    ('import + setup', ['-c', 'from granadilla import cli; cli.setup(); cli.models.LdapUser']),
+]
+
+
+def run(args, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, env=env, cwd=CHECKOUT_DIR, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'granadilla_webapp.settings')
+    env['PYTHONPATH'] = os.pathsep.join([CHECKOUT_DIR] + [path for path in [env.get('PYTHONPATH')] if path])
+
+    print("Best of %d runs" % args.repeat)
+    for name, command_args in COMMANDS:
+        best = min(run(command_args, env) for _run in range(args.repeat))
+        print("%-20s %8.1f ms" % (name, best * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
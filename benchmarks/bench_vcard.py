@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Micro-benchmark of bulk vCard rendering.
+
+Compares vcard.render_many() with the previous renderer (per-value re.sub,
+per-card sort of the rendered lines), on synthetic cards.
+
+Usage: python benchmarks/bench_vcard.py [--cards N] [--repeat N]
+"""
+
+import argparse
+import os.path
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from granadilla import vcard  # noqa: E402
+
+
+def legacy_render_bytes(card):
+    """The renderer before render_many() was introduced."""
+
+    def escape_one(value):
+        value = re.sub(r'([,;\\])', r'\\\1', value)
+        value = value.replace('\n', '\\n')
+        return value
+
+    def escape(field, value):
+        if field.cardinality == field.SINGLE:
+            return escape_one(value)
+        elif field.cardinality == field.MULTI:
+            return ';'.join(escape_one(v) for v in value)
+        return ';'.join(','.join(escape_one(subv) for subv in v) for v in value)
+
+    inner_lines = []
+    for key, field in card.ALL_FIELDS.items():
+        if key not in card.data:
+            continue
+        value = card.data[key]
+        if not field.filled(value):
+            continue
+        subtype_txt = ';TYPE=%s' % field.subtype if field.subtype else ''
+        inner_lines.append('%s%s:%s' % (field.prefix, subtype_txt, escape(field, value)))
+
+    lines = ['BEGIN:VCARD', 'VERSION:3.0'] + sorted(inner_lines) + ['END:VCARD']
+    return '\r\n'.join(lines).encode('utf-8')
+
+
+def make_cards(count):
+    cards = []
+    for i in range(count):
+        card = vcard.VCard()
+        card['kind'] = 'individual'
+        card['names'] = [['Jöhn%d' % i], ['Doe, Jr.'], [], [], []]
+        card['full_name'] = 'Jöhn%d Doe, Jr.' % i
+        card['email'] = 'john%d.doe@example.org' % i
+        card['org'] = [['Example; Inc.']]
+        card['phone'] = '+33 1 23 45 %02d %02d' % (i // 100 % 100, i % 100)
+        card['cell'] = '+33 6 00 00 %02d %02d' % (i // 100 % 100, i % 100)
+        cards.append(card)
+    return cards
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cards', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    cards = make_cards(args.cards)
+
+    legacy = b''.join(legacy_render_bytes(card) + b'\r\n' for card in cards)
+    current = b''.join(vcard.render_many(cards))
+    if legacy != current:
+        sys.stderr.write("Output mismatch between renderers!\n")
+        return 1
+
+    timings = [
+        ('legacy render_bytes', lambda: [legacy_render_bytes(card) + b'\r\n' for card in cards]),
+        ('render_bytes', lambda: [card.render_bytes() + b'\r\n' for card in cards]),
+        ('render_many', lambda: list(vcard.render_many(cards))),
+    ]
+    print("%d cards, best of %d runs" % (args.cards, args.repeat))
+    baseline = None
+    for name, func in timings:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        baseline = baseline or best
+        print("%-20s %8.1f ms  %5.2fx" % (name, best * 1000, baseline / best))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
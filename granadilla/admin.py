@@ -19,6 +19,7 @@
 #
 
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 
 from .conf import settings
 from . import models
@@ -41,6 +42,12 @@ class LdapGroupAdmin(admin.ModelAdmin):
 admin.site.register(models.LdapGroup, LdapGroupAdmin)
 
 
+class LdapUserChangeList(ChangeList):
+    def get_queryset(self, *args, **kwargs):
+        # Don't fetch every photo just to list users.
+        return super(LdapUserChangeList, self).get_queryset(*args, **kwargs).defer('photo')
+
+
 class LdapUserAdmin(admin.ModelAdmin):
     fieldsets = (
         (None, {
@@ -57,6 +64,9 @@ class LdapUserAdmin(admin.ModelAdmin):
     list_display = ['username', 'first_name', 'last_name', 'email', 'uid']
     search_fields = ['first_name', 'last_name', 'full_name', 'username']
 
+    def get_changelist(self, request, **kwargs):
+        return LdapUserChangeList
+
 
 admin.site.register(models.LdapUser, LdapUserAdmin)
 
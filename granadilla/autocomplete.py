@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Typeahead completion of names and phone numbers.
+
+Completions are looked up in a sorted array of keys, by bisection: a lookup
+costs O(log n) plus the number of results, whatever the prefix.  Keys are:
+
+- the full name, and each of its tails starting at a word ("jean dupont",
+  "dupont"), lowercased and without accents;
+- the digits of each phone number, and their national form when the number
+  starts with a +<country code> group ("+33 1 23 45 67 89" gives
+  "33123456789" and "0123456789").
+
+Keys and usernames are kept in two parallel sorted lists, which is much
+more compact than a trie of Python objects.  They are built with a single
+sort, then updated in place as records change.
+
+This module doesn't depend on Django, so that it can be benchmarked alone.
+"""
+
+import bisect
+import re
+import unicodedata
+
+
+# Fields returned for each completion
+FIELDS = ['username', 'full_name', 'phone', 'mobile_phone', 'internal_phone']
+PHONE_FIELDS = ['phone', 'mobile_phone', 'internal_phone']
+
+SPACES_RE = re.compile(r'\s+')
+NON_DIGITS_RE = re.compile(r'\D')
+# Queries made of these characters only are phone numbers
+PHONE_QUERY_RE = re.compile(r'^[\d\s+.()/-]*\d[\d\s+.()/-]*$')
+
+# Prefix of phone number keys, so that names with digits never match them
+PHONE_MARK = '#'
+
+
+def fold(text):
+    """Lowercase a text and strip its accents and extra spaces."""
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return SPACES_RE.sub(' ', text).strip().lower()
+
+
+def phone_keys(phone):
+    digits = NON_DIGITS_RE.sub('', phone)
+    if not digits:
+        return []
+    keys = [digits]
+    groups = phone.split()
+    if len(groups) > 1 and groups[0].startswith('+'):
+        keys.append('0' + NON_DIGITS_RE.sub('', ''.join(groups[1:])))
+    return keys
+
+
+def name_keys(name):
+    words = fold(name).split(' ')
+    return [' '.join(words[start:]) for start in range(len(words)) if words[start]]
+
+
+def record_keys(record):
+    keys = set(name_keys(record['full_name'] or record['username']))
+    for name in PHONE_FIELDS:
+        keys.update(PHONE_MARK + key for key in phone_keys(record[name] or ''))
+    return keys
+
+
+def query_key(query):
+    """The key matching a query: digits for phone numbers, folded text for names."""
+    if PHONE_QUERY_RE.match(query):
+        return NON_DIGITS_RE.sub('', query), True
+    return fold(query), False
+
+
+class Completions(object):
+    """Completions over records (dicts having at least FIELDS), by username."""
+
+    def __init__(self, records=()):
+        self.records = {}  # username => values of FIELDS
+        pairs = []
+        for record in records:
+            pairs.extend((key, record['username']) for key in self._store(record))
+        pairs.sort()
+        self.keys = [key for key, _username in pairs]
+        self.owners = [username for _key, username in pairs]  # Parallel to keys
+
+    def __len__(self):
+        return len(self.records)
+
+    def _store(self, record):
+        """Store a record; returns its keys."""
+        values = tuple(record[name] or '' for name in FIELDS)
+        self.records[values[0]] = values
+        return record_keys(dict(zip(FIELDS, values)))
+
+    def add(self, record):
+        self.remove(record['username'])
+        for key in self._store(record):
+            position = bisect.bisect_right(self.keys, key)
+            self.keys.insert(position, key)
+            self.owners.insert(position, record['username'])
+
+    def remove(self, username):
+        values = self.records.pop(username, None)
+        if values is None:
+            return
+        for key in record_keys(dict(zip(FIELDS, values))):
+            position = bisect.bisect_left(self.keys, key)
+            while self.owners[position] != username:
+                position += 1
+            del self.keys[position]
+            del self.owners[position]
+
+    def complete(self, query, limit):
+        """The first ``limit`` records matching a prefix, as dicts of FIELDS.
+
+        Records are sorted by matching key (names alphabetically, phone
+        numbers numerically).
+        """
+        key, is_phone = query_key(query)
+        if not key:
+            return []
+        if is_phone:
+            key = PHONE_MARK + key
+
+        seen = set()
+        results = []
+        keys = self.keys
+        for position in range(bisect.bisect_left(keys, key), len(keys)):
+            if len(results) >= limit or not keys[position].startswith(key):
+                break
+            username = self.owners[position]
+            if username not in seen:
+                seen.add(username)
+                results.append(dict(zip(FIELDS, self.records[username])))
+        return results
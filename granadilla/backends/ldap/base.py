@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""django-ldapdb backend, with pooled connections.
+
+ldapdb opens a new connection for each Django connection (usually each
+request), and binds again before each operation.  This backend takes
+already bound connections from a granadilla.pool pool instead, and gives
+them back when Django closes the connection.
+
+Usage: set ENGINE to 'granadilla.backends.ldap', and use
+granadilla.router.Router.
+"""
+
+import functools
+
+from django.db.backends.base.base import BaseDatabaseWrapper
+from ldapdb.backends.ldap import base as ldapdb_base
+
+from granadilla import pool
+
+
+class DatabaseWrapper(ldapdb_base.DatabaseWrapper):
+
+    def get_pool(self):
+        conn_params = self.get_connection_params()
+        return pool.get_pool(
+            pool.pool_key(conn_params),
+            functools.partial(super(DatabaseWrapper, self).get_new_connection, conn_params),
+        )
+
+    def get_new_connection(self, conn_params):
+        # Normally set when the connection is opened: it may come from the pool.
+        self.page_size = int(conn_params['options'].get('page_size', self.page_size))
+        self.connection_pool = self.get_pool()
+        return self.connection_pool.acquire()
+
+    def ensure_connection(self):
+        # Skip ldapdb's bind before each operation: pooled connections are
+        # checked when reused, and ReconnectLDAPObject reconnects if needed.
+        BaseDatabaseWrapper.ensure_connection(self)
+
+    def is_usable(self):
+        return True
+
+    def close(self):
+        self.validate_thread_sharing()
+        if self.connection is not None:
+            self.connection_pool.release(self.connection, discard=self.errors_occurred)
+            self.connection = None
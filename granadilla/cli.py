@@ -18,26 +18,67 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+"""The granadilla-admin command-line tool.
+
+Django and the LDAP models are only loaded when a command uses them: the
+command line is parsed first, so that ``help`` or a typo return at once.
+"""
+
 from __future__ import unicode_literals
 
 import base64
 import colorama
+import contextlib
 import datetime
-import django
-import inspect
+import importlib
+import io
+import json
 import logging
 import os
 import os.path
-import termios
 import time
 import re
+import shlex
 import sys
 
 
-django.setup()
+def setup():
+    """Set up Django, unless already done."""
+    from django.apps import apps
+    if not apps.ready:
+        import django
+        django.setup()
+
+
+class LazyImport(object):
+    """A module (or one of its attributes), imported on first use after setup()."""
+
+    def __init__(self, module_name, attribute=None):
+        self._module_name = module_name
+        self._attribute = attribute
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            setup()
+            target = importlib.import_module(self._module_name)
+            if self._attribute:
+                target = getattr(target, self._attribute)
+            self._target = target
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
 
-from .conf import settings  # noqa: E402
-from . import models  # noqa: E402
+
+settings = LazyImport('granadilla.conf', 'settings')
+exports = LazyImport('granadilla.exports')
+ids = LazyImport('granadilla.ids')
+jobs = LazyImport('granadilla.jobs.worker')
+models = LazyImport('granadilla.models')
+phonebook = LazyImport('granadilla.phonebook')
+provisioning = LazyImport('granadilla.provisioning')
+sync = LazyImport('granadilla.sync')
 
 
 # configure logging
@@ -48,6 +89,13 @@ logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 
 
+# Flag of functions taking *args (inspect.CO_VARARGS, without importing inspect)
+CO_VARARGS = 0x04
+
+# Output formats of listing commands
+LISTING_FORMATS = ['text', 'ndjson']
+
+
 def command(fun):
     """Decorator that marks a method as "publicly callable".
 
@@ -61,12 +109,21 @@ def command(fun):
     return fun
 
 
+class InteractionRequired(Exception):
+    """A command needs to prompt the user, which batch mode forbids."""
+
+
 class CLI(object):
+    # Whether commands run from 'shell --batch', without a terminal
+    batch = False
 
-    def _write(self, txt, args, color=colorama.Fore.RESET, target=sys.stdout):
+    def _write(self, txt, args, color=colorama.Fore.RESET, target=None):
+        # Looked up at call time: batch mode redirects the standard streams.
+        target = target or sys.stdout
         txt = txt % args
-        txt = '%s%s%s\n' % (color, txt, colorama.Fore.RESET)
-        target.write(txt)
+        if not self.batch:
+            txt = '%s%s%s' % (color, txt, colorama.Fore.RESET)
+        target.write(txt + '\n')
 
     def display(self, txt, *args):
         self._write(txt, args)
@@ -110,8 +167,11 @@ class CLI(object):
             return None
 
     def grab(self, prompt, password=False):
+        if self.batch:
+            raise InteractionRequired("Unable to prompt for %r in batch mode" % prompt.strip(' :'))
 
         if password and sys.stdin.isatty():
+            import termios
             fd = sys.stdin.fileno()
             old = termios.tcgetattr(fd)
             new = termios.tcgetattr(fd)
@@ -128,6 +188,65 @@ class CLI(object):
             sys.stdout.write(prompt)
             return sys.stdin.readline().strip()
 
+    def _read_input(self, path):
+        """Read a whole file, or stdin for '-'."""
+        if path == '-':
+            if self.batch:
+                raise InteractionRequired("stdin holds the commands in batch mode")
+            return sys.stdin.read()
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+
+    def _listing_options(self, options, model, default_fields):
+        """Parse the options of a listing command: --format=<format>, --fields=<f1,f2>.
+
+        Returns (format, field names), or None after reporting an error.
+        """
+        output_format, fields = 'text', None
+        for option in options:
+            name, _sep, value = option.partition('=')
+            if name == '--format' and value in LISTING_FORMATS:
+                output_format = value
+            elif name == '--fields' and value:
+                fields = value.split(',')
+            else:
+                self.error("Invalid option %s (expected --format=%s or --fields=<name,...>)",
+                           option, '|'.join(LISTING_FORMATS))
+                return None
+        if fields is None:
+            fields = default_fields
+        elif output_format != 'ndjson':
+            self.error("--fields requires --format=ndjson")
+            return None
+
+        known = {field.name for field in model._meta.concrete_fields}
+        unknown = [name for name in fields if name not in known]
+        if unknown:
+            self.error("Unknown fields: %s (available: %s)", ', '.join(unknown), ', '.join(sorted(known)))
+            return None
+        return output_format, fields
+
+    def _write_ndjson(self, queryset, fields):
+        """Write one JSON object per entry, as entries arrive from LDAP (unsorted).
+
+        Only the LDAP attributes backing ``fields`` are fetched.
+        """
+        encoder = json.JSONEncoder(ensure_ascii=False, default=_json_default)
+        write = sys.stdout.write
+        for _dn, values in queryset.entries(*fields):
+            write(encoder.encode(values) + '\n')
+
+    def _list(self, options, queryset, default_fields, display):
+        """Run a listing command: ndjson, or text lines through display(entries)."""
+        parsed = self._listing_options(options, queryset.model, default_fields)
+        if parsed is None:
+            return 1
+        output_format, fields = parsed
+        if output_format == 'ndjson':
+            self._write_ndjson(queryset, fields)
+        else:
+            display(queryset)
+
     def fill_object(self, obj, fields):
         for key in fields:
             name = key.replace("_", " ").title()
@@ -148,17 +267,10 @@ class CLI(object):
         """
         Create a new group.
         """
-        # get gid
-        gids = models.LdapGroup.objects.values_list('gid', flat=True)
-        if gids:
-            gid = max(gids) + 1
-        else:
-            gid = 10000
-
         # create group
         group = models.LdapGroup()
         group.name = groupname
-        group.gid = gid
+        group.gid = ids.allocate('gid')
         group.save()
 
     @command
@@ -166,17 +278,9 @@ class CLI(object):
         """
         Create a new user.
         """
-        # create user
-        users = models.LdapUser.objects.all()
-        if users:
-            id = max([x.uid for x in users]) + 1
-        else:
-            id = 10000
-
         # prompt for information
         user = models.LdapUser()
         user.username = username
-        user.uid = id
         self.fill_object(user, ['first_name', 'last_name'])
         for key in ['full_name', 'gecos', 'group', 'email', 'home_directory', 'login_shell']:
             setattr(user, key, user.defaults(key))
@@ -184,28 +288,61 @@ class CLI(object):
         self.change_password(user)
 
         # save user
+        user.uid = ids.allocate('uid')
         user.save()
 
+    @command
+    def bulk_adduser(self, path):
+        """
+        Create users from a CSV or JSON file ('-' for stdin); generated passwords are printed.
+        """
+        try:
+            rows = provisioning.parse_rows(self._read_input(path))
+        except ValueError as e:
+            self.error("Unable to parse %s: %s", path, e)
+            return 1
+
+        results = provisioning.bulk_create_users(rows)
+        for result in results:
+            if result.created and result.password:
+                self.success(
+                    "%d: %s: created %s, password: %s", result.row, result.username, result.message, result.password,
+                )
+            elif result.created:
+                self.success("%d: %s: created %s", result.row, result.username, result.message)
+            else:
+                self.error("%d: %s: %s", result.row, result.username, result.message)
+        created = sum(1 for result in results if result.created)
+        self.display("%d users created, %d failed", created, len(results) - created)
+
     @command
     def addusergroup(self, username, groupname):
         """Add user <username> to group <groupname>."""
-        user = models.LdapUser.objects.get(username=username)
-        group = models.LdapGroup.objects.get(name=groupname)
-        if user.username not in group.usernames:
-            group.usernames.append(user.username)
-            group.save()
+        self._check_memberships(provisioning.add_memberships([(username, groupname)]))
 
-        if settings.GRANADILLA_USE_ACLS:
-            try:
-                acl = models.LdapAcl.objects.get(name=groupname)
-                if user.dn not in acl.members:
-                    acl.members.append(user.dn)
-                    acl.save()
-            except models.LdapAcl.DoesNotExist:
-                acl = models.LdapAcl()
-                acl.name = groupname
-                acl.members = [user.dn]
-                acl.save()
+    @command
+    def bulk_addusergroup(self, path):
+        """Add users to groups, from 'username,group' lines in a file ('-' for stdin)."""
+        try:
+            pairs = provisioning.parse_pairs(self._read_input(path))
+        except ValueError as e:
+            self.error("Unable to parse %s: %s", path, e)
+            return 1
+        self._report_memberships(provisioning.add_memberships(pairs))
+
+    def _check_memberships(self, result):
+        if result.unknown_users:
+            raise models.LdapUser.DoesNotExist()
+        if result.unknown_groups:
+            raise models.LdapGroup.DoesNotExist()
+
+    def _report_memberships(self, result):
+        for name in result.unknown_groups:
+            self.error("Unknown group %s", name)
+        for username in result.unknown_users:
+            self.error("Unknown user %s", username)
+        for name, usernames in sorted(result.changed.items()):
+            self.success("%s: %s", name, ', '.join(usernames))
 
     @command
     def catgroup(self, groupname):
@@ -251,25 +388,17 @@ class CLI(object):
     @command
     def delusergroup(self, username, groupname):
         """Remove a user from a group."""
-        user = models.LdapUser.objects.get(username=username)
-        group = models.LdapGroup.objects.get(name=groupname)
-
-        self._delusergroup(user, group)
+        self._check_memberships(provisioning.remove_memberships([(username, groupname)]))
 
-    def _delusergroup(self, user, group):
-        if user.username in group.usernames:
-            self.warn("Removing %s from group %s", user.username, group.name)
-            group.usernames = [x for x in group.usernames if x != user.username]
-            group.save()
-
-        if settings.GRANADILLA_USE_ACLS:
-            try:
-                acl = models.LdapAcl.objects.get(name=group.name)
-                if user.dn in acl.members:
-                    acl.members = [x for x in acl.members if x != user.dn]
-                    acl.save()
-            except models.LdapAcl.DoesNotExist:
-                pass
+    @command
+    def bulk_delusergroup(self, path):
+        """Remove users from groups, from 'username,group' lines in a file ('-' for stdin)."""
+        try:
+            pairs = provisioning.parse_pairs(self._read_input(path))
+        except ValueError as e:
+            self.error("Unable to parse %s: %s", path, e)
+            return 1
+        self._report_memberships(provisioning.remove_memberships(pairs))
 
     @command
     def deluser(self, username):
@@ -278,12 +407,14 @@ class CLI(object):
         """
         user = models.LdapUser.objects.get(username=username)
 
-        # delete user
-        for group in models.LdapGroup.objects.all():
-            self._delusergroup(user, group)
-
         self.warn("Removing user %s", user.dn)
-        user.delete()
+        result = provisioning.delete_user(user)
+        for name in result.groups:
+            self.warn("Removed %s from group %s", user.username, name)
+        for name in result.acls:
+            self.warn("Removed %s from ACL %s", user.username, name)
+        for dn in result.devices:
+            self.warn("Removed device %s", dn)
 
     @command
     def init(self):
@@ -311,6 +442,10 @@ class CLI(object):
                 ou.name = name
                 ou.save()
 
+        # create uid/gid counters
+        if ids.create_pool():
+            self.success("Created ID pool %s", settings.GRANADILLA_ID_POOL_NAME)
+
         # create default group
         try:
             models.LdapGroup.objects.get(name=settings.GRANADILLA_USERS_GROUP)
@@ -318,10 +453,12 @@ class CLI(object):
             self.addgroup(settings.GRANADILLA_USERS_GROUP)
 
     @command
-    def lsgroups(self):
-        """Print the list of groups"""
-        for group in models.LdapGroup.objects.all():
-            self.display(group.name)
+    def lsgroups(self, *options):
+        """Print the list of groups (--format=ndjson, --fields=<name,...>)"""
+        def display(queryset):
+            for group in queryset:
+                self.display(group.name)
+        return self._list(options, models.LdapGroup.objects.all(), ['name', 'gid'], display)
 
     @command
     def lsgroup(self, groupname):
@@ -330,9 +467,9 @@ class CLI(object):
         """
         members = models.LdapGroup.objects.get(name=groupname).usernames
         others = [
-            x.username
-            for x in models.LdapUser.objects.all()
-            if x.username not in members
+            username
+            for username in models.LdapUser.objects.values_list('username', flat=True)
+            if username not in members
         ]
 
         self.display("members:")
@@ -345,25 +482,72 @@ class CLI(object):
             self.display("  %s", other)
 
     @command
-    def lsuser(self):
+    def group_vcards(self, groupname):
         """
-        Print the list of users.
+        Print the vCards of all members of one group
         """
-        self.display("%20s%50s%20s", "username", "Email", "Password last set")
-        for user in models.LdapUser.objects.order_by('username'):
-            if user.samba_pwdlastset > time.time() - 3 * 365 * 24 * 60 * 60:
-                pwd_last_set = datetime.date.fromtimestamp(user.samba_pwdlastset).strftime('%d %b %Y')
-            else:
-                pwd_last_set = "long ago"
-            self.display("%20s%50s%20s", user.username, user.email, pwd_last_set)
+        try:
+            for chunk in exports.group_vcards(groupname):
+                sys.stdout.buffer.write(chunk)
+        except models.LdapGroup.DoesNotExist:
+            self.error("Group %s does not exist", groupname)
+            return
+        sys.stdout.flush()
+
+    @command
+    def group_print(self, groupname, format='csv'):
+        """
+        Print the directory of one group, sorted by name, as CSV or PDF
+        """
+        if format not in exports.PRINT_CONTENT_TYPES:
+            self.error("Unknown format %s, expected one of: %s", format, ', '.join(sorted(exports.PRINT_CONTENT_TYPES)))
+            return 1
+        try:
+            for chunk in exports.store.export(groupname, format):
+                sys.stdout.buffer.write(chunk)
+        except models.LdapGroup.DoesNotExist:
+            self.error("Group %s does not exist", groupname)
+            return 1
+        sys.stdout.flush()
+
+    @command
+    def group_phonebook(self, groupname, since=None):
+        """
+        Print the phonebook of one group as JSON, or its changes since a version
+        """
+        try:
+            current = phonebook.group_phonebook(groupname)
+        except models.LdapGroup.DoesNotExist:
+            self.error("Group %s does not exist", groupname)
+            return 1
+        sys.stdout.write(phonebook.dumps(current.export(since=since)).decode('utf-8') + '\n')
 
     @command
-    def lspasswd(self):
+    def lsuser(self, *options):
         """
-        Print the list of passwords.
+        Print the list of users (--format=ndjson, --fields=<name,...>).
         """
-        for user in models.LdapUser.objects.order_by('username'):
-            self.display(user.password)
+        def display(queryset):
+            self.display("%20s%50s%20s", "username", "Email", "Password last set")
+            for user in queryset.order_by('username').only('username', 'email', 'samba_pwdlastset'):
+                if user.samba_pwdlastset > time.time() - 3 * 365 * 24 * 60 * 60:
+                    pwd_last_set = datetime.date.fromtimestamp(user.samba_pwdlastset).strftime('%d %b %Y')
+                else:
+                    pwd_last_set = "long ago"
+                self.display("%20s%50s%20s", user.username, user.email, pwd_last_set)
+
+        fields = ['username', 'email'] + (['samba_pwdlastset'] if settings.GRANADILLA_USE_SAMBA else [])
+        return self._list(options, models.LdapUser.objects.all(), fields, display)
+
+    @command
+    def lspasswd(self, *options):
+        """
+        Print the list of passwords (--format=ndjson, --fields=<name,...>).
+        """
+        def display(queryset):
+            for user in queryset.order_by('username').only('username', 'password'):
+                self.display(user.password)
+        return self._list(options, models.LdapUser.objects.all(), ['username', 'password'], display)
 
     @command
     def lsjohnpasswd(self):
@@ -371,7 +555,7 @@ class CLI(object):
         Print the list of password formated for john
         """
         password_re = re.compile(r'^{\w+}([A-Za-z0-9/+=]+)$')  # {MD5}uihGYUGE==
-        for user in models.LdapUser.objects.order_by('username'):
+        for user in models.LdapUser.objects.order_by('username').only('username', 'password'):
             match = password_re.match(user.password)
             if not match:
                 self.warn("Password of user %s doesn't match {<ALGO>}<hash> format.", user.username)
@@ -386,9 +570,8 @@ class CLI(object):
         user = models.LdapUser.objects.get(username=username)
         self.display("Groups for %s (%s):\n", user.username, user.email)
 
-        for group in models.LdapGroup.objects.order_by('name'):
-            if user.username in group.usernames:
-                self.display(group.name)
+        for groupname in models.memberships.groups_of(user.username):
+            self.display(groupname)
 
     @command
     def moduser(self, username, attr, value):
@@ -413,12 +596,14 @@ class CLI(object):
         user.save()
 
     @command
-    def service_list(self):
+    def service_list(self, *options):
         """
-        Print the list of service accounts.
+        Print the list of service accounts (--format=ndjson, --fields=<name,...>).
         """
-        for account in models.LdapServiceAccount.objects.order_by('username'):
-            self.display("%-20s %s", account.username, account.description.replace('\n', '  '))
+        def display(queryset):
+            for account in queryset.order_by('username'):
+                self.display("%-20s %s", account.username, account.description.replace('\n', '  '))
+        return self._list(options, models.LdapServiceAccount.objects.all(), ['username', 'description'], display)
 
     @command
     def service_add(self, username):
@@ -464,12 +649,14 @@ class CLI(object):
         account.save()
 
     @command
-    def extuser_list(self):
+    def extuser_list(self, *options):
         """
-        Print the list of extuser accounts.
+        Print the list of extuser accounts (--format=ndjson, --fields=<name,...>).
         """
-        for account in models.LdapExternalUser.objects.order_by('email'):
-            self.display("%-20s %s", account.email, account.full_name)
+        def display(queryset):
+            for account in queryset.order_by('email'):
+                self.display("%-20s %s", account.email, account.full_name)
+        return self._list(options, models.LdapExternalUser.objects.all(), ['email', 'full_name'], display)
 
     @command
     def extuser_add(self, email):
@@ -560,12 +747,14 @@ class CLI(object):
         account.delete()
 
     @command
-    def device_list(self):
+    def device_list(self, *options):
         """
-        Print the list of devices and their owner.
+        Print the list of devices and their owner (--format=ndjson, --fields=<name,...>).
         """
-        for device in models.LdapDevice.objects.order_by('login'):
-            self.display("%s", device.login)
+        def display(queryset):
+            for device in queryset.order_by('login'):
+                self.display("%s", device.login)
+        return self._list(options, models.LdapDevice.objects.all(), ['login', 'owner_dn'], display)
 
     @command
     def device_add(self, username, device_name):
@@ -620,8 +809,7 @@ class CLI(object):
         """
         Synchronize device ACLs.
         """
-        for device_group in models.LdapDeviceGroup.objects.all():
-            device_group.resync()
+        sync.sync_device_groups()
 
     @command
     def help(self):
@@ -635,7 +823,13 @@ class CLI(object):
                 continue
 
             bits = [cmd]
-            bits.extend(["<%s>" % arg for arg in inspect.getargspec(func)[0][1:]])
+            code = func.__code__
+            arg_names = code.co_varnames[1:code.co_argcount]
+            optional = len(func.__defaults__ or ())
+            bits.extend(["<%s>" % arg for arg in arg_names[:len(arg_names) - optional]])
+            bits.extend(["[%s]" % arg for arg in arg_names[len(arg_names) - optional:]])
+            if code.co_flags & CO_VARARGS:
+                bits.append("[%s...]" % code.co_varnames[code.co_argcount])
             cmdhelp.append("%s%s" % (" ".join(bits).ljust(50), func.__doc__.strip()))
 
         self.display("""Usage: %s <command> [arguments..]
@@ -644,21 +838,94 @@ Commands:
 %s
 """, os.path.basename(sys.argv[0]), "\n".join(cmdhelp))
 
+    @command
+    def run_jobs(self, mode=None):
+        """
+        Run the queued background jobs (--loop: keep running them as they are queued).
+        """
+        if mode not in (None, '--loop'):
+            self.error("Unknown option %s", mode)
+            return 1
+
+        while True:
+            count = jobs.run_pending()
+            if count:
+                self.success("Ran %d jobs", count)
+            if mode is None:
+                return
+            time.sleep(settings.GRANADILLA_JOBS_POLL_INTERVAL)
+
+    @command
+    def shell(self, mode='--batch'):
+        """
+        Run commands read from stdin, one per line (--batch).
+        """
+        if mode != '--batch' or self.batch:
+            self.error("Only 'shell --batch' is supported, outside of batch mode.")
+            return 1
+
+        self.batch = True
+        failures = 0
+        try:
+            for number, line in enumerate(sys.stdin, start=1):
+                try:
+                    args = parse_batch_line(line)
+                except ValueError as e:
+                    result = {'line': number, 'command': None, 'status': 1, 'output': '', 'errors': str(e)}
+                else:
+                    if not args:
+                        continue
+                    result = dict(self.run_captured(args), line=number)
+                failures += bool(result['status'])
+                sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+                sys.stdout.flush()
+        finally:
+            self.batch = False
+        return 1 if failures else None
+
+    def run_captured(self, args):
+        """Run a command in batch mode, capturing its output.
+
+        Returns a dict with the command, its status (0 on success) and
+        outputs.
+        """
+        out = io.TextIOWrapper(io.BytesIO(), encoding='utf-8', newline='')
+        err = io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            try:
+                status = self.dispatch(args[0], args[1:])
+            except InteractionRequired as e:
+                self.error("%s", e)
+                status = 1
+            except Exception as e:
+                logger.exception("Command %s failed", args[0])
+                self.error("%s: %s", e.__class__.__name__, e)
+                status = 3
+        out.flush()
+        return {
+            'command': args,
+            'status': status or 0,
+            'output': out.buffer.getvalue().decode('utf-8'),
+            'errors': err.getvalue(),
+        }
+
     def main(self, argv):
         if len(argv) < 2:  # No command
             self.help()
             return 1
+        return self.dispatch(argv[1], argv[2:])
 
-        cmd = argv[1]
-        args = argv[2:]
+    def dispatch(self, cmd, args):
+        """Run a command; returns the exit status."""
         meth = getattr(self, cmd, None)
         if meth is None or not getattr(meth, 'is_command', False):
             self.error("Unknown command %s", cmd)
-            self.help()
+            if not self.batch:
+                self.help()
             return 1
 
         try:
-            meth(*args)
+            return meth(*args)
         except models.LdapUser.DoesNotExist:
             self.error("The requested user does not exist.")
             return 2
@@ -673,6 +940,31 @@ Commands:
             return 2
 
 
+def _json_default(value):
+    """Encode binary values (photos) as base64 in JSON output."""
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError("%r is not JSON serializable" % value)
+
+
+def parse_batch_line(line):
+    """Parse a line of 'shell --batch' input into [command, args...].
+
+    Lines are either JSON lists of strings, or shell-like words; blank
+    lines and comments (#) give an empty list.
+
+    Raises:
+        ValueError: invalid line.
+    """
+    line = line.strip()
+    if line.startswith('['):
+        args = json.loads(line)
+        if not all(isinstance(arg, str) for arg in args):
+            raise ValueError("Expected a JSON list of strings")
+        return args
+    return shlex.split(line, comments=True)
+
+
 def launch_cli():
     """Main 'cli' entry point."""
     cli = CLI()
@@ -19,6 +19,9 @@
 #
 
 
+import os.path
+import tempfile
+
 import appconf
 
 from django.conf import settings  # noqa: F401
@@ -57,6 +60,73 @@ class GranadillaConf(appconf.AppConf):
     USERS_HOME = '/home'
     USERS_SHELL = '/bin/bash'
 
+    # Caching: Django cache alias, and how long group memberships are kept (seconds)
+    CACHE_ALIAS = 'default'
+    MEMBERSHIP_CACHE_TTL = 300
+
+    # Read-through cache of entries: how long they are kept (seconds, 0 to
+    # disable), and how many cache keys each process may store
+    ENTRY_CACHE_TTL = 60
+    ENTRY_CACHE_SIZE = 2000
+
+    # In-memory replica of users, groups and devices, kept up to date by a
+    # syncrepl consumer thread of the web process; the directory is polled every
+    # REPLICA_POLL_INTERVAL seconds if the server doesn't support syncrepl.
+    REPLICA_ENABLED = False
+    REPLICA_POLL_INTERVAL = 30
+
+    # Pool of bound LDAP connections (granadilla.backends.ldap): how many
+    # idle connections are kept, how long a connection may be used
+    # (seconds), and after how long idle it is checked before reuse
+    LDAP_POOL_SIZE = 10
+    LDAP_POOL_MAX_AGE = 300
+    LDAP_POOL_CHECK_INTERVAL = 30
+
+    # People search: how often changes made by other processes are picked up
+    # (seconds), and the maximum number of results
+    SEARCH_REFRESH_INTERVAL = 60
+    SEARCH_RESULTS = 20
+
+    # Maximum number of name and phone number completions
+    AUTOCOMPLETE_RESULTS = 10
+
+    # Maximum number of values in a single LDAP (|(...)(...)) filter
+    SEARCH_CHUNK_SIZE = 200
+
+    # Number of cards per group page
+    GROUP_PAGE_SIZE = 100
+
+    # Propagate new devices to device groups in background jobs (requires
+    # 'granadilla.jobs' in INSTALLED_APPS): whether a thread of the web
+    # process runs them (otherwise, run `granadilla-admin run_jobs --loop`),
+    # how often it checks the queue, how long a job may run before being
+    # retried (seconds), and how failed jobs are retried
+    ASYNC_PROVISIONING = False
+    JOBS_WORKER_THREAD = True
+    JOBS_POLL_INTERVAL = 10
+    JOBS_LEASE = 300
+    JOBS_MAX_ATTEMPTS = 5
+    JOBS_RETRY_DELAY = 30
+
+    # How long the versions of group phonebooks are remembered for deltas (seconds)
+    PHONEBOOK_HISTORY_TTL = 7 * 24 * 3600
+
+    # Photos: resized variants (name => max width/height), where they are
+    # stored, and how long a user's photo digest is cached (seconds)
+    PHOTO_SIZES = {
+        'thumbnail': 128,
+    }
+    PHOTO_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'granadilla-photos')
+    PHOTO_CACHE_TTL = 3600
+
+    # Where printable group directories (CSV, PDF) are stored
+    EXPORT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'granadilla-exports')
+
+    # Name of the counters entry used to allocate uids and gids (cn=<name>
+    # under BASE_DN, requires the Samba schema); if empty, new ids are
+    # computed from the existing ones.
+    ID_POOL_NAME = ''
+
     # Password
     ZXCVBN_PASSWORD_MIN_SCORE = 3
 
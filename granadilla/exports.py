@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Exports of group members, shared by the web views and the CLI.
+
+Exports are generators: members are fetched chunk by chunk from paged LDAP
+searches, so that memory use doesn't depend on the size of the group.
+
+Printable directories (CSV and PDF) are sorted by name: only the sort keys
+of all members are loaded first.  They are also stored on disk, under
+GRANADILLA_EXPORT_CACHE_DIR, keyed by a digest of the members' DNs and
+modification times, and by language (headers are translated): printing an
+unchanged group again only costs a search of those timestamps.
+"""
+
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+
+from django.utils import translation
+
+from .conf import settings
+from . import models
+from . import pdf
+from . import vcard
+
+
+logger = logging.getLogger(__name__.split('.')[0])
+
+
+# Fields read by user_card()
+VCARD_FIELDS = ['first_name', 'last_name', 'full_name', 'email', 'phone', 'mobile_phone']
+
+
+def user_card(user):
+    """Build the vCard of a user or contact."""
+    card = vcard.VCard()
+    card['kind'] = 'individual'
+    card['names'] = [
+        [user.first_name],
+        [user.last_name],
+        [],  # Additional names
+        [],  # Honorific prefixes
+        [],  # Honorific suffixes
+    ]
+    card['full_name'] = user.full_name
+    card['email'] = user.email
+    card['org'] = getattr(user, 'organization', '')
+    card['phone'] = user.phone
+    card['cell'] = user.mobile_phone
+    return card
+
+
+def iter_members(group_name, fields):
+    """Iterate over the members of a group, loading only some fields.
+
+    Members are sorted by username within each search chunk.
+
+    Raises:
+        LdapGroup.DoesNotExist: no such group.
+    """
+    usernames = sorted(models.memberships.members_of(group_name))
+    for queryset in models.LdapUser.objects.chunked_in('username', usernames):
+        for member in sorted(queryset.projected(*fields), key=lambda member: member.username):
+            yield member
+
+
+def group_vcards(group_name):
+    """Iterate over the vCards of the members of a group, as bytes chunks.
+
+    The concatenation of all chunks is a valid multi-card .vcf file.
+    """
+    cards = (user_card(member) for member in iter_members(group_name, VCARD_FIELDS))
+    return vcard.render_many(cards)
+
+
+# Columns of printable directories: (field name, relative width)
+PRINT_COLUMNS = [
+    ('username', 2),
+    ('full_name', 3),
+    ('phone', 2),
+    ('mobile_phone', 2),
+    ('internal_phone', 1.5),
+]
+
+# Format => content type
+PRINT_CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'pdf': 'application/pdf',
+}
+
+
+def iter_sorted_members(group_name, fields):
+    """Iterate over the members of a group, sorted by name, loading only some fields.
+
+    Raises:
+        LdapGroup.DoesNotExist: no such group.
+    """
+    keys = []
+    for queryset in models.LdapUser.objects.chunked_in('username', models.memberships.members_of(group_name)):
+        for _dn, values in queryset.entries('username', 'last_name', 'first_name'):
+            keys.append(((values['last_name'] or '').lower(), (values['first_name'] or '').lower(), values['username']))
+    usernames = [username for _last_name, _first_name, username in sorted(keys)]
+
+    size = settings.GRANADILLA_SEARCH_CHUNK_SIZE
+    for start in range(0, len(usernames), size):
+        chunk = usernames[start:start + size]
+        members = {
+            member.username: member
+            for member in models.LdapUser.objects.filter(username__in=chunk).projected(*fields)
+        }
+        for username in chunk:
+            if username in members:
+                yield members[username]
+
+
+def print_rows(group_name):
+    fields = [name for name, _width in PRINT_COLUMNS]
+    for member in iter_sorted_members(group_name, fields):
+        yield tuple(getattr(member, name) or '' for name in fields)
+
+
+def print_headers():
+    return [str(models.LdapUser._meta.get_field(name).verbose_name) for name, _width in PRINT_COLUMNS]
+
+
+def group_csv(group_name):
+    """Iterate over the printable directory of a group, as CSV bytes chunks."""
+    # Headers are translated now, in the language of the caller.
+    return _csv_chunks(print_headers(), print_rows(group_name))
+
+
+def _csv_chunks(headers, rows):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(headers)
+    for number, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if number % settings.GRANADILLA_SEARCH_CHUNK_SIZE == 0:
+            yield output.getvalue().encode('utf-8')
+            output.seek(0)
+            output.truncate()
+    yield output.getvalue().encode('utf-8')
+
+
+def group_pdf(group_name):
+    """Iterate over the printable directory of a group, as PDF bytes chunks (one per page)."""
+    writer = pdf.TableWriter(group_name, print_headers(), [width for _name, width in PRINT_COLUMNS])
+    return writer.render(print_rows(group_name))
+
+
+PRINT_RENDERERS = {
+    'csv': group_csv,
+    'pdf': group_pdf,
+}
+
+
+class ExportStore(object):
+    """Printable directories, stored on disk by group, format and version."""
+
+    @property
+    def root(self):
+        return settings.GRANADILLA_EXPORT_CACHE_DIR
+
+    def version(self, group_name):
+        """Digest of the DNs and modification times of a group's members.
+
+        Returns None if the server doesn't expose modification times.
+
+        Raises:
+            LdapGroup.DoesNotExist: no such group.
+        """
+        timestamps = {}
+        for queryset in models.LdapUser.objects.chunked_in('username', models.memberships.members_of(group_name)):
+            timestamps.update(queryset.modify_timestamps())
+        if None in timestamps.values():
+            return None
+        state = sorted((models.normalise_dn(dn), modified.isoformat()) for dn, modified in timestamps.items())
+        return hashlib.sha256(json.dumps(state).encode('utf-8')).hexdigest()
+
+    def prefix(self, group_name, format, language):
+        """Prefix of the files of a group's exports in a format and language."""
+        # Locale names have no dashes: prefixes of different languages never overlap.
+        locale = translation.to_locale(language) if language else 'default'
+        return '%s-%s-%s-' % (hashlib.sha256(group_name.encode('utf-8')).hexdigest()[:16], format, locale)
+
+    def _read(self, f):
+        with f:
+            while True:
+                chunk = f.read(64 * 1024)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _write(self, prefix, version, chunks):
+        """Pass chunks through, storing them on disk once all have been read."""
+        os.makedirs(self.root, exist_ok=True)
+        # Write then rename, so that readers never see a partial file.
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+        except BaseException:  # Including GeneratorExit, when the client goes away
+            os.unlink(tmp_path)
+            raise
+        os.replace(tmp_path, os.path.join(self.root, prefix + version))
+
+        for name in os.listdir(self.root):
+            if name.startswith(prefix) and name != prefix + version:
+                try:
+                    os.unlink(os.path.join(self.root, name))
+                except FileNotFoundError:
+                    pass  # Removed by another process
+
+    def export(self, group_name, format):
+        """The printable directory of a group, as bytes chunks; from disk if unchanged.
+
+        Raises:
+            LdapGroup.DoesNotExist: no such group.
+        """
+        version = self.version(group_name)
+        chunks = PRINT_RENDERERS[format](group_name)
+        if version is None:
+            return chunks
+        prefix = self.prefix(group_name, format, translation.get_language())
+        try:
+            f = open(os.path.join(self.root, prefix + version), 'rb')
+        except FileNotFoundError:
+            logger.info("Generating the %s export of group %s", format, group_name)
+            return self._write(prefix, version, chunks)
+        return self._read(f)
+
+
+store = ExportStore()
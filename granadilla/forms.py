@@ -19,6 +19,7 @@
 #
 
 from . import models
+from . import photos
 from django import forms
 from django.utils.translation import gettext_lazy as _
 
@@ -44,8 +45,8 @@ class LdapDeviceForm(forms.Form):
         return name
 
     def save(self, commit=True):
-        # target_user might be a Django User object
-        user = models.LdapUser.objects.get(username=self.target_user.username)
+        # target_user might be a Django User object; only its DN is needed.
+        user = models.LdapUser.objects.cached(pk=self.target_user.username)
         name = self.data['name']
         login = '%s_%s' % (user.username, name)
 
@@ -71,6 +72,11 @@ class LdapUserForm(forms.ModelForm):
             contact.photo = photo.read()
         if commit:
             contact.save()
+            if hasattr(photo, 'read'):
+                # Have the resized variants ready before they are requested.
+                photos.store.generate(contact.photo)
+                modified = models.LdapUser.objects.filter(pk=contact.pk).modify_timestamps()
+                photos.store.remember(contact.username, contact.photo, modified.get(contact.dn))
         return contact
 
     class Meta:
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Allocation of uidNumber and gidNumber values.
+
+When GRANADILLA_ID_POOL_NAME is set, the next free ids are kept in a
+sambaUnixIdPool entry.  An id is taken with a single modify replacing the
+value read by its successor (delete the old value, add the new one): if
+another process took it first, the delete fails and we retry.  Concurrent
+allocations thus never return the same id, and each costs a few small
+requests whatever the size of the directory.  Blocks of ids are taken the
+same way, with a single modify.
+
+Without a pool, the next id is computed from the existing ones, fetching
+only that attribute.
+"""
+
+import logging
+
+import ldap
+from django.db import connections, router
+
+from .conf import settings
+from . import models
+
+
+logger = logging.getLogger(__name__.split('.')[0])
+
+FIRST_ID = 10000
+
+# How many times to retry when other processes allocate concurrently
+MAX_ATTEMPTS = 20
+
+# Pool field => model whose ids are allocated
+ALLOCATED_MODELS = {
+    'uid': models.LdapUser,
+    'gid': models.LdapGroup,
+}
+
+
+class AllocationError(Exception):
+    pass
+
+
+def next_free(field_name):
+    """Compute the next free id from the existing ones (no pool)."""
+    ids = ALLOCATED_MODELS[field_name].objects.values_list(field_name, flat=True)
+    return max(ids, default=FIRST_ID - 1) + 1
+
+
+def used_between(field_name, low, high):
+    """Ids already used within [low, high]."""
+    queryset = ALLOCATED_MODELS[field_name].objects.filter(**{
+        '%s__gte' % field_name: low,
+        '%s__lte' % field_name: high,
+    })
+    return set(queryset.values_list(field_name, flat=True))
+
+
+def create_pool():
+    """Create the counters entry, starting after the existing ids.
+
+    Returns the new pool, or None if it already exists or none is configured.
+    """
+    name = settings.GRANADILLA_ID_POOL_NAME
+    if not name or any(True for _entry in models.LdapIdPool.objects.filter(name=name).entries()):
+        return None
+    pool = models.LdapIdPool(name=name, uid=next_free('uid'), gid=next_free('gid'))
+    pool.save()
+    return pool
+
+
+def _reserve(name, field_name, count):
+    """Take ``count`` consecutive ids from a pool; returns the first one.
+
+    Returns None if the pool doesn't exist.
+    """
+    field = models.LdapIdPool._meta.get_field(field_name)
+    connection = connections[router.db_for_write(models.LdapIdPool)]
+
+    for _attempt in range(MAX_ATTEMPTS):
+        entries = list(models.LdapIdPool.objects.filter(name=name).entries(field_name))
+        if not entries:
+            return None
+        dn, values = entries[0]
+        value = values[field_name]
+
+        try:
+            connection.modify_s(dn, [
+                (ldap.MOD_DELETE, field.db_column, field.get_db_prep_save(value, connection=connection)),
+                (ldap.MOD_ADD, field.db_column, field.get_db_prep_save(value + count, connection=connection)),
+            ])
+        except ldap.NO_SUCH_ATTRIBUTE:
+            # Taken by another process in the meantime.
+            continue
+        return value
+
+    raise AllocationError("Unable to allocate a %s from pool %s after %d attempts" % (field_name, name, MAX_ATTEMPTS))
+
+
+def allocate_block(field_name, count):
+    """Allocate ``count`` new 'uid' or 'gid' values, as a sorted list."""
+    name = settings.GRANADILLA_ID_POOL_NAME
+    if not name:
+        start = next_free(field_name)
+        return list(range(start, start + count))
+
+    allocated = []
+    while len(allocated) < count:
+        needed = count - len(allocated)
+        start = _reserve(name, field_name, needed)
+        if start is None:
+            logger.warning("ID pool %s not found, computing the next %s from existing ones", name, field_name)
+            start = next_free(field_name)
+            allocated.extend(range(start, start + needed))
+            break
+
+        # The counter may lag behind ids assigned by other tools.
+        used = used_between(field_name, start, start + needed - 1)
+        for value in range(start, start + needed):
+            if value in used:
+                logger.warning("%s %d from pool %s is already used, skipping it", field_name, value, name)
+            else:
+                allocated.append(value)
+    return allocated
+
+
+def allocate(field_name):
+    """Allocate a new 'uid' or 'gid'."""
+    return allocate_block(field_name, 1)[0]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Background jobs, kept in a queue in the Django database.
+
+Used to propagate device access (see GRANADILLA_ASYNC_PROVISIONING); add
+'granadilla.jobs' to INSTALLED_APPS and run its migrations to enable it.
+"""
+
+default_app_config = 'granadilla.jobs.apps.JobsConfig'
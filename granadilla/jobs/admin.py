@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.contrib import admin
+
+from . import models
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'key', 'status', 'attempts', 'run_after', 'created']
+    list_filter = ['status', 'kind']
+    readonly_fields = ['attempts', 'locked_until', 'last_error', 'created']
+
+
+admin.site.register(models.Job, JobAdmin)
@@ -0,0 +1,46 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=32, verbose_name='kind')),
+                ('key', models.CharField(max_length=255, verbose_name='key')),
+                ('owner_dns', models.TextField(blank=True, default='', verbose_name='owner distinguished names')),
+                ('status', models.CharField(
+                    choices=[('pending', 'pending'), ('running', 'running'), ('failed', 'failed')],
+                    default='pending',
+                    max_length=16,
+                    verbose_name='status',
+                )),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now, verbose_name='run after')),
+                ('locked_until', models.DateTimeField(blank=True, null=True, verbose_name='locked until')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='last error')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+            ],
+            options={
+                'verbose_name': 'job',
+                'verbose_name_plural': 'jobs',
+                'ordering': ('run_after', 'id'),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['status', 'run_after'], name='granadilla_job_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['kind', 'key'], name='granadilla_job_kind_key_idx'),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import models
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+
+class Job(models.Model):
+    """A queued job; finished jobs are deleted, failed ones kept for inspection.
+
+    Jobs of the same kind and key are coalesced while pending: their owner
+    DNs are merged into a single job.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUSES = [
+        (PENDING, _("pending")),
+        (RUNNING, _("running")),
+        (FAILED, _("failed")),
+    ]
+
+    kind = models.CharField(_("kind"), max_length=32)
+    key = models.CharField(_("key"), max_length=255)
+    # One DN per line, with leading and trailing newlines
+    owner_dns = models.TextField(_("owner distinguished names"), blank=True, default='')
+    status = models.CharField(_("status"), max_length=16, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveIntegerField(_("attempts"), default=0)
+    run_after = models.DateTimeField(_("run after"), default=timezone.now)
+    locked_until = models.DateTimeField(_("locked until"), null=True, blank=True)
+    last_error = models.TextField(_("last error"), blank=True, default='')
+    created = models.DateTimeField(_("created"), auto_now_add=True)
+
+    class Meta:
+        ordering = ('run_after', 'id')
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='granadilla_job_status_idx'),
+            models.Index(fields=['kind', 'key'], name='granadilla_job_kind_key_idx'),
+        ]
+        verbose_name = _("job")
+        verbose_name_plural = _("jobs")
+
+    def __str__(self):
+        return '%s %s (%s)' % (self.kind, self.key, self.status)
+
+    def get_owner_dns(self):
+        return [dn for dn in self.owner_dns.split('\n') if dn]
+
+    @staticmethod
+    def join_dns(dns):
+        return '\n%s\n' % '\n'.join(sorted(set(dns))) if dns else ''
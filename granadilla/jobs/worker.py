@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Propagation of device access, in background jobs.
+
+Adding a device to the VPN device groups of its owner's groups takes a
+few searches and modifications; with GRANADILLA_ASYNC_PROVISIONING, they
+are queued instead, so that saving a device costs a single LDAP write:
+
+- an 'owner_devices' job (keyed by owner DN) finds the device groups of
+  the owner's groups, and queues:
+- a 'device_group' job per device group (keyed by its name), which adds
+  the devices of the owners it was queued for.
+
+Pending jobs with the same key are coalesced, merging their owners.
+Workers claim jobs for GRANADILLA_JOBS_LEASE seconds: a job whose worker
+died is run again once its lease expires, and failed jobs are retried
+GRANADILLA_JOBS_MAX_ATTEMPTS times, after GRANADILLA_JOBS_RETRY_DELAY
+seconds, doubled at each attempt.  Jobs are thus run at least once, and
+must be idempotent.
+
+Jobs are run by a thread of the web process (GRANADILLA_JOBS_WORKER_THREAD),
+started along with the WSGI application so that jobs left over by a restart
+are picked up; other processes only start it when they queue a job.  Without
+that thread, `granadilla-admin run_jobs --loop` must be running.
+"""
+
+import datetime
+import logging
+import threading
+
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from ..conf import settings
+from .. import models
+from .models import Job
+
+
+logger = logging.getLogger(__name__.split('.')[0])
+
+
+# Queueing
+
+def enqueue(kind, key, owner_dns=()):
+    """Queue a job, or merge the owners into the pending job of the same kind and key."""
+    owner_dns = list(owner_dns)
+    with transaction.atomic():
+        # Failed jobs are superseded by the new one, which takes over their owners.
+        failed = Job.objects.filter(kind=kind, key=key, status=Job.FAILED)
+        for job in failed:
+            owner_dns.extend(job.get_owner_dns())
+        failed.delete()
+        for job in Job.objects.filter(kind=kind, key=key, status=Job.PENDING):
+            merged = Job.join_dns(job.get_owner_dns() + owner_dns)
+            # Not claimed by a worker in the meantime
+            if Job.objects.filter(pk=job.pk, status=Job.PENDING).update(owner_dns=merged):
+                break
+        else:
+            Job.objects.create(kind=kind, key=key, owner_dns=Job.join_dns(owner_dns))
+    transaction.on_commit(wake_worker)
+
+
+def enqueue_device_provisioning(owner_dn):
+    """Queue the propagation of an owner's devices to their device groups."""
+    enqueue('owner_devices', models.normalise_dn(owner_dn), [owner_dn])
+
+
+def owner_statuses(owner_dns):
+    """Provisioning status of some owners, as {owner DN: Job.PENDING or Job.FAILED}.
+
+    Owners without pending or failed jobs are up to date, and not listed.
+    """
+    wanted = {models.normalise_dn(dn): dn for dn in owner_dns}
+    statuses = {}
+    # Failed jobs first, so that pending (or running) ones take precedence.
+    for status, dns in Job.objects.order_by('status').values_list('status', 'owner_dns'):
+        for dn in dns.split('\n'):
+            owner_dn = wanted.get(models.normalise_dn(dn)) if dn else None
+            if owner_dn is not None:
+                statuses[owner_dn] = Job.FAILED if status == Job.FAILED else Job.PENDING
+    return statuses
+
+
+# Handlers
+
+def run_owner_devices(job):
+    for owner_dn in job.get_owner_dns():
+        try:
+            owner = models.LdapUser.objects.only('username').get(dn=owner_dn)
+        except models.LdapUser.DoesNotExist:
+            continue
+        group_dns = models.memberships.group_dns_of(owner.username)
+        if not group_dns:
+            continue
+        for device_group in models.LdapDeviceGroup.objects.filter(group_dn__in=group_dns).only('name'):
+            enqueue('device_group', device_group.name, [owner_dn])
+
+
+def run_device_group(job):
+    try:
+        device_group = models.LdapDeviceGroup.objects.get(name=job.key)
+    except models.LdapDeviceGroup.DoesNotExist:
+        return
+    device_dns = [
+        dn
+        for queryset in models.LdapDevice.objects.chunked_in('owner_dn', job.get_owner_dns())
+        for dn, _values in queryset.entries()
+    ]
+    device_group.add_members(device_dns)
+
+
+HANDLERS = {
+    'owner_devices': run_owner_devices,
+    'device_group': run_device_group,
+}
+
+
+# Running
+
+def _runnable(now):
+    return Q(status=Job.PENDING, run_after__lte=now) | Q(status=Job.RUNNING, locked_until__lt=now)
+
+
+def claim():
+    """Take the next runnable job; returns None if there is none."""
+    now = timezone.now()
+    for pk in Job.objects.filter(_runnable(now)).values_list('pk', flat=True)[:10]:
+        claimed = Job.objects.filter(_runnable(now), pk=pk).update(
+            status=Job.RUNNING,
+            locked_until=now + datetime.timedelta(seconds=settings.GRANADILLA_JOBS_LEASE),
+            attempts=F('attempts') + 1,
+        )
+        if claimed:
+            return Job.objects.get(pk=pk)
+    return None
+
+
+def run(job):
+    """Run a claimed job; it is deleted if successful, and retried otherwise."""
+    try:
+        HANDLERS[job.kind](job)
+    except Exception as e:
+        logger.exception("Job %s failed (attempt %d)", job, job.attempts)
+        if job.attempts >= settings.GRANADILLA_JOBS_MAX_ATTEMPTS:
+            changes = {'status': Job.FAILED}
+        else:
+            delay = settings.GRANADILLA_JOBS_RETRY_DELAY * 2 ** (job.attempts - 1)
+            changes = {'status': Job.PENDING, 'run_after': timezone.now() + datetime.timedelta(seconds=delay)}
+        Job.objects.filter(pk=job.pk).update(locked_until=None, last_error=str(e), **changes)
+        return False
+    Job.objects.filter(pk=job.pk).delete()
+    return True
+
+
+def run_pending():
+    """Run all runnable jobs, including those queued meanwhile; returns the number of jobs run."""
+    count = 0
+    while True:
+        job = claim()
+        if job is None:
+            return count
+        run(job)
+        count += 1
+
+
+class Worker(threading.Thread):
+    """Runs jobs as they are queued, and every GRANADILLA_JOBS_POLL_INTERVAL seconds."""
+
+    def __init__(self):
+        super(Worker, self).__init__(name='granadilla-jobs', daemon=True)
+        self.wake = threading.Event()
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+        self.wake.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                run_pending()
+            except Exception:
+                logger.exception("Unable to run jobs, retrying")
+            finally:
+                close_old_connections()
+            self.wake.wait(settings.GRANADILLA_JOBS_POLL_INTERVAL)
+            self.wake.clear()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def start_worker():
+    """Start the worker thread of this process, if enabled; returns it, or None.
+
+    Once started, it runs the jobs already queued, then polls the queue.
+    """
+    global _worker
+    if not (settings.GRANADILLA_ASYNC_PROVISIONING and settings.GRANADILLA_JOBS_WORKER_THREAD):
+        return None
+    with _worker_lock:
+        if _worker is None:
+            _worker = Worker()
+            _worker.start()
+        return _worker
+
+
+def wake_worker():
+    """Have the worker thread of this process run the queued jobs, starting it if needed."""
+    worker = start_worker()
+    if worker is not None:
+        worker.wake.set()
+
+
+def stop_worker():
+    global _worker
+    with _worker_lock:
+        worker, _worker = _worker, None
+    if worker is not None:
+        worker.stop()
+        worker.join()
@@ -20,22 +20,33 @@
 
 import base64
 import collections
+import datetime
+import functools
 import hashlib
 
 import logging
 import os
 import time
 import random
+import threading
 import unicodedata
 
+import ldap
+import ldap.controls
+import ldap.dn
 import zxcvbn
 
 from .conf import settings
 from django.utils.translation import gettext_lazy as _
 
+from django.core.cache import caches
+from django.db import connections, router
+from django.db import models as django_models
+from django.db.models import query as django_query
 from django.utils.crypto import constant_time_compare
 
 from ldapdb import models as ldap_models
+from ldapdb.backends.ldap import compiler as ldap_compiler
 from ldapdb.models import fields as ldap_fields
 
 
@@ -62,6 +73,422 @@ def nthash(cleartext):
     return hashlib.new('md4', cleartext.encode('utf-16le')).hexdigest().upper()
 
 
+class ProjectedModelIterable(django_query.ModelIterable):
+    """Yield model instances, requesting only the non-deferred attributes.
+
+    django-ldapdb always fetches every attribute of the model, even when
+    some fields are deferred through only() or defer().
+    """
+
+    def __iter__(self):
+        queryset = self.queryset
+        query = queryset.query
+        opts = queryset.model._meta
+
+        names, defer = query.deferred_loading
+        if defer:
+            loaded = {field.name for field in opts.concrete_fields if field.name not in names}
+        else:
+            loaded = set(names)
+
+        ordering = query.order_by or (opts.ordering if query.default_ordering else ())
+        ordering = [
+            (name[1:], True) if name.startswith('-') else (name, False)
+            for name in ordering
+        ]
+        ordering = [(opts.pk.name if name == 'pk' else name, reverse) for name, reverse in ordering]
+        # Sorting happens client-side, we need those fields too.
+        loaded.update(name for name, _reverse in ordering)
+
+        results = list(queryset.projected(*loaded))
+        for name, reverse in reversed(ordering):
+            results.sort(key=functools.partial(_sort_key, name), reverse=reverse)
+
+        return iter(results[query.low_mark:query.high_mark])
+
+
+def _sort_key(field_name, instance):
+    value = getattr(instance, field_name)
+    if hasattr(value, 'lower'):
+        value = value.lower()
+    return value
+
+
+class LdapQuerySet(django_models.QuerySet):
+    """QuerySet with LDAP-specific helpers.
+
+    only() and defer() restrict the list of attributes requested from LDAP.
+    """
+
+    def only(self, *fields):
+        clone = super(LdapQuerySet, self).only(*fields)
+        if clone._iterable_class is django_query.ModelIterable:
+            clone._iterable_class = ProjectedModelIterable
+        return clone
+
+    def defer(self, *fields):
+        clone = super(LdapQuerySet, self).defer(*fields)
+        if clone._iterable_class is django_query.ModelIterable:
+            clone._iterable_class = ProjectedModelIterable
+        return clone
+
+    def get_by_dn(self, dn):
+        """Fetch a single entry from its DN.
+
+        This issues a base-scoped search on the DN itself, instead of
+        looking for the entry within the whole subtree of the model.
+        """
+        # django-ldapdb turns a lone `dn=` lookup into a SCOPE_BASE search.
+        return self.get(dn=dn)
+
+    def cached(self, pk=None, dn=None):
+        """Get an entry by primary key or DN, through the entry cache."""
+        return entry_cache.get(self, pk=pk, dn=dn)
+
+    def entries(self, *field_names, modified_since=None):
+        """Iterate over the matching entries, as (dn, {field name: value}) pairs.
+
+        Only the LDAP attributes backing ``field_names`` are requested; entries
+        are yielded as the server returns them, page by page (see
+        paged_search()), without sorting.
+
+        With ``modified_since`` (an aware datetime), only entries modified since
+        then are returned.
+        """
+        fields = [self.model._meta.get_field(name) for name in field_names]
+        # '1.1' is the LDAP way of asking for no attributes at all.
+        attrlist = [field.db_column for field in fields if field.db_column] or ['1.1']
+        extra_filter = ''
+        if modified_since is not None:
+            timestamp = modified_since.astimezone(datetime.timezone.utc).strftime('%Y%m%d%H%M%SZ')
+            extra_filter = '(modifyTimestamp>=%s)' % timestamp
+
+        for connection, dn, attrs in self._search(attrlist, extra_filter):
+            values = {}
+            for field in fields:
+                if field.db_column:
+                    values[field.name] = field.from_ldap(attrs.get(field.db_column, []), connection=connection)
+                else:
+                    values[field.name] = dn
+            yield dn, values
+
+    def dns_with(self, field_name):
+        """DNs of the matching entries having a value for the given field.
+
+        This is a presence check: the values themselves are not fetched.
+        """
+        field = self.model._meta.get_field(field_name)
+        return {dn for _connection, dn, _attrs in self._search(['1.1'], '(%s=*)' % field.db_column)}
+
+    def modify_timestamps(self, having=None):
+        """Last modification time of the matching entries, as {dn: datetime}.
+
+        With ``having``, only entries with a value for that field are
+        returned (presence check).  Dates are None if the server doesn't
+        expose the operational attribute.
+        """
+        extra_filter = ''
+        if having:
+            extra_filter = '(%s=*)' % self.model._meta.get_field(having).db_column
+        return {
+            dn: ldap_fields.datetime_from_ldap(
+                attrs.get('modifyTimestamp', [b''])[0].decode(connection.charset),
+            )
+            for connection, dn, attrs in self._search(['modifyTimestamp'], extra_filter)
+        }
+
+    def _search(self, attrlist, extra_filter=''):
+        compiler = self.query.get_compiler(using=self.db)
+        connection = compiler.connection
+        lookup = ldap_compiler.query_as_ldap(self.query, compiler=compiler, connection=connection)
+        if lookup is None:
+            return
+
+        filterstr = lookup.filterstr
+        if extra_filter:
+            filterstr = '(&%s%s)' % (filterstr, extra_filter)
+
+        try:
+            for dn, attrs in paged_search(connection, lookup.base, lookup.scope, filterstr, attrlist):
+                yield connection, dn, attrs
+        except ldap.NO_SUCH_OBJECT:
+            return
+
+    def projected(self, *field_names):
+        """Iterate over the matching entries, loading only the given fields.
+
+        Other fields are deferred: they are fetched from LDAP if accessed.
+        Like entries(), results are not sorted.
+        """
+        names = set(field_names) | {'dn', self.model._meta.pk.name}
+        fields = [field for field in self.model._meta.concrete_fields if field.name in names]
+        attnames = [field.attname for field in fields]
+        for _dn, values in self.entries(*[field.name for field in fields]):
+            yield self.model.from_db(self.db, attnames, [values[field.name] for field in fields])
+
+    def chunked_in(self, field_name, values):
+        """Split a ``<field_name>__in`` filter into several querysets.
+
+        This keeps the LDAP filters, and thus server-side evaluation, short.
+        """
+        values = list(values)
+        size = settings.GRANADILLA_SEARCH_CHUNK_SIZE
+        return [
+            self.filter(**{'%s__in' % field_name: values[start:start + size]})
+            for start in range(0, len(values), size)
+        ]
+
+
+def paged_search(connection, base, scope, filterstr, attrlist):
+    """Search LDAP with the paged results control, yielding (dn, attrs) pairs.
+
+    Each page is yielded as soon as it arrives, before the next one is
+    requested: only one page is held in memory, whatever the number of
+    entries.
+    """
+    control = ldap.controls.SimplePagedResultsControl(criticality=False, size=connection.page_size, cookie='')
+    with connection.cursor() as cursor:
+        ldap_object = cursor.connection
+        while True:
+            msgid = ldap_object.search_ext(
+                base, scope, filterstr, attrlist, serverctrls=[control], timeout=ldap_object.timeout,
+            )
+            _type, results, _msgid, server_controls = ldap_object.result3(msgid, timeout=ldap_object.timeout)
+            for dn, attrs in results:
+                if dn is not None:  # Skip referrals
+                    yield dn, attrs
+
+            cookies = [ctrl.cookie for ctrl in server_controls if ctrl.controlType == control.controlType]
+            if not cookies or not cookies[0]:
+                break
+            control.cookie = cookies[0]
+
+
+def modify_values(instance, field_name, added=(), removed=()):
+    """Add and remove values of a multi-valued field, in a single LDAP modify.
+
+    Unlike save(), this neither fetches the entry first nor rewrites the
+    whole list of values.  The instance is updated accordingly.
+    """
+    field = instance._meta.get_field(field_name)
+    connection = connections[router.db_for_write(instance.__class__, instance=instance)]
+
+    modlist = []
+    if added:
+        modlist.append((ldap.MOD_ADD, field.db_column, field.get_db_prep_save(added, connection=connection)))
+    if removed:
+        modlist.append((ldap.MOD_DELETE, field.db_column, field.get_db_prep_save(removed, connection=connection)))
+    if not modlist:
+        return
+
+    connection.modify_s(instance.dn, modlist)
+    entry_cache.invalidate(instance.__class__, pk=instance.pk, dn=instance.dn)
+    removed = set(removed)
+    values = [value for value in getattr(instance, field_name) if value not in removed]
+    values.extend(sorted(set(added) - set(values)))
+    setattr(instance, field_name, values)
+
+
+def add_entries(instances, using=None, window=100):
+    """Create new entries over a single connection, pipelining the requests.
+
+    Up to ``window`` add requests are sent before their results are read.
+    save() is not called: the instances must be complete.
+
+    Returns the list of errors (an LDAPError, or None on success), in the
+    order of ``instances``.
+    """
+    errors = []
+    if not instances:
+        return errors
+    model = instances[0].__class__
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    fields = [
+        field
+        for field in model._meta.get_fields(include_hidden=True)
+        if field.concrete and not field.primary_key
+    ]
+
+    with connection.cursor() as cursor:
+        for start in range(0, len(instances), window):
+            pending = []
+            for instance in instances[start:start + window]:
+                dn = instance.build_dn()
+                modlist = [('objectClass', [object_class.encode('utf-8') for object_class in instance.object_classes])]
+                for field in fields:
+                    values = field.get_db_prep_save(getattr(instance, field.attname), connection=connection)
+                    if values:
+                        modlist.append((field.db_column, values))
+                pending.append((instance, dn, cursor.connection.add_ext(dn, modlist)))
+
+            for instance, dn, msgid in pending:
+                try:
+                    cursor.connection.result3(msgid)
+                except ldap.LDAPError as e:
+                    errors.append(e)
+                else:
+                    instance.dn = instance._saved_dn = dn
+                    entry_cache.invalidate(model, pk=instance.pk, dn=dn)
+                    errors.append(None)
+    return errors
+
+
+def normalise_dn(dn):
+    """Normalise a DN for comparisons (case and spacing)."""
+    return ldap.dn.dn2str(ldap.dn.str2dn(dn)).lower()
+
+
+class EntryCache(object):
+    """Read-through cache of full entries, kept in Django's cache.
+
+    Entries are stored under their primary key, with a pointer from their
+    DN.  Each process keeps track of the keys it stored, in LRU order, and
+    evicts the oldest ones beyond GRANADILLA_ENTRY_CACHE_SIZE; entries also
+    expire after GRANADILLA_ENTRY_CACHE_TTL seconds (0 disables the cache).
+
+    Entries are invalidated when saved or deleted (see CachedEntryMixin).
+
+    Models kept in the replica are served from it when it is up to date
+    (see replica.Replica.serves()).
+    """
+    key_prefix = 'granadilla:entry'
+
+    def __init__(self):
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        return caches[settings.GRANADILLA_CACHE_ALIAS]
+
+    @property
+    def enabled(self):
+        return settings.GRANADILLA_ENTRY_CACHE_TTL > 0
+
+    def _key(self, model, kind, value):
+        # Hashed: DNs may hold characters or lengths some backends reject.
+        digest = hashlib.sha1(str(value).encode('utf-8')).hexdigest()
+        return '%s:%s:%s:%s' % (self.key_prefix, model._meta.label_lower, kind, digest)
+
+    def _pk_key(self, model, pk):
+        return self._key(model, 'pk', pk)
+
+    def _dn_key(self, model, dn):
+        return self._key(model, 'dn', normalise_dn(dn))
+
+    def _touch(self, *keys):
+        """Mark keys as recently used; returns the keys to evict."""
+        with self._lock:
+            for key in keys:
+                self._keys[key] = None
+                self._keys.move_to_end(key)
+            evicted = []
+            while len(self._keys) > settings.GRANADILLA_ENTRY_CACHE_SIZE:
+                evicted.append(self._keys.popitem(last=False)[0])
+        return evicted
+
+    def _forget(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._keys.pop(key, None)
+
+    def get(self, queryset, pk=None, dn=None):
+        """Get an entry by primary key or DN, from the cache if possible.
+
+        Raises:
+            DoesNotExist: no such entry.
+        """
+        assert (pk is None) != (dn is None), "Exactly one of pk and dn is required"
+        from .replica import replica  # The replica module imports this one.
+        model = queryset.model
+        if replica.serves(model):
+            entry = replica.get(model, pk=pk, dn=dn)
+            if entry is None:
+                raise model.DoesNotExist("%s %s not found" % (model._meta.verbose_name, pk or dn))
+            self.hits += 1
+            return entry.instance()
+
+        lookup = {'pk': pk} if dn is None else {'dn': dn}
+        if not self.enabled:
+            return queryset.get(**lookup)
+
+        if dn is not None:
+            pk = self.cache.get(self._dn_key(model, dn))
+        instance = self.cache.get(self._pk_key(model, pk)) if pk is not None else None
+
+        if instance is not None:
+            self.hits += 1
+            self._touch(self._pk_key(model, pk))
+            return instance
+
+        self.misses += 1
+        instance = queryset.get(**lookup)
+        self.store(instance)
+        return instance
+
+    def store(self, instance):
+        model = instance.__class__
+        pk_key = self._pk_key(model, instance.pk)
+        dn_key = self._dn_key(model, instance.dn)
+        self.cache.set_many({pk_key: instance, dn_key: instance.pk}, settings.GRANADILLA_ENTRY_CACHE_TTL)
+        evicted = self._touch(pk_key, dn_key)
+        if evicted:
+            self.cache.delete_many(evicted)
+
+    def invalidate(self, model, pk=None, dn=None):
+        """Drop an entry, given its primary key and/or DN."""
+        from .replica import replica
+        replica.mark_dirty(model, dn)
+        keys = []
+        if dn:
+            dn_key = self._dn_key(model, dn)
+            keys.append(dn_key)
+            # The DN may point to a former primary key (renamed entry).
+            old_pk = self.cache.get(dn_key)
+            if old_pk is not None:
+                keys.append(self._pk_key(model, old_pk))
+        if pk is not None:
+            keys.append(self._pk_key(model, pk))
+        self.cache.delete_many(keys)
+        self._forget(*keys)
+
+    def stats(self):
+        """Hit and miss counters of this process."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else None,
+            'size': len(self._keys),
+        }
+
+
+entry_cache = EntryCache()
+
+
+class CachedEntryMixin(object):
+    """Invalidate the cached copy of an entry when it is saved or deleted."""
+
+    def save(self, *args, **kwargs):
+        old_dn = self._saved_dn
+        res = super(CachedEntryMixin, self).save(*args, **kwargs)
+        entry_cache.invalidate(self.__class__, pk=self.pk, dn=self.dn)
+        if old_dn and old_dn != self.dn:
+            entry_cache.invalidate(self.__class__, dn=old_dn)
+        return res
+
+    def delete(self, *args, **kwargs):
+        res = super(CachedEntryMixin, self).delete(*args, **kwargs)
+        entry_cache.invalidate(self.__class__, pk=self.pk, dn=self.dn)
+        return res
+
+
+LdapManager = django_models.Manager.from_queryset(LdapQuerySet)
+
+
 PasswordCheckResult = collections.namedtuple('PasswordCheckResult', ['good', 'message'])
 
 
@@ -81,7 +508,7 @@ def check_password_strength(candidate, blacklist):
         )
 
 
-class LdapAcl(ldap_models.Model):
+class LdapAcl(CachedEntryMixin, ldap_models.Model):
     """
     Class for representing an LDAP ACL entry.
     """
@@ -89,6 +516,8 @@ class LdapAcl(ldap_models.Model):
     base_dn = settings.GRANADILLA_ACLS_DN
     object_classes = ['groupOfNames']
 
+    objects = LdapManager()
+
     # groupOfNames
     name = ldap_fields.CharField(_("name"), db_column='cn', primary_key=True)
     members = ldap_fields.ListField(_("members"), db_column='member')
@@ -108,7 +537,7 @@ class LdapAcl(ldap_models.Model):
         verbose_name_plural = _("access control lists")
 
 
-class LdapGroup(ldap_models.Model):
+class LdapGroup(CachedEntryMixin, ldap_models.Model):
     """
     Class for representing an LDAP group entry.
     """
@@ -116,6 +545,8 @@ class LdapGroup(ldap_models.Model):
     base_dn = settings.GRANADILLA_GROUPS_DN
     object_classes = ['posixGroup']
 
+    objects = LdapManager()
+
     # posixGroup
     gid = ldap_fields.IntegerField(_("identifier"), db_column='gidNumber', unique=True)
     name = ldap_fields.CharField(_("name"), db_column='cn', primary_key=True)
@@ -134,22 +565,97 @@ class LdapGroup(ldap_models.Model):
 
     def save(self, *args, **kwargs):
         res = super(LdapGroup, self).save(*args, **kwargs)
+        memberships.invalidate()
         try:
             device_group = LdapDeviceGroup.objects.get(group_dn=self.dn)
         except LdapDeviceGroup.DoesNotExist:
             pass
         else:
-            device_group.resync()
+            # We already hold the group, no need to fetch it again.
+            device_group.resync(group=self)
 
         return res
 
+    def delete(self, *args, **kwargs):
+        res = super(LdapGroup, self).delete(*args, **kwargs)
+        memberships.invalidate()
+        return res
+
+
+class MembershipIndex(object):
+    """Reverse index of group memberships, kept in Django's cache.
+
+    Built from a single search over all groups, and invalidated whenever
+    a group is saved or deleted.  When groups are served by the replica,
+    the index is built from it instead, and rebuilt when it changes.
+    """
+    cache_key = 'granadilla:memberships'
+
+    @property
+    def cache(self):
+        return caches[settings.GRANADILLA_CACHE_ALIAS]
+
+    def _build(self):
+        groups = {}
+        users = collections.defaultdict(list)
+        for dn, values in LdapGroup.objects.entries('name', 'usernames'):
+            groups[values['name']] = (dn, values['usernames'])
+            for username in values['usernames']:
+                users[username].append(values['name'])
+        return {'groups': groups, 'users': dict(users)}
+
+    def _build_from_replica(self, replica):
+        groups = {}
+        users = collections.defaultdict(list)
+        for entry in replica.all(LdapGroup):
+            group = entry.instance(['name', 'usernames'])
+            groups[group.name] = (group.dn, group.usernames)
+            for username in group.usernames:
+                users[username].append(group.name)
+        return {'groups': groups, 'users': dict(users)}
+
+    def _load(self):
+        from .replica import replica
+        if replica.serves(LdapGroup):
+            return replica.memoized(self.cache_key, self._build_from_replica)
+
+        index = self.cache.get(self.cache_key)
+        if index is None:
+            index = self._build()
+            self.cache.set(self.cache_key, index, settings.GRANADILLA_MEMBERSHIP_CACHE_TTL)
+        return index
+
+    def groups_of(self, username):
+        """Names of the groups a user belongs to."""
+        return sorted(self._load()['users'].get(username, []))
+
+    def group_dns_of(self, username):
+        """DNs of the groups a user belongs to."""
+        index = self._load()
+        return [index['groups'][name][0] for name in index['users'].get(username, [])]
+
+    def members_of(self, group_name):
+        """Usernames of the members of a group."""
+        try:
+            return list(self._load()['groups'][group_name][1])
+        except KeyError:
+            raise LdapGroup.DoesNotExist("Group %s not found" % group_name)
+
+    def invalidate(self):
+        self.cache.delete(self.cache_key)
+
+
+memberships = MembershipIndex()
 
-class LdapServiceAccount(ldap_models.Model):
+
+class LdapServiceAccount(CachedEntryMixin, ldap_models.Model):
     """Class for a Service account."""
     # LDAP meta-data
     base_dn = settings.GRANADILLA_SERVICES_DN
     object_classes = ['person', 'uidObject']
 
+    objects = LdapManager()
+
     username = ldap_fields.CharField(_("username"), db_column='uid', primary_key=True)
     first_name = ldap_fields.CharField(_("name (copy)"), db_column='sn', editable=False)
     last_name = ldap_fields.CharField(_("name (copy)"), db_column='cn', editable=False)
@@ -171,7 +677,7 @@ class LdapServiceAccount(ldap_models.Model):
         super(LdapServiceAccount, self).save(*args, **kwargs)
 
 
-class LdapUser(ldap_models.Model):
+class LdapUser(CachedEntryMixin, ldap_models.Model):
     """
     Class for representing an LDAP user entry.
 
@@ -189,6 +695,8 @@ class LdapUser(ldap_models.Model):
     if settings.GRANADILLA_USE_SAMBA:
         object_classes.append('sambaSamAccount')
 
+    objects = LdapManager()
+
     # inetOrgPerson
     first_name = ldap_fields.CharField(_("first name"), db_column='givenName')
     last_name = ldap_fields.CharField(_("last name"), db_column='sn')
@@ -221,6 +729,19 @@ class LdapUser(ldap_models.Model):
         samba_ntpassword = ldap_fields.CharField(db_column='sambaNTPassword')
         samba_pwdlastset = ldap_fields.IntegerField(db_column='sambaPwdLastSet')
 
+    # Set when the photo presence was checked without fetching it.
+    _has_photo = None
+
+    @property
+    def has_photo(self):
+        if self._has_photo is None:
+            return bool(self.photo)
+        return self._has_photo
+
+    @has_photo.setter
+    def has_photo(self, value):
+        self._has_photo = value
+
     def defaults(self, key):
         if key == "email":
             email = "-".join(normalise(self.first_name).split(" "))
@@ -257,16 +778,29 @@ class LdapUser(ldap_models.Model):
             self.samba_pwdlastset = int(time.time())
 
     def resync_devices(self):
-        for group in LdapGroup.objects.filter(usernames__contains=self.username):
-            try:
-                device_group = LdapDeviceGroup.objects.get(group_dn=group.dn)
-            except LdapDeviceGroup.DoesNotExist:
-                continue
-            device_group.resync()
-
-    def save(self, *args, **kwargs):
+        """Add this user's devices to the device groups of their groups.
+
+        Only this user's devices are considered: the device groups are
+        not recomputed from scratch.
+        """
+        group_dns = memberships.group_dns_of(self.username)
+        if not group_dns:
+            return
+        device_groups = list(LdapDeviceGroup.objects.filter(group_dn__in=group_dns))
+        if not device_groups:
+            return
+
+        device_dns = [dn for dn, _values in LdapDevice.objects.filter(owner_dn=self.dn).entries()]
+        for device_group in device_groups:
+            device_group.add_members(device_dns)
+
+    def fill_computed(self):
+        """Set the attributes derived from the others."""
         if settings.GRANADILLA_USE_SAMBA and not self.samba_sid:
             self.samba_sid = "%s-%i" % (settings.GRANADILLA_SAMBA_PREFIX, self.uid * 2 + 1000)
+
+    def save(self, *args, **kwargs):
+        self.fill_computed()
         super(LdapUser, self).save(*args, **kwargs)
 
     class Meta:
@@ -275,7 +809,7 @@ class LdapUser(ldap_models.Model):
         verbose_name_plural = _("users")
 
 
-class LdapOrganizationalUnit(ldap_models.Model):
+class LdapOrganizationalUnit(CachedEntryMixin, ldap_models.Model):
     """
     Class for representing an LDAP organization unit entry.
     """
@@ -283,11 +817,30 @@ class LdapOrganizationalUnit(ldap_models.Model):
     base_dn = settings.GRANADILLA_BASE_DN
     object_classes = ['organizationalUnit']
 
+    objects = LdapManager()
+
     # organizationalUnit
     name = ldap_fields.CharField(_("name"), db_column='ou', primary_key=True)
 
 
-class LdapExternalUser(ldap_models.Model):
+class LdapIdPool(CachedEntryMixin, ldap_models.Model):
+    """
+    Class for representing the counters of the next free uid and gid.
+
+    Requires the Samba schema, for the sambaUnixIdPool object class.
+    """
+    # LDAP meta-data
+    base_dn = settings.GRANADILLA_BASE_DN
+    object_classes = ['organizationalRole', 'sambaUnixIdPool']
+
+    objects = LdapManager()
+
+    name = ldap_fields.CharField(_("name"), db_column='cn', primary_key=True)
+    uid = ldap_fields.IntegerField(_("next user id"), db_column='uidNumber')
+    gid = ldap_fields.IntegerField(_("next group id"), db_column='gidNumber')
+
+
+class LdapExternalUser(CachedEntryMixin, ldap_models.Model):
     """
     An external user.
     """
@@ -295,6 +848,8 @@ class LdapExternalUser(ldap_models.Model):
     base_dn = settings.GRANADILLA_EXTERNAL_USERS_DN
     object_classes = ['inetOrgPerson']
 
+    objects = LdapManager()
+
     # inetOrgPerson
     first_name = ldap_fields.CharField(_("first name"), db_column='givenName')
     last_name = ldap_fields.CharField(_("last name"), db_column='sn')
@@ -314,7 +869,7 @@ class LdapExternalUser(ldap_models.Model):
         return super(LdapExternalUser, self).save(*args, **kwargs)
 
 
-class LdapDevice(ldap_models.Model):
+class LdapDevice(CachedEntryMixin, ldap_models.Model):
     """
     A device for the VPN.
     """
@@ -322,6 +877,8 @@ class LdapDevice(ldap_models.Model):
     base_dn = settings.GRANADILLA_DEVICES_DN
     object_classes = ['device', 'simpleSecurityObject']
 
+    objects = LdapManager()
+
     # device
     login = ldap_fields.CharField(_("device-specific login"), db_column='cn', primary_key=True)
     name = ldap_fields.CharField(_("name"), db_column='description')
@@ -346,12 +903,21 @@ class LdapDevice(ldap_models.Model):
 
     def save(self, *args, **kwargs):
         res = super(LdapDevice, self).save(*args, **kwargs)
-        owner = LdapUser.objects.get(dn=self.owner_dn)
-        owner.resync_devices()
+        if settings.GRANADILLA_ASYNC_PROVISIONING:
+            from .jobs import worker  # The worker module imports this one.
+            worker.enqueue_device_provisioning(self.owner_dn)
+        else:
+            owner = LdapUser.objects.only('username').get(dn=self.owner_dn)
+            owner.resync_devices()
         return res
 
+    def delete(self, *args, **kwargs):
+        for device_group in LdapDeviceGroup.objects.filter(members__contains=self.dn):
+            device_group.remove_members([self.dn])
+        return super(LdapDevice, self).delete(*args, **kwargs)
 
-class LdapDeviceGroup(ldap_models.Model):
+
+class LdapDeviceGroup(CachedEntryMixin, ldap_models.Model):
     """
     A group of devices.
     """
@@ -359,6 +925,8 @@ class LdapDeviceGroup(ldap_models.Model):
     base_dn = settings.GRANADILLA_DEVICEGROUPS_DN
     object_classes = ['groupOfNames']
 
+    objects = LdapManager()
+
     name = ldap_fields.CharField(_("name"), db_column='cn', primary_key=True)
     group_dn = ldap_fields.CharField(_("target group"), db_column='seeAlso', unique=True)
     members = ldap_fields.ListField(_("members"), db_column='member')
@@ -373,17 +941,19 @@ class LdapDeviceGroup(ldap_models.Model):
 
     @property
     def group(self):
-        for group in LdapGroup.objects.all():
-            if group.dn == self.group_dn:
-                return group
-        raise LdapGroup.DoesNotExist("Related group %s not found!!" % self.group_dn)
+        try:
+            return LdapGroup.objects.get_by_dn(self.group_dn)
+        except LdapGroup.DoesNotExist:
+            raise LdapGroup.DoesNotExist("Related group %s not found!!" % self.group_dn)
 
     @group.setter
-    def set_group(self, group):
+    def group(self, group):
         self.group_dn = group.dn
 
-    def _get_expected_members(self):
-        owners = self.group.get_members()
+    def _get_expected_members(self, group=None):
+        if group is None:
+            group = self.group
+        owners = group.get_members().only('username')
         owner_dns = [owner.dn for owner in owners]
         devices = LdapDevice.objects.filter(owner_dn__in=owner_dns)
         return [device.dn for device in devices]
@@ -393,9 +963,34 @@ class LdapDeviceGroup(ldap_models.Model):
         if save:
             self.save()
 
-    def resync(self):
-        members = self._get_expected_members()
+    def resync(self, group=None):
+        self.update_members(self._get_expected_members(group=group))
+
+    def add_members(self, dns):
+        """Add some devices to the group, without touching other members."""
+        added = sorted(set(dns) - set(self.members))
+        if added:
+            logger.info("Group %s: added devices %s", self.name, ', '.join(added))
+            modify_values(self, 'members', added=added)
+        return added
+
+    def remove_members(self, dns):
+        """Remove some devices from the group, without touching other members."""
+        removed = sorted(set(dns) & set(self.members))
+        if removed and len(removed) == len(self.members):
+            # groupOfNames requires at least one member.
+            logger.warning("Group %s: not removing its last devices %s", self.name, ', '.join(removed))
+            return []
+        if removed:
+            logger.info("Group %s: removed devices %s", self.name, ', '.join(removed))
+            modify_values(self, 'members', removed=removed)
+        return removed
+
+    def update_members(self, members):
+        """Replace the list of members, saving only if it changed.
 
+        Returns whether the device group was changed.
+        """
         old_members = set(self.members)
         new_members = set(members)
 
@@ -408,6 +1003,7 @@ class LdapDeviceGroup(ldap_models.Model):
         if added or removed:
             self.members = members
             self.save()
+        return bool(added or removed)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""A minimal PDF writer, for tables of text.
+
+Documents are written page by page, as rows arrive: only the current page
+is kept in memory, and the page tree and cross-reference table, which
+need the position of every object, are written at the end.
+
+Text uses the standard Helvetica font (no embedding), in the WinAnsi
+encoding; characters outside of it are replaced by '?'.
+"""
+
+import zlib
+
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842  # A4, in points
+MARGIN = 40
+FONT_SIZE = 9
+LINE_HEIGHT = 13
+TITLE_SIZE = 14
+
+# Average width of a Helvetica character, relative to the font size
+CHAR_WIDTH = 0.55
+
+# Objects written first; the page tree (2) is written last
+CATALOG, PAGES, FONT = 1, 2, 3
+
+
+def escape(text):
+    data = text.encode('cp1252', errors='replace')
+    return data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+
+def fit(text, width):
+    """Truncate a text to (approximately) fit in a width, in points."""
+    max_chars = int(width / (FONT_SIZE * CHAR_WIDTH))
+    if len(text) <= max_chars:
+        return text
+    return text[:max(max_chars - 1, 0)] + '…'
+
+
+class TableWriter(object):
+    """Render a table over as many pages as needed.
+
+    Args:
+        title (str): printed at the top of each page.
+        headers (str list): column titles.
+        widths (float list): relative widths of the columns.
+    """
+
+    def __init__(self, title, headers, widths):
+        self.title = title
+        self.headers = headers
+        usable = PAGE_WIDTH - 2 * MARGIN
+        self.widths = [usable * width / sum(widths) for width in widths]
+        self.rows_per_page = int((PAGE_HEIGHT - 2 * MARGIN - TITLE_SIZE - 2 * LINE_HEIGHT) / LINE_HEIGHT)
+        self._offsets = {}
+        self._position = 0
+        self._next_object = FONT + 2  # After the regular and bold fonts
+        self._pages = []
+
+    def _object(self, number, body):
+        self._offsets[number] = self._position
+        data = b'%d 0 obj\n' % number + body + b'\nendobj\n'
+        self._position += len(data)
+        return data
+
+    def _line(self, cells, y, bold=False):
+        parts = []
+        x = MARGIN
+        for cell, width in zip(cells, self.widths):
+            parts.append(b'BT /F%d %d Tf %.1f %.1f Td (%s) Tj ET' % (
+                2 if bold else 1, FONT_SIZE, x, y, escape(fit(cell, width - 4)),
+            ))
+            x += width
+        return b'\n'.join(parts)
+
+    def _page(self, rows):
+        y = PAGE_HEIGHT - MARGIN - TITLE_SIZE
+        commands = [b'BT /F2 %d Tf %d %d Td (%s) Tj ET' % (TITLE_SIZE, MARGIN, y, escape(self.title))]
+        y -= 2 * LINE_HEIGHT
+        commands.append(self._line(self.headers, y, bold=True))
+        for row in rows:
+            y -= LINE_HEIGHT
+            commands.append(self._line(row, y))
+        content = zlib.compress(b'\n'.join(commands))
+
+        contents, page = self._next_object, self._next_object + 1
+        self._next_object += 2
+        self._pages.append(page)
+        return self._object(
+            contents, b'<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream' % (len(content), content),
+        ) + self._object(page, (
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] '
+            b'/Resources << /Font << /F1 %d 0 R /F2 %d 0 R >> >> /Contents %d 0 R >>'
+        ) % (PAGES, PAGE_WIDTH, PAGE_HEIGHT, FONT, FONT + 1, contents))
+
+    def render(self, rows):
+        """Iterate over the document, as bytes chunks (one per page).
+
+        Args:
+            rows (iterable): tuples of strings, one per column.
+        """
+        header = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+        self._position = len(header)
+        yield header + self._object(CATALOG, b'<< /Type /Catalog /Pages %d 0 R >>' % PAGES) + b''.join(
+            self._object(number, b'<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>' % name)
+            for number, name in [(FONT, b'Helvetica'), (FONT + 1, b'Helvetica-Bold')]
+        )
+
+        page = []
+        for row in rows:
+            page.append(row)
+            if len(page) == self.rows_per_page:
+                yield self._page(page)
+                page = []
+        if page or not self._pages:
+            yield self._page(page)
+
+        kids = b' '.join(b'%d 0 R' % number for number in self._pages)
+        tree = self._object(PAGES, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self._pages)))
+        xref_position = self._position
+        size = self._next_object
+        xref = [b'xref\n0 %d\n0000000000 65535 f \n' % size]
+        xref.extend(b'%010d 00000 n \n' % self._offsets[number] for number in range(1, size))
+        yield tree + b''.join(xref) + b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+            size, CATALOG, xref_position,
+        )
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Versioned phonebooks of groups, for clients keeping an offline copy.
+
+A phonebook lists the members of a group with their names, phone numbers
+and the digest of their photo.  Its version is a digest of its content:
+the same members give the same version, in every process.
+
+The manifest of each version served ({username: digest of the member}) is
+kept in Django's cache for GRANADILLA_PHONEBOOK_HISTORY_TTL seconds.
+Clients sending the version they hold only get the members changed or
+removed since then; unknown or expired versions get the full phonebook.
+
+Phonebooks are serialised to JSON, or to MessagePack when the msgpack
+package is installed.
+"""
+
+import hashlib
+import json
+
+from django.core.cache import caches
+
+from .conf import settings
+from . import models
+from . import photos
+
+try:
+    import msgpack
+except ImportError:  # Optional dependency
+    msgpack = None
+
+
+# Fields of each member, on top of the photo digest
+FIELDS = ['username', 'first_name', 'last_name', 'full_name', 'phone', 'mobile_phone', 'internal_phone']
+
+# Format => content type
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'msgpack': 'application/msgpack',
+}
+
+
+def available_formats():
+    return [name for name in sorted(CONTENT_TYPES) if name != 'msgpack' or msgpack is not None]
+
+
+def photo_digests(modified):
+    """Digests of the photos of some users, as {username: digest}.
+
+    Photos are only fetched from LDAP when their digest isn't known.
+
+    Args:
+        modified (dict): the modification time of each user's entry.
+    """
+    digests = photos.store.known_digests(modified) if modified else {}
+    unknown = [username for username in modified if username not in digests]
+    for queryset in models.LdapUser.objects.chunked_in('username', unknown):
+        for user in queryset.projected('username', 'photo'):
+            if user.photo:
+                digests[user.username] = photos.store.remember(user.username, user.photo, modified[user.username])
+    return digests
+
+
+def fetch_members(group_name):
+    """The members of a group, as {username: dict of FIELDS and 'photo'}.
+
+    Raises:
+        LdapGroup.DoesNotExist: no such group.
+    """
+    usernames = models.memberships.members_of(group_name)
+    members = {}
+    modified = {}  # username => modifyTimestamp, for members with a photo
+    for queryset in models.LdapUser.objects.chunked_in('username', usernames):
+        with_photo = queryset.modify_timestamps(having='photo')
+        for user in queryset.projected(*FIELDS):
+            members[user.username] = {name: getattr(user, name) or '' for name in FIELDS}
+            if user.dn in with_photo:
+                modified[user.username] = with_photo[user.dn]
+
+    digests = photo_digests(modified)
+    for username, member in members.items():
+        member['photo'] = digests.get(username)
+    return members
+
+
+def digest(value):
+    """A short digest of a JSON-serialisable value."""
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+class Phonebook(object):
+    """The members of a group, at some version."""
+
+    def __init__(self, members):
+        self.members = members
+        self.manifest = {username: digest(member) for username, member in members.items()}
+        self.version = digest(sorted(self.manifest.items()))
+
+    @property
+    def cache(self):
+        return caches[settings.GRANADILLA_CACHE_ALIAS]
+
+    @staticmethod
+    def manifest_key(version):
+        return 'granadilla:phonebook:%s' % version
+
+    def remember(self):
+        """Keep the manifest of this version, for later deltas."""
+        self.cache.add(self.manifest_key(self.version), self.manifest, settings.GRANADILLA_PHONEBOOK_HISTORY_TTL)
+
+    def export(self, since=None):
+        """The full phonebook, or the changes since a version, as a dict.
+
+        Full phonebooks have a ``members`` list; deltas ``changed`` members
+        and ``removed`` usernames instead.
+        """
+        if since == self.version:
+            old = self.manifest
+        else:
+            old = self.cache.get(self.manifest_key(since)) if since else None
+        if old is None:
+            return {
+                'version': self.version,
+                'members': [self.members[username] for username in sorted(self.members)],
+            }
+        return {
+            'version': self.version,
+            'since': since,
+            'changed': [
+                self.members[username] for username in sorted(self.members)
+                if old.get(username) != self.manifest[username]
+            ],
+            'removed': sorted(set(old) - set(self.members)),
+        }
+
+
+def group_phonebook(group_name):
+    """The current phonebook of a group.
+
+    Raises:
+        LdapGroup.DoesNotExist: no such group.
+    """
+    phonebook = Phonebook(fetch_members(group_name))
+    phonebook.remember()
+    return phonebook
+
+
+def dumps(data, format='json'):
+    """Serialise an exported phonebook to bytes."""
+    if format == 'msgpack':
+        return msgpack.packb(data, use_bin_type=True)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
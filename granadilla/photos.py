@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Resized variants of user photos, cached on disk by content.
+
+Variants are stored under GRANADILLA_PHOTO_CACHE_DIR, keyed by the SHA-256
+digest of the original photo.  The last known digest of each user's photo
+is kept in Django's cache, so that conditional requests can be answered,
+and generated variants served, without fetching the photo from LDAP; pages
+can also link to versioned photo URLs.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import tempfile
+
+from django.core.cache import caches
+from PIL import Image
+
+from .conf import settings
+
+
+logger = logging.getLogger(__name__.split('.')[0])
+
+FULL_SIZE = 'full'
+
+
+def photo_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def photo_etag(digest, size):
+    return '"%s-%s"' % (digest, size)
+
+
+def resize(data, size):
+    """Shrink a JPEG photo to fit in a size x size square."""
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail((size, size))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+
+class PhotoStore(object):
+
+    @property
+    def root(self):
+        return settings.GRANADILLA_PHOTO_CACHE_DIR
+
+    @property
+    def sizes(self):
+        return settings.GRANADILLA_PHOTO_SIZES
+
+    @property
+    def cache(self):
+        return caches[settings.GRANADILLA_CACHE_ALIAS]
+
+    def is_valid_size(self, size):
+        return size == FULL_SIZE or size in self.sizes
+
+    def path(self, digest, size):
+        return os.path.join(self.root, digest[:2], '%s-%s.jpg' % (digest, size))
+
+    def read(self, digest, size):
+        """Read a variant from disk; returns None if it wasn't generated yet."""
+        try:
+            with open(self.path(digest, size), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, digest, size, data):
+        path = self.path(digest, size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so that readers never see a partial file.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, data, size, digest=None):
+        """Return the given variant of a photo, generating it if needed."""
+        if size == FULL_SIZE:
+            return data
+        digest = digest or photo_digest(data)
+        variant = self.read(digest, size)
+        if variant is None:
+            try:
+                variant = resize(data, self.sizes[size])
+            except (IOError, ValueError):
+                logger.warning("Unable to resize photo %s, serving it as is", digest)
+                return data
+            self._write(digest, size, variant)
+        return variant
+
+    def generate(self, data):
+        """Generate all variants of a photo; returns its digest."""
+        digest = photo_digest(data)
+        for size in self.sizes:
+            self.get(data, size, digest=digest)
+        return digest
+
+    # Per-user digests
+    #
+    # Each digest is recorded along with the modifyTimestamp of the user's
+    # entry at that time; it is only trusted while the entry is unchanged.
+
+    def _digest_key(self, username):
+        return 'granadilla:photo-digest:%s' % username
+
+    def remember(self, username, data, modified=None):
+        """Record the digest of a user's photo; returns it."""
+        digest = photo_digest(data)
+        self.cache.set(self._digest_key(username), (digest, modified), settings.GRANADILLA_PHOTO_CACHE_TTL)
+        return digest
+
+    def forget(self, username):
+        self.cache.delete(self._digest_key(username))
+
+    def known_digest(self, username, modified=None):
+        return self.known_digests({username: modified}).get(username)
+
+    def known_digests(self, modified_by_username):
+        """Known digests of the photos of some users, as {username: digest}.
+
+        Args:
+            modified_by_username (dict): the current modification time of
+                each user's entry.
+        """
+        keys = {self._digest_key(username): username for username in modified_by_username}
+        digests = {}
+        for key, (digest, modified) in self.cache.get_many(keys).items():
+            username = keys[key]
+            if modified == modified_by_username[username]:
+                digests[username] = digest
+        return digests
+
+
+store = PhotoStore()
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Pools of bound LDAP connections.
+
+Opening a connection costs a TCP (and TLS) handshake and a bind, often
+more than the operation itself.  Connections are thus kept bound in a pool
+when released, and handed out again to the next user with the same
+parameters: the granadilla.backends.ldap database backend, the replica and
+the CLI commands all go through it.
+
+Connections idle for more than GRANADILLA_LDAP_POOL_CHECK_INTERVAL seconds
+are checked (with a "Who am I?" request) before being reused; those older
+than GRANADILLA_LDAP_POOL_MAX_AGE seconds are closed instead of being
+returned to the pool, which keeps at most GRANADILLA_LDAP_POOL_SIZE idle
+connections.
+"""
+
+import contextlib
+import logging
+import threading
+import time
+
+import ldap
+from django.db import connections
+
+from .conf import settings
+
+
+logger = logging.getLogger(__name__.split('.')[0])
+
+
+class ConnectionPool(object):
+    """Idle connections opened by ``factory()``, most recently used first."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._idle = []  # (connection, created, released), oldest first
+        self._created = {}  # id(connection) => creation time, for connections in use
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(['created', 'reused', 'recycled', 'failed_checks'], 0)
+
+    def acquire(self):
+        """Get a bound connection, reusing an idle one if possible."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection, created, released = self._idle.pop()
+
+            idle_time = time.monotonic() - released
+            if idle_time > settings.GRANADILLA_LDAP_POOL_CHECK_INTERVAL and not self._check(connection):
+                continue
+            with self._lock:
+                self.counters['reused'] += 1
+                self._created[id(connection)] = created
+            return connection
+
+        connection = self.factory()
+        with self._lock:
+            self.counters['created'] += 1
+            self._created[id(connection)] = time.monotonic()
+        return connection
+
+    def release(self, connection, discard=False):
+        """Give back a connection; it is closed if too old or discarded."""
+        now = time.monotonic()
+        with self._lock:
+            created = self._created.pop(id(connection), now)
+            recycle = discard or now - created >= settings.GRANADILLA_LDAP_POOL_MAX_AGE
+            full = len(self._idle) >= settings.GRANADILLA_LDAP_POOL_SIZE
+            if recycle:
+                self.counters['recycled'] += 1
+            elif not full:
+                self._idle.append((connection, created, now))
+                return
+        _unbind(connection)
+
+    def _check(self, connection):
+        try:
+            connection.whoami_s()
+        except ldap.LDAPError as e:
+            logger.info("Dropping pooled LDAP connection: %s", e)
+            with self._lock:
+                self.counters['failed_checks'] += 1
+            _unbind(connection)
+            return False
+        return True
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _created, _released in idle:
+            _unbind(connection)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, idle=len(self._idle), in_use=len(self._created))
+
+
+def _unbind(connection):
+    try:
+        connection.unbind_s()
+    except ldap.LDAPError:
+        pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, factory):
+    """The pool of connections for the given (hashable) parameters."""
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(factory)
+        return _pools[key]
+
+
+def pool_key(conn_params):
+    """Pool key for ldapdb connection parameters."""
+    return (
+        conn_params['uri'],
+        conn_params['tls'],
+        conn_params['bind_dn'],
+        conn_params['bind_pw'],
+        repr(sorted(conn_params['options'].items(), key=repr)),
+    )
+
+
+@contextlib.contextmanager
+def borrow(using):
+    """Borrow a pooled connection of an LDAP database, outside of Django's connection handling."""
+    wrapper = connections[using]
+    pool = wrapper.get_pool()
+    connection = pool.acquire()
+    discard = False
+    try:
+        yield connection
+    except ldap.SERVER_DOWN:
+        discard = True
+        raise
+    finally:
+        pool.release(connection, discard=discard)
+
+
+def stats():
+    """Statistics of all pools of this process, by server URI and bind DN."""
+    with _pools_lock:
+        pools = list(_pools.items())
+    return {'%s %s' % (key[0], key[2]): pool.stats() for key, pool in pools}
+
+
+def clear():
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.clear()
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Bulk operations on user accounts and group memberships.
+
+For account creation, rows are validated first; defaults are then resolved
+once for the batch, ids are allocated as a block, and entries are written
+with pipelined requests over a single connection.
+
+Membership changes are grouped by target group: each group and ACL gets a
+single modify adding or removing values, and the devices of the moved users
+are then added to, or removed from, the device groups of those groups.
+
+Deleting a user costs a fixed number of searches, whatever the size of the
+directory: its groups, ACLs and devices are found through indexed filters.
+"""
+
+import collections
+import csv
+import functools
+import io
+import json
+import operator
+
+from django.db import connections, router
+from django.db.models import Q
+
+from .conf import settings
+from . import ids
+from . import models
+
+
+# Columns accepted in input rows
+FIELDS = [
+    'username', 'first_name', 'last_name', 'email', 'full_name', 'gecos',
+    'home_directory', 'login_shell', 'phone', 'mobile_phone', 'internal_phone', 'password',
+]
+REQUIRED_FIELDS = ['username', 'first_name', 'last_name']
+
+# Fields computed by LdapUser.defaults() when missing
+DEFAULTED_FIELDS = ['full_name', 'gecos', 'email', 'home_directory', 'login_shell']
+
+# password: the generated password of created users who had none, or None
+RowResult = collections.namedtuple('RowResult', ['row', 'username', 'created', 'message', 'password'])
+
+# Entries changed when deleting a user
+DeletionResult = collections.namedtuple('DeletionResult', ['groups', 'acls', 'devices', 'device_groups'])
+
+# changed: {group name: usernames added or removed}
+MembershipResult = collections.namedtuple('MembershipResult', ['changed', 'unknown_users', 'unknown_groups'])
+
+
+def parse_rows(text):
+    """Parse users from a JSON list of objects, or from CSV with a header line."""
+    if text.lstrip().startswith('['):
+        rows = json.loads(text)
+        if not all(isinstance(row, dict) for row in rows):
+            raise ValueError("Expected a JSON list of objects")
+        return rows
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def ldap_error_message(error):
+    if error.args and isinstance(error.args[0], dict):
+        return error.args[0].get('desc', str(error))
+    return str(error)
+
+
+def _check_row(row):
+    """Validate a row; returns an error message, or None."""
+    unknown = sorted(key for key in row if key not in FIELDS)
+    if unknown:
+        return "Unknown fields: %s" % ', '.join(str(key) for key in unknown)
+    # JSON rows may hold numbers, lists or objects: reject them before anything is written.
+    invalid = sorted(key for key, value in row.items() if not isinstance(value, str))
+    if invalid:
+        return "Expected text values for: %s" % ', '.join(invalid)
+    missing = [key for key in REQUIRED_FIELDS if not row.get(key)]
+    if missing:
+        return "Missing fields: %s" % ', '.join(missing)
+    return None
+
+
+def _existing_usernames(usernames):
+    existing = set()
+    for queryset in models.LdapUser.objects.chunked_in('username', usernames):
+        existing.update(queryset.values_list('username', flat=True))
+    return existing
+
+
+def bulk_create_users(rows):
+    """Create user accounts from dicts of FIELDS.
+
+    Without a password, accounts get a random one, returned in their RowResult.
+
+    Returns a RowResult per row, in order; rows are numbered from 1.
+    """
+    results = {}
+    seen = set()
+    valid = []
+    for number, row in enumerate(rows, start=1):
+        # Empty values (and JSON nulls) are missing values.
+        row = {
+            key: value.strip() if isinstance(value, str) else value
+            for key, value in row.items() if value is not None and value != ''
+        }
+        error = _check_row(row)
+        if error is None and row['username'] in seen:
+            error = "Duplicate username"
+        if error is None:
+            seen.add(row['username'])
+            valid.append((number, row))
+        else:
+            results[number] = RowResult(number, row.get('username', ''), False, error, None)
+
+    existing = _existing_usernames([row['username'] for _number, row in valid])
+    users = []
+    group_gid = None
+    for number, row in valid:
+        if row['username'] in existing:
+            results[number] = RowResult(number, row['username'], False, "User already exists", None)
+            continue
+
+        password = row.pop('password', None)
+        generated = None
+        user = models.LdapUser(**row)
+        if password:
+            check = models.check_password_strength(password, blacklist=[user.username, user.first_name, user.last_name])
+            if not check.good:
+                results[number] = RowResult(number, user.username, False, str(check.message), None)
+                continue
+        else:
+            password = generated = models.random_password()
+        user.set_password(password)
+
+        for key in DEFAULTED_FIELDS:
+            if not row.get(key):
+                setattr(user, key, user.defaults(key))
+        # Resolved once for the whole batch
+        if group_gid is None:
+            group_gid = user.defaults('group')
+        user.group = group_gid
+        users.append((number, user, generated))
+
+    if not users:
+        return [results[number] for number in sorted(results)]
+
+    for (_number, user, _generated), uid in zip(users, ids.allocate_block('uid', len(users))):
+        user.uid = uid
+        user.fill_computed()
+
+    errors = models.add_entries([user for _number, user, _generated in users])
+    for (number, user, generated), error in zip(users, errors):
+        if error is None:
+            results[number] = RowResult(number, user.username, True, user.dn, generated)
+        else:
+            results[number] = RowResult(number, user.username, False, ldap_error_message(error), None)
+
+    return [results[number] for number in sorted(results)]
+
+
+def parse_pairs(text):
+    """Parse (username, group name) pairs, one per line, separated by a comma.
+
+    Blank lines and lines starting with # are ignored.
+    """
+    pairs = []
+    for row in csv.reader(io.StringIO(text)):
+        if not row or not row[0].strip() or row[0].lstrip().startswith('#'):
+            continue
+        if len(row) != 2:
+            raise ValueError("Expected 'username,group', got %r" % ','.join(row))
+        pairs.append((row[0].strip(), row[1].strip()))
+    return pairs
+
+
+def _fetch_by(model, field_name, values, *fields):
+    """Fetch entries by the values of a field, as {value: instance}."""
+    instances = {}
+    for queryset in model.objects.chunked_in(field_name, sorted(values)):
+        for instance in queryset.projected(field_name, *fields):
+            instances[getattr(instance, field_name)] = instance
+    return instances
+
+
+def _change_memberships(pairs, add):
+    targets = collections.defaultdict(set)
+    for username, group_name in pairs:
+        targets[group_name].add(username)
+
+    groups = _fetch_by(models.LdapGroup, 'name', targets, 'usernames')
+    users = _fetch_by(models.LdapUser, 'username', set().union(*targets.values()))
+    unknown_groups = sorted(set(targets) - set(groups))
+    unknown_users = sorted(set().union(*targets.values()) - set(users))
+
+    changed = {}
+    for name, group in sorted(groups.items()):
+        current = set(group.usernames)
+        if add:
+            delta = sorted((targets[name] & set(users)) - current)
+            models.modify_values(group, 'usernames', added=delta)
+        else:
+            # Usernames of deleted users may linger in groups; remove them too.
+            delta = sorted(targets[name] & current)
+            models.modify_values(group, 'usernames', removed=delta)
+        if delta:
+            changed[name] = delta
+
+    if settings.GRANADILLA_USE_ACLS:
+        acls = _fetch_by(models.LdapAcl, 'name', groups, 'members')
+        for name in groups:
+            dns = {users[username].dn for username in targets[name] if username in users}
+            acl = acls.get(name)
+            if acl is None:
+                if add and dns:
+                    models.LdapAcl(name=name, members=sorted(dns)).save()
+                continue
+            current = set(acl.members)
+            if add:
+                models.modify_values(acl, 'members', added=sorted(dns - current))
+            elif current <= dns:
+                # groupOfNames entries can't be empty; LdapAcl.save() deletes them too.
+                acl.delete()
+            else:
+                models.modify_values(acl, 'members', removed=sorted(dns & current))
+
+    if changed:
+        models.memberships.invalidate()
+        moved = {
+            groups[name].dn: [users[username] for username in changed[name] if username in users]
+            for name in changed
+        }
+        _move_devices(moved, add)
+
+    return MembershipResult(changed, unknown_users, unknown_groups)
+
+
+def _move_devices(moved, add):
+    """Add or remove the devices of moved users in the device groups of their groups.
+
+    Args:
+        moved (dict): the users added to or removed from each group, by group DN.
+    """
+    moved = {models.normalise_dn(dn): owners for dn, owners in moved.items() if owners}
+    device_groups = [
+        device_group
+        for queryset in models.LdapDeviceGroup.objects.chunked_in('group_dn', sorted(moved))
+        for device_group in queryset.projected('group_dn', 'members')
+    ]
+    if not device_groups:
+        return
+
+    owner_dns = {models.normalise_dn(owner.dn) for owners in moved.values() for owner in owners}
+    devices = collections.defaultdict(list)  # normalised owner DN => device DNs
+    for queryset in models.LdapDevice.objects.chunked_in('owner_dn', sorted(owner_dns)):
+        for dn, values in queryset.entries('owner_dn'):
+            devices[models.normalise_dn(values['owner_dn'])].append(dn)
+
+    for device_group in device_groups:
+        owners = moved.get(models.normalise_dn(device_group.group_dn), [])
+        device_dns = [dn for owner in owners for dn in devices[models.normalise_dn(owner.dn)]]
+        if add:
+            device_group.add_members(device_dns)
+        else:
+            device_group.remove_members(device_dns)
+
+
+def add_memberships(pairs):
+    """Add users to groups, from (username, group name) pairs."""
+    return _change_memberships(pairs, add=True)
+
+
+def remove_memberships(pairs):
+    """Remove users from groups, from (username, group name) pairs."""
+    return _change_memberships(pairs, add=False)
+
+
+def _device_groups_with(device_dns):
+    """Device groups having any of the given devices as members."""
+    size = settings.GRANADILLA_SEARCH_CHUNK_SIZE
+    for start in range(0, len(device_dns), size):
+        lookup = functools.reduce(operator.or_, [Q(members__contains=dn) for dn in device_dns[start:start + size]])
+        yield from models.LdapDeviceGroup.objects.filter(lookup)
+
+
+def delete_user(user):
+    """Delete a user, with its group and ACL memberships, and its devices.
+
+    Returns a DeletionResult listing the names of the changed entries.
+    """
+    # (memberUid=<username>)
+    groups = list(models.LdapGroup.objects.filter(usernames__contains=user.username).projected('name', 'usernames'))
+    for group in groups:
+        models.modify_values(group, 'usernames', removed=[user.username])
+
+    acls = []
+    if settings.GRANADILLA_USE_ACLS:
+        # (member=<dn>); ACLs may list the user even for groups they are not a member of.
+        acls = list(models.LdapAcl.objects.filter(members__contains=user.dn).projected('name', 'members'))
+        for acl in acls:
+            if acl.members == [user.dn]:
+                # groupOfNames entries can't be empty; LdapAcl.save() deletes them too.
+                acl.delete()
+            else:
+                models.modify_values(acl, 'members', removed=[user.dn])
+
+    device_dns = [dn for dn, _values in models.LdapDevice.objects.filter(owner_dn=user.dn).entries()]
+    device_groups = []
+    for device_group in _device_groups_with(device_dns):
+        if device_group.remove_members(device_dns):
+            device_groups.append(device_group)
+    connection = connections[router.db_for_write(models.LdapDevice)]
+    for dn in device_dns:
+        # Not LdapDevice.delete(): device groups are already cleaned up.
+        connection.delete_s(dn)
+        models.entry_cache.invalidate(models.LdapDevice, dn=dn)
+
+    user.delete()
+    if groups:
+        models.memberships.invalidate()
+
+    return DeletionResult(
+        groups=[group.name for group in groups],
+        acls=[acl.name for acl in acls],
+        devices=device_dns,
+        device_groups=[device_group.name for device_group in device_groups],
+    )
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""In-memory replica of users, groups, devices and device groups.
+
+When GRANADILLA_REPLICA_ENABLED is set, a background thread of the web
+process (started along with the WSGI application, see ensure_started())
+keeps a copy of those entries, through an RFC 4533 content synchronisation search
+(refreshAndPersist): the server pushes changes as they happen.  Servers
+without the syncprov overlay reject the sync control; the replica then falls
+back to polling every GRANADILLA_REPLICA_POLL_INTERVAL seconds: entries
+modified since the previous poll are fetched, and deleted entries found by
+listing the entryUUIDs of all entries.
+
+Read paths (the entry cache, the membership index, group pages) are served
+from the replica once it is loaded, without any LDAP request.  Processes
+which don't start it, such as granadilla-admin, read from LDAP.
+
+Entries written by this process are marked as dirty until the replica
+receives their new version; reads of a model with dirty entries go to LDAP,
+so that users always see their own changes.
+
+Photos are not kept: only their digest is (ReplicaEntry.photo_digest), and
+the photo field of replicated instances is deferred.
+"""
+
+import collections
+import datetime
+import logging
+import threading
+import time
+
+import ldap
+import ldap.dn
+import ldap.ldapobject
+import ldap.syncrepl
+from django.db import connections, router
+from ldapdb.models import fields as ldap_fields
+
+from .conf import settings
+from . import models
+from . import photos
+from . import pool
+
+
+logger = logging.getLogger(__name__.split('.')[0])
+
+# Replicated models, in classification order
+REPLICATED_MODELS = [models.LdapUser, models.LdapGroup, models.LdapDevice, models.LdapDeviceGroup]
+
+# Operational attributes needed on top of the user attributes
+OPERATIONAL_ATTRIBUTES = ['entryUUID', 'entryCSN', 'modifyTimestamp']
+
+# Margin for clock differences with the LDAP server when polling, in seconds
+CLOCK_SKEW = 300
+
+# Replaced by their digest as entries arrive (lowercased)
+PHOTO_ATTRIBUTE = 'jpegphoto'
+
+
+def entry_model(dn, attrs):
+    """The replicated model an entry belongs to, or None."""
+    # Parsed, as RDNs may contain escaped commas
+    parent = ldap.dn.dn2str(ldap.dn.str2dn(dn)[1:]).lower()
+    object_classes = {value.decode('utf-8').lower() for value in attrs.get('objectclass', [])}
+    for model in REPLICATED_MODELS:
+        if parent != models.normalise_dn(model.base_dn):
+            continue
+        if all(object_class.lower() in object_classes for object_class in model.object_classes):
+            return model
+    return None
+
+
+def entry_version(attrs):
+    """The change sequence number of an entry, or its modification time."""
+    return (attrs.get('entrycsn') or attrs.get('modifytimestamp') or [None])[0]
+
+
+class ReplicaEntry(object):
+    """A replicated entry: its DN, model and attributes (lowercased names).
+
+    The photo, if any, is dropped from the attributes: only its digest is kept.
+    """
+
+    def __init__(self, dn, model, attrs):
+        self.dn = dn
+        self.model = model
+        self.version = entry_version(attrs)
+        photo = attrs.pop(PHOTO_ATTRIBUTE, None)
+        self.photo_digest = photos.photo_digest(photo[0]) if photo else None
+        self.attrs = attrs
+
+    @staticmethod
+    def is_photo(field):
+        return (field.db_column or '').lower() == PHOTO_ATTRIBUTE
+
+    def values(self, field):
+        return self.attrs.get(field.db_column.lower(), [])
+
+    @property
+    def pk(self):
+        field = self.model._meta.pk
+        return field.from_ldap(self.values(field), connection=Replica.connection())
+
+    @property
+    def modified(self):
+        timestamp = self.attrs.get('modifytimestamp', [b''])[0].decode('utf-8')
+        return ldap_fields.datetime_from_ldap(timestamp)
+
+    def has(self, field_name):
+        field = self.model._meta.get_field(field_name)
+        if self.is_photo(field):
+            return self.photo_digest is not None
+        return bool(self.values(field))
+
+    def instance(self, field_names=None):
+        """Build a model instance; other fields, and the photo, are deferred."""
+        connection = Replica.connection()
+        fields = [
+            field for field in self.model._meta.concrete_fields
+            if (field_names is None or field.name in field_names or field.primary_key) and not self.is_photo(field)
+        ]
+        values = [
+            self.dn if field.attname == 'dn' else field.from_ldap(self.values(field), connection=connection)
+            for field in fields
+        ]
+        return self.model.from_db(Replica.using(), [field.attname for field in fields], values)
+
+
+class Replica(object):
+    """The replicated entries, indexed by entryUUID, DN and primary key."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = {}  # uuid => ReplicaEntry
+        self._by_dn = {}  # normalised dn => uuid
+        self._by_pk = {model: {} for model in REPLICATED_MODELS}  # model => {pk: uuid}
+        self._present = set()
+        self._dirty = {}  # normalised dn => (model, time)
+        self._memo = {}  # Values derived from the entries, see memoized()
+        self._sequence = 0  # Number of changes applied, see changes()
+        self._changes = collections.OrderedDict()  # uuid => (sequence, models) of its last change, oldest first
+        self._polled_at = None  # time.time() at the start of the last poll, see refresh()
+        self.ready = threading.Event()
+        self._consumer = None
+
+    @staticmethod
+    def using():
+        return router.db_for_read(models.LdapUser)
+
+    @classmethod
+    def connection(cls):
+        return connections[cls.using()]
+
+    @property
+    def enabled(self):
+        return settings.GRANADILLA_REPLICA_ENABLED
+
+    # Updates
+
+    def apply_entry(self, uuid, dn, attrs):
+        attrs = {name.lower(): values for name, values in attrs.items()}
+        model = entry_model(dn, attrs)
+        with self._lock:
+            self._present.add(uuid)
+            current = self._entries.get(uuid)
+            if current is None and model is None:
+                return
+            if current is not None and current.dn == dn and current.version is not None:
+                if current.version == entry_version(attrs):
+                    return  # Unchanged
+            self._remove(uuid)
+            self._memo.clear()
+            self._record_change(uuid, current.model if current is not None else None, model)
+            if model is None:
+                return
+            entry = ReplicaEntry(dn, model, attrs)
+            self._entries[uuid] = entry
+            self._by_dn[models.normalise_dn(dn)] = uuid
+            self._by_pk[model][entry.pk] = uuid
+            self._dirty.pop(models.normalise_dn(dn), None)
+
+    def apply_delete(self, uuids):
+        with self._lock:
+            for uuid in uuids:
+                entry = self._entries.get(uuid)
+                if entry is not None:
+                    self._remove(uuid)
+                    self._memo.clear()
+                    self._record_change(uuid, entry.model)
+                    self._dirty.pop(models.normalise_dn(entry.dn), None)
+
+    def _remove(self, uuid):
+        entry = self._entries.pop(uuid, None)
+        if entry is not None:
+            self._by_dn.pop(models.normalise_dn(entry.dn), None)
+            self._by_pk[entry.model].pop(entry.pk, None)
+
+    def _record_change(self, uuid, *changed_models):
+        """Record a change of an entry, which belonged or now belongs to the given models."""
+        self._sequence += 1
+        self._changes.pop(uuid, None)
+        self._changes[uuid] = (self._sequence, frozenset(changed_models))
+
+    def start_refresh(self):
+        """Start a full refresh: entries not seen again will be removed."""
+        with self._lock:
+            self._present = set()
+            return time.time()
+
+    def end_refresh(self, started):
+        with self._lock:
+            self.apply_delete([uuid for uuid in self._entries if uuid not in self._present])
+            self._dirty = {dn: mark for dn, mark in self._dirty.items() if mark[1] >= started}
+        self.ready.set()
+
+    def mark_dirty(self, model, dn):
+        """Record a local write, not received by the replica yet."""
+        if self.enabled and model in self._by_pk and dn:
+            with self._lock:
+                self._dirty[models.normalise_dn(dn)] = (model, time.time())
+
+    # Reads
+
+    def serves(self, model):
+        """Whether reads of a model can be served by the replica."""
+        if not self.enabled or model not in self._by_pk:
+            return False
+        if not self.ready.is_set():
+            return False
+        with self._lock:
+            return not any(dirty_model is model for dirty_model, _time in self._dirty.values())
+
+    def get(self, model, pk=None, dn=None):
+        """Get an entry of a served model; returns None if not found."""
+        with self._lock:
+            if dn is not None:
+                uuid = self._by_dn.get(models.normalise_dn(dn))
+            else:
+                uuid = self._by_pk[model].get(pk)
+            entry = self._entries.get(uuid)
+        if entry is None or entry.model is not model:
+            return None
+        return entry
+
+    def all(self, model):
+        with self._lock:
+            return [self._entries[uuid] for uuid in self._by_pk[model].values()]
+
+    def memoized(self, key, build):
+        """Compute a value from the entries, until they change."""
+        with self._lock:
+            if key not in self._memo:
+                self._memo[key] = build(self)
+            return self._memo[key]
+
+    def changes(self, model, since):
+        """Entries of a model changed after a sequence number, to follow the replica incrementally.
+
+        Returns the current sequence number, and a list of (uuid, entry)
+        pairs, entry being None for removed entries.  Since 0, all entries
+        are listed.
+        """
+        changed = []
+        with self._lock:
+            for uuid in reversed(self._changes):
+                sequence, changed_models = self._changes[uuid]
+                if sequence <= since:
+                    break
+                if model in changed_models:
+                    entry = self._entries.get(uuid)
+                    changed.append((uuid, entry if entry is not None and entry.model is model else None))
+            return self._sequence, changed
+
+    def filter_pks(self, model, pks):
+        with self._lock:
+            uuids = [self._by_pk[model].get(pk) for pk in pks]
+            return [self._entries[uuid] for uuid in uuids if uuid is not None]
+
+    # Loading
+
+    def refresh(self):
+        """Poll the directory with plain searches (no sync control).
+
+        The first poll loads all entries; later ones only fetch the entries
+        modified since the previous one, and the entryUUIDs of all entries
+        to find the deleted ones.
+        """
+        with pool.borrow(self.using()) as conn:
+            started = self.start_refresh()
+            filterstr = '(objectClass=*)'
+            if self._polled_at is not None:
+                since = datetime.datetime.fromtimestamp(self._polled_at - CLOCK_SKEW, datetime.timezone.utc)
+                filterstr = '(modifyTimestamp>=%s)' % since.strftime('%Y%m%d%H%M%SZ')
+            for base in self.bases():
+                for dn, attrs in self._search(conn, base, filterstr, ['*'] + OPERATIONAL_ATTRIBUTES):
+                    self.apply_entry(attrs.get('entryUUID', [b''])[0].decode('ascii'), dn, attrs)
+                if self._polled_at is not None:
+                    uuids = {
+                        attrs.get('entryUUID', [b''])[0].decode('ascii')
+                        for _dn, attrs in self._search(conn, base, '(objectClass=*)', ['entryUUID'])
+                    }
+                    with self._lock:
+                        self._present.update(uuids)
+            self.end_refresh(started)
+            self._polled_at = started
+
+    @staticmethod
+    def _search(conn, base, filterstr, attrlist):
+        msgid = conn.search_ext(base, ldap.SCOPE_ONELEVEL, filterstr, attrlist=attrlist)
+        for _type, data, _msgid, _controls in conn.allresults(msgid):
+            for dn, attrs in data:
+                yield dn, attrs
+
+    def bases(self):
+        return sorted({model.base_dn for model in REPLICATED_MODELS})
+
+    def ldap_connect(self, factory):
+        """Open a dedicated connection, for long-running searches."""
+        db = settings.DATABASES[self.using()]
+        conn = factory(db['NAME'], bytes_mode=False)
+        conn.simple_bind_s(db['USER'], db['PASSWORD'])
+        return conn
+
+    def ensure_started(self):
+        """Start following the directory, if the replica is enabled."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._consumer is None:
+                self._consumer = ReplicaThread(self)
+                self._consumer.start()
+
+    def stop(self):
+        with self._lock:
+            consumer, self._consumer = self._consumer, None
+        if consumer is not None:
+            consumer.stop()
+            consumer.join()
+
+    def clear(self):
+        with self._lock:
+            for uuid, entry in self._entries.items():
+                self._record_change(uuid, entry.model)
+            self._entries.clear()
+            self._by_dn.clear()
+            for index in self._by_pk.values():
+                index.clear()
+            self._dirty.clear()
+            self._memo.clear()
+            self._polled_at = None
+            self.ready.clear()
+
+
+class SyncreplConnection(ldap.ldapobject.ReconnectLDAPObject, ldap.syncrepl.SyncreplConsumer):
+    """Feeds a Replica from RFC 4533 sync messages."""
+
+    def __init__(self, *args, **kwargs):
+        self.replica = kwargs.pop('replica')
+        self.cookie = None
+        self.refresh_started = None
+        super(SyncreplConnection, self).__init__(*args, **kwargs)
+
+    def syncrepl_get_cookie(self):
+        return self.cookie
+
+    def syncrepl_set_cookie(self, cookie):
+        self.cookie = cookie
+
+    def syncrepl_entry(self, dn, attributes, uuid):
+        self.replica.apply_entry(uuid, dn, attributes)
+
+    def syncrepl_delete(self, uuids):
+        self.replica.apply_delete(uuids)
+
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+        if uuids is None:
+            # End of the present phase: entries not listed are gone.
+            if not refreshDeletes:
+                self.replica.end_refresh(self.refresh_started)
+        elif refreshDeletes:
+            self.replica.apply_delete(uuids)
+        else:
+            with self.replica._lock:
+                self.replica._present.update(uuids)
+
+    def syncrepl_refreshdone(self):
+        self.replica.end_refresh(self.refresh_started)
+
+
+class ReplicaThread(threading.Thread):
+    """Keeps a replica up to date, with syncrepl or by polling."""
+
+    # Errors meaning the server doesn't support content synchronisation
+    UNSUPPORTED = (ldap.UNAVAILABLE_CRITICAL_EXTENSION, ldap.PROTOCOL_ERROR, ldap.UNWILLING_TO_PERFORM)
+
+    def __init__(self, replica):
+        super(ReplicaThread, self).__init__(name='granadilla-replica', daemon=True)
+        self.replica = replica
+        self._stop_event = threading.Event()
+        self.polling = False
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                if self.polling:
+                    self.replica.refresh()
+                    self._stop_event.wait(settings.GRANADILLA_REPLICA_POLL_INTERVAL)
+                else:
+                    self.persist()
+            except self.UNSUPPORTED as e:
+                logger.warning("Content synchronisation unsupported (%s), polling the directory instead", e)
+                self.polling = True
+            except ldap.LDAPError:
+                logger.exception("Replica update failed, retrying")
+                self._stop_event.wait(settings.GRANADILLA_REPLICA_POLL_INTERVAL)
+
+    def persist(self):
+        """Follow all replicated entries with refreshAndPersist searches."""
+        conn = self.replica.ldap_connect(
+            factory=lambda uri, **kwargs: SyncreplConnection(uri, replica=self.replica, **kwargs),
+        )
+        try:
+            conn.refresh_started = self.replica.start_refresh()
+            # A single search over the common suffix, filtered client-side by entry_model().
+            base = models.normalise_dn(settings.GRANADILLA_BASE_DN)
+            msgid = conn.syncrepl_search(
+                base,
+                ldap.SCOPE_SUBTREE,
+                mode='refreshAndPersist',
+                attrlist=['*'] + OPERATIONAL_ATTRIBUTES,
+            )
+            # Wake up regularly to notice stop requests.
+            while not self._stop_event.is_set():
+                try:
+                    if not conn.syncrepl_poll(msgid=msgid, all=1, timeout=1):
+                        break
+                except ldap.TIMEOUT:
+                    continue
+        finally:
+            conn.unbind_s()
+
+
+replica = Replica()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.conf import settings
+from ldapdb import router as ldapdb_router
+
+
+# Engines of LDAP databases
+LDAP_ENGINES = ['ldapdb.backends.ldap', 'granadilla.backends.ldap']
+
+
+class Router(ldapdb_router.Router):
+    """ldapdb's router, also accepting the pooled backend (granadilla.backends.ldap)."""
+
+    def __init__(self):
+        self.ldap_alias = None
+        for alias, settings_dict in settings.DATABASES.items():
+            if settings_dict['ENGINE'] in LDAP_ENGINES:
+                self.ldap_alias = alias
+                break
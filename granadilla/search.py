@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""People search, over an in-process inverted index of users.
+
+Names, e-mail addresses and phone numbers are split into tokens, without
+accents or case.  A query matches the users having, for each of its terms,
+a token equal to the term, starting with it, or (for terms of at least
+FUZZY_MIN_LENGTH characters without other matches) one edit away from it.
+Prefixes are found by bisection in the sorted tokens, and typos through an
+index of the tokens' one-character deletions: queries never scan the
+directory.
+
+The index is loaded with a single search, then refreshed incrementally:
+users saved or deleted by this process are updated before the next query,
+and every GRANADILLA_SEARCH_REFRESH_INTERVAL seconds, entries modified in
+the meantime are fetched and deleted entries dropped.  When users are
+served by the replica, the index is loaded from it instead, then updated
+with the changes it received (see Replica.changes()).
+
+The index also holds the typeahead completions of names and phone numbers
+(see the autocomplete module), updated along with it.
+"""
+
+import bisect
+import collections
+import datetime
+import re
+import threading
+import time
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .conf import settings
+from . import autocomplete
+from . import models
+from .replica import replica
+
+
+# Indexed fields
+FIELDS = ['username', 'first_name', 'last_name', 'full_name', 'email', 'phone', 'mobile_phone', 'internal_phone']
+PHONE_FIELDS = ['phone', 'mobile_phone', 'internal_phone']
+
+# Terms shorter than this only match exactly or as a prefix
+FUZZY_MIN_LENGTH = 4
+
+# Margin for clock differences with the LDAP server, in seconds
+CLOCK_SKEW = 300
+
+# Match scores
+EXACT, PREFIX, FUZZY = 3, 2, 1
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    """Split a text into lowercase tokens, without accents."""
+    return TOKEN_RE.findall(models.normalise(text or '').lower())
+
+
+def record_tokens(record):
+    tokens = set()
+    for name in FIELDS:
+        tokens.update(tokenize(record[name]))
+    for name in PHONE_FIELDS:
+        digits = ''.join(c for c in record[name] or '' if c.isdigit())
+        if digits:
+            tokens.add(digits)
+    return tokens
+
+
+def deletions(token):
+    """Variants of a token with one character removed."""
+    return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+
+def within_one_edit(a, b):
+    """Whether a and b differ by at most one insertion, deletion, substitution or transposition."""
+    if abs(len(a) - len(b)) > 1:
+        return False
+    start = 0
+    while start < min(len(a), len(b)) and a[start] == b[start]:
+        start += 1
+    a, b = a[start:], b[start:]
+    return (
+        a[1:] == b[1:]  # substitution
+        or a[1:] == b or a == b[1:]  # deletion, insertion
+        or (a[:2] == b[1::-1] and a[2:] == b[2:])  # transposition
+    )
+
+
+class Index(object):
+    """An inverted index of user records (dicts of 'dn' and FIELDS)."""
+
+    def __init__(self, records=()):
+        self.records = {}  # username => record
+        self._tokens_of = {}  # username => tokens
+        self._postings = collections.defaultdict(set)  # token => usernames
+        self._variants = collections.defaultdict(set)  # token or one of its deletions => tokens
+        self._completions = None
+        # Loading: tokens are sorted once, rather than inserted one by one.
+        for record in records:
+            self._store(record)
+        self._sorted_tokens = sorted(self._postings)
+        for token in self._sorted_tokens:
+            self._add_variants(token)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def completions(self):
+        """Completions of the indexed records, built on first use."""
+        if self._completions is None:
+            self._completions = autocomplete.Completions(self.records.values())
+        return self._completions
+
+    def _store(self, record):
+        """Index a record, except for the sorted tokens and variants; returns the record and its new tokens."""
+        username = record['username']
+        record = dict(record, sort_key=models.normalise(record['full_name'] or username).lower())
+        tokens = record_tokens(record)
+        new_tokens = [token for token in tokens if token not in self._postings]
+        self.records[username] = record
+        self._tokens_of[username] = tokens
+        for token in tokens:
+            self._postings[token].add(username)
+        return record, new_tokens
+
+    def _add_variants(self, token):
+        for variant in deletions(token) | {token}:
+            self._variants[variant].add(token)
+
+    def add(self, record):
+        self.remove(record['username'])
+        record, new_tokens = self._store(record)
+        for token in new_tokens:
+            bisect.insort(self._sorted_tokens, token)
+            self._add_variants(token)
+        if self._completions is not None:
+            self._completions.add(record)
+
+    def remove(self, username):
+        self.records.pop(username, None)
+        if self._completions is not None:
+            self._completions.remove(username)
+        for token in self._tokens_of.pop(username, ()):
+            usernames = self._postings[token]
+            usernames.discard(username)
+            if usernames:
+                continue
+            del self._postings[token]
+            del self._sorted_tokens[bisect.bisect_left(self._sorted_tokens, token)]
+            for variant in deletions(token) | {token}:
+                self._variants[variant].discard(token)
+                if not self._variants[variant]:
+                    del self._variants[variant]
+
+    def _matches(self, term):
+        """Users matching a query term, as {username: score}."""
+        scores = {}
+        tokens = self._sorted_tokens
+        for position in range(bisect.bisect_left(tokens, term), len(tokens)):
+            token = tokens[position]
+            if not token.startswith(term):
+                break
+            score = EXACT if token == term else PREFIX
+            for username in self._postings[token]:
+                scores[username] = max(score, scores.get(username, 0))
+
+        if not scores and len(term) >= FUZZY_MIN_LENGTH:
+            candidates = set()
+            for variant in deletions(term) | {term}:
+                candidates.update(self._variants.get(variant, ()))
+            for token in candidates:
+                if within_one_edit(term, token):
+                    for username in self._postings[token]:
+                        scores[username] = FUZZY
+        return scores
+
+    def query(self, text, limit):
+        """Records of the users matching all terms of a query, best first."""
+        scores = None
+        for term in tokenize(text):
+            matches = self._matches(term)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {
+                    username: scores[username] + score for username, score in matches.items() if username in scores
+                }
+            if not scores:
+                return []
+        if scores is None:
+            return []
+        ranked = sorted(scores, key=lambda username: (-scores[username], self.records[username]['sort_key']))
+        return [self.records[username] for username in ranked[:limit]]
+
+
+class DirectoryIndex(object):
+    """The index of all users, kept up to date with the directory."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._index = None
+        self._synced_at = None  # Start of the last sync (aware datetime)
+        self._refreshed_at = 0  # time.monotonic() of the last sync
+        self._dirty = set()  # usernames saved or deleted by this process
+        # Built from the replica, when it serves users
+        self._replica_index = None
+        self._replica_sequence = 0  # Last change of the replica applied
+        self._replica_usernames = {}  # uuid => username
+
+    def mark_dirty(self, username):
+        with self._lock:
+            self._dirty.add(username)
+
+    def _fetch(self, queryset, **kwargs):
+        """Index the matching users; returns their usernames."""
+        usernames = set()
+        for _dn, record in queryset.entries('dn', *FIELDS, **kwargs):
+            self._index.add(record)
+            usernames.add(record['username'])
+        return usernames
+
+    def _load(self):
+        self._index = Index(record for _dn, record in models.LdapUser.objects.all().entries('dn', *FIELDS))
+
+    def _update(self, full):
+        """Apply local changes, and if ``full``, changes made by others."""
+        dirty, self._dirty = self._dirty, set()
+        for queryset in models.LdapUser.objects.chunked_in('username', sorted(dirty)):
+            dirty.difference_update(self._fetch(queryset))
+        # Not found anymore: deleted
+        for username in dirty:
+            self._index.remove(username)
+
+        if full:
+            since = self._synced_at - datetime.timedelta(seconds=CLOCK_SKEW)
+            self._fetch(models.LdapUser.objects.all(), modified_since=since)
+            existing = {dn for dn, _values in models.LdapUser.objects.entries()}
+            for username, record in list(self._index.records.items()):
+                if record['dn'] not in existing:
+                    self._index.remove(username)
+
+    def _refresh(self):
+        full = time.monotonic() - self._refreshed_at > settings.GRANADILLA_SEARCH_REFRESH_INTERVAL
+        if not (full or self._dirty or self._index is None):
+            return
+        started = datetime.datetime.now(datetime.timezone.utc)
+        if self._index is None:
+            self._load()
+        else:
+            self._update(full)
+        if full or self._synced_at is None:
+            self._synced_at = started
+            self._refreshed_at = time.monotonic()
+
+    def _follow_replica(self):
+        """Apply the changes received by the replica since the last call."""
+        sequence, changes = replica.changes(models.LdapUser, self._replica_sequence)
+        records = {uuid: replica_record(entry) for uuid, entry in changes if entry is not None}
+        if self._replica_index is None:
+            self._replica_index = Index(records.values())
+        else:
+            # Removals first, as a username may have moved to another entry.
+            for uuid, _entry in changes:
+                username = self._replica_usernames.pop(uuid, None)
+                if username is not None:
+                    self._replica_index.remove(username)
+            for record in records.values():
+                self._replica_index.add(record)
+        self._replica_usernames.update((uuid, record['username']) for uuid, record in records.items())
+        self._replica_sequence = sequence
+
+    def _current(self):
+        """The index, up to date."""
+        if replica.serves(models.LdapUser):
+            self._follow_replica()
+            return self._replica_index
+        self._refresh()
+        return self._index
+
+    def query(self, text, limit):
+        """Query the index, refreshing it first if needed."""
+        with self._lock:
+            return self._current().query(text, limit)
+
+    def complete(self, text, limit):
+        """Complete a name or phone number, refreshing the index first if needed."""
+        with self._lock:
+            return self._current().completions.complete(text, limit)
+
+    def clear(self):
+        with self._lock:
+            self._index = None
+            self._synced_at = None
+            self._refreshed_at = 0
+            self._dirty = set()
+            self._replica_index = None
+            self._replica_sequence = 0
+            self._replica_usernames = {}
+
+
+def replica_record(entry):
+    """The record of a replicated user."""
+    user = entry.instance(FIELDS)
+    return dict({name: getattr(user, name) for name in FIELDS}, dn=entry.dn)
+
+
+directory_index = DirectoryIndex()
+
+
+@receiver(post_save, sender=models.LdapUser)
+@receiver(post_delete, sender=models.LdapUser)
+def _user_changed(sender, instance, **kwargs):
+    directory_index.mark_dirty(instance.username)
+
+
+def search(text, limit=None):
+    """Search users by name, e-mail address or phone number.
+
+    Returns a list of dicts of FIELDS, best matches first.
+    """
+    return directory_index.query(text, limit or settings.GRANADILLA_SEARCH_RESULTS)
+
+
+def complete(text, limit=None):
+    """Complete the start of a name or phone number.
+
+    Returns a list of dicts of autocomplete.FIELDS.
+    """
+    return directory_index.complete(text, limit or settings.GRANADILLA_AUTOCOMPLETE_RESULTS)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# django-granadilla
+# Copyright (C) Bolloré telecom, Polyconseil
+# See AUTHORS file for a full list of contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Bulk reconciliation of device groups.
+
+LdapDeviceGroup.resync() recomputes one device group at a time, fetching its
+group, the group members and their devices.  The engine below fetches each
+kind of entry once, and reconciles all device groups in memory.
+"""
+
+import collections
+import logging
+
+from . import models
+
+
+logger = logging.getLogger(__name__.split('.')[0])
+
+
+class DirectorySnapshot(object):
+    """In-memory indexes of the entries needed to compute device group members."""
+
+    def __init__(self):
+        # normalised group DN => usernames
+        self.group_usernames = {}
+        # username => normalised user DN
+        self.user_dns = {}
+        # normalised owner DN => device DNs
+        self.owner_devices = collections.defaultdict(list)
+
+    @classmethod
+    def load(cls):
+        snapshot = cls()
+        for dn, values in models.LdapGroup.objects.entries('usernames'):
+            snapshot.group_usernames[models.normalise_dn(dn)] = values['usernames']
+        for dn, values in models.LdapUser.objects.entries('username'):
+            snapshot.user_dns[values['username']] = models.normalise_dn(dn)
+        for dn, values in models.LdapDevice.objects.entries('owner_dn'):
+            if values['owner_dn']:
+                snapshot.owner_devices[models.normalise_dn(values['owner_dn'])].append(dn)
+        return snapshot
+
+    def has_group(self, group_dn):
+        return models.normalise_dn(group_dn) in self.group_usernames
+
+    def group_member_dns(self, group_dn):
+        """DNs of the existing users belonging to a group."""
+        usernames = self.group_usernames.get(models.normalise_dn(group_dn), [])
+        return [self.user_dns[username] for username in usernames if username in self.user_dns]
+
+    def expected_devices(self, group_dn):
+        """DNs of the devices owned by members of a group."""
+        return sorted(
+            device_dn
+            for owner_dn in self.group_member_dns(group_dn)
+            for device_dn in self.owner_devices.get(owner_dn, [])
+        )
+
+
+def sync_device_groups(device_groups=None):
+    """Resynchronize device groups with the devices of their group members.
+
+    All device groups are handled unless ``device_groups`` is provided.
+    This costs four searches (device groups, groups, users and devices)
+    whatever the size of the directory, plus one write per changed group.
+
+    Returns the list of device groups that were changed.
+    """
+    if device_groups is None:
+        device_groups = models.LdapDeviceGroup.objects.all()
+    device_groups = list(device_groups)
+    if not device_groups:
+        return []
+
+    snapshot = DirectorySnapshot.load()
+
+    changed = []
+    for device_group in device_groups:
+        if not snapshot.has_group(device_group.group_dn):
+            logger.warning("Group %s: related group %s not found", device_group.name, device_group.group_dn)
+            continue
+        if device_group.update_members(snapshot.expected_devices(device_group.group_dn)):
+            changed.append(device_group)
+    return changed
@@ -31,11 +31,19 @@ urlpatterns = [
     re_path(r'^devices/(?P<device_login>[^/]+)/password/$', views.device_password, name='device_password'),
     re_path(r'^devices/(?P<device_login>[^/]+)/delete/$', views.device_delete),
     path('groups/', views.groups, name='groups'),
+    path('search/', views.search_view, name='search'),
+    re_path(r'^search\.json$', views.search_json, name='search_json'),
+    re_path(r'^autocomplete\.json$', views.autocomplete_json, name='autocomplete_json'),
+    re_path(r'^group/(?P<slug>.*)/cards\.vcf$', views.group_cards, name='group_cards'),
+    re_path(r'^group/(?P<slug>.*)/phonebook\.(?P<format>json|msgpack)$', views.group_phonebook, name='group_phonebook'),
+    re_path(r'^group/(?P<slug>.*)/print\.(?P<format>csv|pdf)$', views.group_print_export, name='group_print_export'),
     re_path(r'^group/(?P<slug>.*)/print/$', views.group_print, name='group_print'),
     re_path(r'^group/(?P<slug>.*)/$', views.group, name='group'),
     re_path(r'^user/(?P<uid>.*)/card/$', views.user_card, name='user_card'),
-    re_path(r'^user/(?P<uid>.*)/photo/$', views.photo),
+    re_path(r'^user/(?P<uid>.*)/photo/$', views.photo, name='photo'),
     re_path(r'^user/(?P<uid>.*)/photo/delete/$', views.photo_delete),
     re_path(r'^user/(?P<uid>.*)/$', views.user, name='user'),
     path('password/', views.ChangePassword, name='change_password'),
+    path('cache/stats/', views.entry_cache_stats, name='entry_cache_stats'),
+    path('pool/stats/', views.ldap_pool_stats, name='ldap_pool_stats'),
 ]
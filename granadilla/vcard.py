@@ -1,6 +1,13 @@
 """Trivial vcard generator."""
 
-import re
+
+# Characters escaped in vCard values, see RFC 2426 section 4.
+ESCAPES = str.maketrans({
+    ',': '\\,',
+    ';': '\\;',
+    '\\': '\\\\',
+    '\n': '\\n',
+})
 
 
 class Field(object):
@@ -12,21 +19,23 @@ class Field(object):
         self.prefix = prefix
         self.subtype = subtype
         self.cardinality = cardinality
+        if subtype:
+            self.header = '%s;TYPE=%s:' % (prefix, subtype)
+        else:
+            self.header = '%s:' % prefix
 
     def _escape_one(self, value):
-        value = re.sub(r'([,;\\])', r'\\\1', value)
-        value = value.replace('\n', '\\n')
-        return value
+        return value.translate(ESCAPES)
 
     def _escape(self, value):
         if self.cardinality == self.SINGLE:
-            return self._escape_one(value)
+            return value.translate(ESCAPES)
         elif self.cardinality == self.MULTI:
-            return ';'.join(self._escape_one(v) for v in value)
+            return ';'.join(v.translate(ESCAPES) for v in value)
         else:
             assert self.cardinality == self.MULTI_NESTED
             return ';'.join(
-                ','.join(self._escape_one(subv) for subv in v)
+                ','.join(subv.translate(ESCAPES) for subv in v)
                 for v in value
             )
 
@@ -40,11 +49,7 @@ class Field(object):
             return any(any(subv for subv in v) for v in value)
 
     def render(self, value):
-        if self.subtype:
-            subtype_txt = ';TYPE=%s' % self.subtype
-        else:
-            subtype_txt = ''
-        return '%s%s:%s' % (self.prefix, subtype_txt, self._escape(value))
+        return self.header + self._escape(value)
 
 
 class VCard(object):
@@ -61,6 +66,10 @@ class VCard(object):
         'photo': Field('PHOTO'),
     }
 
+    # Lines are sorted by header; no header is a prefix of another one, so
+    # this is the order of the rendered lines.
+    RENDER_ORDER = sorted(ALL_FIELDS.items(), key=lambda item: item[1].header)
+
     def __init__(self):
         self.data = {}
 
@@ -71,20 +80,32 @@ class VCard(object):
         assert key in self.ALL_FIELDS
         self.data[key] = value
 
+    def render(self):
+        """Render the card as text, without a trailing line break."""
+        data = self.data
+        lines = ['BEGIN:VCARD', 'VERSION:3.0']
+        for key, field in self.RENDER_ORDER:
+            value = data.get(key)
+            if value is not None and field.filled(value):
+                lines.append(field.render(value))
+        lines.append('END:VCARD')
+        return '\r\n'.join(lines)
+
     def render_bytes(self):
-        inner_lines = []
-        for key, field in self.ALL_FIELDS.items():
-            if key not in self.data:
-                continue
-            value = self.data[key]
-            if not field.filled(value):
-                continue
-            inner_lines.append(field.render(value))
-
-        lines = [
-            'BEGIN:VCARD',
-            'VERSION:3.0',
-        ] + sorted(inner_lines) + [
-            'END:VCARD',
-        ]
-        return '\r\n'.join(lines).encode('utf-8')
+        return self.render().encode('utf-8')
+
+
+def render_many(cards, batch_size=100):
+    """Render cards as a single .vcf file, yielding bytes chunks.
+
+    Each chunk holds up to ``batch_size`` cards, each followed by a line
+    break.
+    """
+    batch = []
+    for card in cards:
+        batch.append(card.render())
+        if len(batch) >= batch_size:
+            yield ('\r\n'.join(batch) + '\r\n').encode('utf-8')
+            batch = []
+    if batch:
+        yield ('\r\n'.join(batch) + '\r\n').encode('utf-8')
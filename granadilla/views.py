@@ -20,23 +20,29 @@
 
 from __future__ import unicode_literals
 
-import time
+import calendar
 
 from .conf import settings
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
 from django.urls import reverse
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotModified
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.template import RequestContext
-from django.utils.http import http_date
-from django.views.static import was_modified_since
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, urlencode
 from django.views import generic as generic_views
 from django.views.generic.edit import FormView
 from granadilla.templatetags.granadilla_tags import granadilla_media
 from granadilla.forms import LdapDeviceForm, LdapUserForm, LdapUserPassForm
+from . import exports
 from . import models
-from . import vcard
+from . import phonebook
+from . import photos
+from . import pool
+from . import search
+from .replica import replica
 from django.contrib.messages.views import SuccessMessageMixin
 from django.utils.translation import gettext_lazy as _
 
@@ -45,11 +51,18 @@ def can_write(user, entry):
     """
     Check whether a user can write an LDAP entry.
     """
-    can_edit = user.username == entry.username or user.is_superuser
-    for group in user.groups.all():
-        if group.name in settings.GRANADILLA_ADMIN_GROUPS:
-            return True
-    return can_edit
+    if user.username == entry.username or user.is_superuser:
+        return True
+    admin_groups = set(settings.GRANADILLA_ADMIN_GROUPS)
+    return any(name in admin_groups for name in models.memberships.groups_of(user.username))
+
+
+def get_cached_or_404(model, pk):
+    """Get an entry through the entry cache, or raise Http404."""
+    try:
+        return model.objects.cached(pk=pk)
+    except model.DoesNotExist:
+        raise Http404("No %s matches %s" % (model._meta.verbose_name, pk))
 
 
 def get_contacts(user):
@@ -59,23 +72,7 @@ def get_contacts(user):
 
 def user_vcard(user):
     """Return the vCard for a contact."""
-    card = vcard.VCard()
-    card['kind'] = 'individual'
-    card['names'] = [
-        [user.first_name],
-        [user.last_name],
-        [],  # Additional names
-        [],  # Honorific prefixes
-        [],  # Honorific suffixes
-    ]
-    card['full_name'] = user.full_name
-    card['email'] = user.email
-    card['org'] = getattr(user, 'organization', '')
-    card['phone'] = user.phone
-    card['cell'] = user.mobile_phone
-
-    # send response
-    response = HttpResponse(card.render_bytes(), "text/x-vcard; charset=utf-8")
+    response = HttpResponse(exports.user_card(user).render_bytes(), "text/x-vcard; charset=utf-8")
     response['Content-Disposition'] = "attachment; filename=%s.vcf" % user.pk.replace(' ', '')
     return response
 
@@ -189,23 +186,115 @@ class DeviceListView(DeviceACLMixin, generic_views.ListView):
     template_name = 'granadilla/device_list.html'
     context_object_name = 'devices'
 
+    def get_context_data(self, **kwargs):
+        ctxt = super(DeviceListView, self).get_context_data(**kwargs)
+        if settings.GRANADILLA_ASYNC_PROVISIONING:
+            from .jobs import worker  # Optional app
+            statuses = worker.owner_statuses({device.owner_dn for device in ctxt['devices']})
+            for device in ctxt['devices']:
+                device.provisioning = statuses.get(device.owner_dn)
+            ctxt['async_provisioning'] = True
+        return ctxt
+
 
 device_list = login_required(DeviceListView.as_view())
 
 
+def member_sort_key(user):
+    return (user.last_name.lower(), user.first_name.lower())
+
+
+def fetch_members(usernames, fields, photo_flag=False):
+    """Fetch the given users, loading only some fields.
+
+    With photo_flag, member.has_photo is set through a presence check,
+    without fetching the photos; member.photo_url points to their
+    thumbnail, versioned by its digest when it is known.
+
+    Returns a {username: user} dict.
+    """
+    if replica.serves(models.LdapUser):
+        return fetch_replicated_members(usernames, fields, photo_flag)
+
+    members = {}
+    for queryset in models.LdapUser.objects.chunked_in('username', usernames):
+        with_photo = queryset.modify_timestamps(having='photo') if photo_flag else {}
+        modified = {}
+        for member in queryset.projected(*fields):
+            if photo_flag:
+                member.has_photo = member.dn in with_photo
+                if member.has_photo:
+                    modified[member.username] = with_photo[member.dn]
+            members[member.username] = member
+
+        digests = photos.store.known_digests(modified) if modified else {}
+        for username in modified:
+            members[username].photo_url = photo_url(members[username], 'thumbnail', digests.get(username))
+    return members
+
+
+def fetch_replicated_members(usernames, fields, photo_flag=False):
+    """fetch_members(), served from the replica."""
+    members = {}
+    for entry in replica.filter_pks(models.LdapUser, usernames):
+        member = entry.instance(fields)
+        if photo_flag:
+            # The replica keeps the digests of all photos.
+            member.has_photo = entry.photo_digest is not None
+            if member.has_photo:
+                member.photo_url = photo_url(member, 'thumbnail', entry.photo_digest)
+        members[member.username] = member
+    return members
+
+
 class GroupView(generic_views.DetailView):
     model = models.LdapGroup
     template_name = 'granadilla/group.html'
     printable = False
     slug_field = 'name'
+    paginate_by = settings.GRANADILLA_GROUP_PAGE_SIZE
+
+    # Fields displayed by the template
+    member_fields = ['username', 'mobile_phone']
+    printable_member_fields = ['username', 'phone', 'mobile_phone', 'internal_phone']
+
+    def get_object(self, queryset=None):
+        # index() passes the home group as pk, URLs as slug.
+        name = self.kwargs.get(self.slug_url_kwarg) or self.kwargs.get(self.pk_url_kwarg)
+        return get_cached_or_404(self.model, name)
+
+    def get_members(self):
+        """Sort the group members, and fetch those to display.
+
+        Returns (members, page); page is None when all members are displayed.
+        """
+        sort_fields = ['last_name', 'first_name']
+        usernames = self.object.usernames
+
+        if self.printable:
+            members = fetch_members(usernames, self.printable_member_fields + sort_fields)
+            return sorted(members.values(), key=member_sort_key), None
+
+        # Sort on lightweight entries, then only fetch the current page.
+        sorted_usernames = [
+            member.username
+            for member in sorted(fetch_members(usernames, ['username'] + sort_fields).values(), key=member_sort_key)
+        ]
+        page = Paginator(sorted_usernames, self.paginate_by).get_page(self.request.GET.get('page'))
+        members = fetch_members(page.object_list, self.member_fields, photo_flag=True)
+        return [members[username] for username in page.object_list if username in members], page
 
     def get_context_data(self, **kwargs):
         ctxt = super(GroupView, self).get_context_data(**kwargs)
+        members, page = self.get_members()
         ctxt.update({
             'printable': self.printable,
             'home': self.object.name == settings.GRANADILLA_USERS_GROUP,
             'group': self.object,
-            'members': models.LdapUser.objects.filter(username__in=self.object.usernames),
+            'members': members,
+            'paginator': page.paginator if page else None,
+            'page_obj': page,
+            'is_paginated': bool(page and page.has_other_pages()),
         })
         return ctxt
 
@@ -213,6 +302,58 @@ class GroupView(generic_views.DetailView):
 group = login_required(GroupView.as_view())
 
 
+@login_required
+def group_cards(request, slug):
+    """Stream the vCards of all members of a group, as a single file."""
+    try:
+        # Fail before streaming starts
+        models.memberships.members_of(slug)
+    except models.LdapGroup.DoesNotExist:
+        raise Http404("No group %s" % slug)
+
+    response = StreamingHttpResponse(exports.group_vcards(slug), content_type="text/x-vcard; charset=utf-8")
+    response['Content-Disposition'] = "attachment; filename=%s.vcf" % slug.replace(' ', '')
+    return response
+
+
+@login_required
+def group_print_export(request, slug, format):
+    """Stream the printable directory of a group, as CSV or PDF."""
+    try:
+        # Fail before streaming starts
+        chunks = exports.store.export(slug, format)
+    except models.LdapGroup.DoesNotExist:
+        raise Http404("No group %s" % slug)
+
+    response = StreamingHttpResponse(chunks, content_type=exports.PRINT_CONTENT_TYPES[format])
+    response['Content-Disposition'] = "attachment; filename=%s.%s" % (slug.replace(' ', ''), format)
+    return response
+
+
+@login_required
+def group_phonebook(request, slug, format):
+    """A group's phonebook, for offline use.
+
+    ``?since=<version>`` only returns the changes since that version, when
+    it is still known.  The version is also the ETag of the response.
+    """
+    if format not in phonebook.available_formats():
+        raise Http404("Unsupported format %s" % format)
+    try:
+        current = phonebook.group_phonebook(slug)
+    except models.LdapGroup.DoesNotExist:
+        raise Http404("No group %s" % slug)
+
+    etag = '"%s"' % current.version
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        data = current.export(since=request.GET.get('since'))
+        response = HttpResponse(phonebook.dumps(data, format), content_type=phonebook.CONTENT_TYPES[format])
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 class ChangePasswordView(SuccessMessageMixin, FormView):
     """
     function to change the user's password
@@ -267,33 +408,151 @@ class GroupsView(generic_views.ListView):
 groups = login_required(GroupsView.as_view())
 
 
+# Fields of search results
+SEARCH_RESULT_FIELDS = ['username', 'full_name', 'email', 'phone', 'mobile_phone', 'internal_phone']
+
+
+def results_limit(request, maximum):
+    """The limit parameter of a request, at most ``maximum``."""
+    try:
+        return min(int(request.GET['limit']), maximum)
+    except (KeyError, ValueError):
+        return maximum
+
+
+def search_results(request):
+    """Run the search of a request (q, and optionally limit, parameters).
+
+    Returns (query, results).
+    """
+    query = request.GET.get('q', '').strip()
+    limit = results_limit(request, settings.GRANADILLA_SEARCH_RESULTS)
+    results = search.search(query, limit=limit) if query and limit > 0 else []
+    return query, [{name: result[name] for name in SEARCH_RESULT_FIELDS} for result in results]
+
+
+@login_required
+def search_view(request):
+    query, results = search_results(request)
+    return render(request, 'granadilla/search.html', {'query': query, 'results': results})
+
+
+@login_required
+def search_json(request):
+    query, results = search_results(request)
+    for result in results:
+        result['url'] = reverse('granadilla:user', args=[result['username']])
+    return JsonResponse({'query': query, 'results': results})
+
+
+@login_required
+def autocomplete_json(request):
+    """Complete a name or phone number prefix (q, and optionally limit, parameters).
+
+    Served from memory: the directory is read at most once per search
+    refresh interval, never on each keystroke.
+    """
+    query = request.GET.get('q', '')
+    limit = results_limit(request, settings.GRANADILLA_AUTOCOMPLETE_RESULTS)
+    results = search.complete(query, limit=limit) if query.strip() and limit > 0 else []
+    return JsonResponse({'query': query, 'results': results})
+
+
+def photo_url(user, size=photos.FULL_SIZE, digest=None):
+    """URL of a user's photo; versioned by its digest, if known."""
+    params = {}
+    if size != photos.FULL_SIZE:
+        params['size'] = size
+    if digest:
+        params['v'] = digest
+    url = reverse('granadilla:photo', args=(user.pk,))
+    if params:
+        url += '?' + urlencode(params)
+    return url
+
+
+def photo_validators(modified, digest, size):
+    etag = photos.photo_etag(digest, size)
+    last_modified = calendar.timegm(modified.utctimetuple()) if modified else None
+    return etag, last_modified
+
+
+def photo_not_modified(request, modified, digest, size):
+    """Answer conditional requests; returns None if the photo must be sent."""
+    etag, last_modified = photo_validators(modified, digest, size)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        response['ETag'] = etag
+    return response
+
+
 @login_required
 def photo(request, uid):
-    now = time.time()
-    max_age = 1800
-    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), now - max_age):
-        return HttpResponseNotModified()
+    """Serve a user's photo.
 
-    user = get_object_or_404(models.LdapUser, pk=uid)
+    ``?size=<name>`` selects a resized variant; ``?v=<digest>`` marks a
+    versioned URL, which browsers may cache forever.
+    """
+    size = request.GET.get('size', photos.FULL_SIZE)
+    if not photos.store.is_valid_size(size):
+        raise Http404("Unknown photo size %s" % size)
+
+    # Lightweight lookup: only the modification time, not the photo.
+    timestamps = models.LdapUser.objects.filter(pk=uid).modify_timestamps()
+    if not timestamps:
+        raise Http404("No user %s" % uid)
+    modified, = timestamps.values()
+
+    digest = photos.store.known_digest(uid, modified)
+    if digest:
+        response = photo_not_modified(request, modified, digest, size)
+        if response is not None:
+            return response
+        # Resized variants are kept on disk: no need for the original.
+        data = photos.store.read(digest, size) if size != photos.FULL_SIZE else None
+        if data is not None:
+            return photo_response(request, data, modified, digest, size)
+
+    user = get_object_or_404(models.LdapUser.objects.only('username', 'photo'), pk=uid)
     if not user.photo:
+        photos.store.forget(user.username)
         return HttpResponseRedirect(granadilla_media('img/unknown.png'))
+
+    digest = photos.store.remember(user.username, user.photo, modified)
+    response = photo_not_modified(request, modified, digest, size)
+    if response is not None:
+        return response
+    return photo_response(request, photos.store.get(user.photo, size, digest=digest), modified, digest, size)
+
+
+def photo_response(request, data, modified, digest, size):
+    etag, last_modified = photo_validators(modified, digest, size)
     response = HttpResponse()
-    response['Cache-Control'] = 'max-age=%i' % max_age
-    response['Content-Length'] = len(user.photo)
+    if request.GET.get('v') == digest:
+        # The URL changes with the photo.
+        response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    else:
+        response['Cache-Control'] = 'private, no-cache'
+    response['Content-Length'] = len(data)
     response['Content-Type'] = 'image/jpeg'
-    response['Last-Modified'] = http_date(now)
-    response.write(user.photo)
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    response.write(data)
     return response
 
 
 def photo_delete(request, uid):
-    user = get_object_or_404(models.LdapUser, pk=uid)
+    user = get_cached_or_404(models.LdapUser, uid)
     if not can_write(request.user, user):
         raise PermissionDenied
 
     if request.method == 'POST':
+        # Saving writes back every field: start from the current entry.
+        user = get_object_or_404(models.LdapUser, pk=uid)
         user.photo = ''
         user.save()
+        photos.store.forget(user.username)
         return redirect(reverse(index))
     else:
         return render(request, 'granadilla/photo_delete.html', RequestContext(request, {
@@ -303,7 +562,7 @@ def photo_delete(request, uid):
 
 @login_required
 def user(request, uid):
-    user = get_object_or_404(models.LdapUser, pk=uid)
+    user = get_cached_or_404(models.LdapUser, uid)
 
     # set permissions
     can_edit = can_write(request.user, user)
@@ -312,6 +571,8 @@ def user(request, uid):
     if request.method == 'POST':
         if not can_edit:
             raise PermissionDenied
+        # The cache is for reads only: saving writes back every field.
+        user = get_object_or_404(models.LdapUser, pk=uid)
         form = LdapUserForm(request.POST, request.FILES, instance=user)
         if form.is_valid():
             form.save()
@@ -328,7 +589,23 @@ def user(request, uid):
     return render(request, 'granadilla/user.html', context)
 
 
+@login_required
+def entry_cache_stats(request):
+    """Hit and miss counters of the entry cache, for this process."""
+    if not request.user.is_superuser:
+        raise PermissionDenied
+    return JsonResponse(models.entry_cache.stats())
+
+
+@login_required
+def ldap_pool_stats(request):
+    """Counters of the LDAP connection pools, for this process."""
+    if not request.user.is_superuser:
+        raise PermissionDenied
+    return JsonResponse(pool.stats())
+
+
 @login_required
 def user_card(request, uid):
-    user = get_object_or_404(models.LdapUser, pk=uid)
+    user = get_cached_or_404(models.LdapUser, uid)
     return user_vcard(user)
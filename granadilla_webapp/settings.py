@@ -75,6 +75,7 @@ ALLOWED_HOSTS = config.getlist('django.allowed_hosts')
 
 INSTALLED_APPS = (
     'granadilla',
+    'granadilla.jobs',
     'granadilla_webapp.web',
     'zxcvbn_password',
     'django_password_strength',
@@ -120,7 +121,7 @@ DATABASES = {
         'PASSWORD': config.getstr('db.password'),
     },
     'ldap': {
-        'ENGINE': 'ldapdb.backends.ldap',
+        'ENGINE': 'granadilla.backends.ldap',
         'NAME': config.getstr('ldap.server', 'ldaps://ldaps.example.org'),
         'USER': config.getstr('ldap.webapp_bind_dn', 'uid=test,dc=example,dc=org'),
         'PASSWORD': config.getstr('ldap.webapp_bind_pw'),
@@ -143,7 +144,7 @@ AUTH_PASSWORD_VALIDATORS = [{
     }
 }]
 
-DATABASE_ROUTERS = ['ldapdb.router.Router']
+DATABASE_ROUTERS = ['granadilla.router.Router']
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
@@ -207,6 +208,45 @@ GRANADILLA_USE_SAMBA = config.getbool('granadilla.use_samba', False)
 # Samba SID prefix
 GRANADILLA_SAMBA_PREFIX = config.getstr('granadilla.samba_prefix', 'S-1-0-0')
 
+# uid/gid counters entry (cn=<name>,<base_dn>); requires the Samba schema.
+GRANADILLA_ID_POOL_NAME = config.getstr('granadilla.id_pool_name', '')
+
+# How long group memberships are cached, in seconds.
+GRANADILLA_MEMBERSHIP_CACHE_TTL = config.getint('granadilla.membership_cache_ttl', 300)
+
+# How long users and groups are cached, in seconds (0 to disable).
+GRANADILLA_ENTRY_CACHE_TTL = config.getint('granadilla.entry_cache_ttl', 60)
+
+# Keep users, groups and devices in memory, synced from the directory.
+GRANADILLA_REPLICA_ENABLED = config.getbool('granadilla.replica_enabled', False)
+GRANADILLA_REPLICA_POLL_INTERVAL = config.getint('granadilla.replica_poll_interval', 30)
+
+# Pool of bound LDAP connections: idle connections kept, maximum age and
+# idle time before a health check, in seconds.
+GRANADILLA_LDAP_POOL_SIZE = config.getint('ldap.pool_size', 10)
+GRANADILLA_LDAP_POOL_MAX_AGE = config.getint('ldap.pool_max_age', 300)
+GRANADILLA_LDAP_POOL_CHECK_INTERVAL = config.getint('ldap.pool_check_interval', 30)
+
+# How often the search index picks up changes from the directory, in seconds.
+GRANADILLA_SEARCH_REFRESH_INTERVAL = config.getint('granadilla.search_refresh_interval', 60)
+
+# Number of cards per group page.
+GRANADILLA_GROUP_PAGE_SIZE = config.getint('granadilla.group_page_size', 100)
+
+# Propagate new devices to device groups in background jobs, run by a
+# thread of the web process unless disabled (then run `granadilla-admin run_jobs --loop`).
+GRANADILLA_ASYNC_PROVISIONING = config.getbool('granadilla.async_provisioning', False)
+GRANADILLA_JOBS_WORKER_THREAD = config.getbool('granadilla.jobs_worker_thread', True)
+
+# How long phonebook versions are remembered to serve deltas, in seconds.
+GRANADILLA_PHONEBOOK_HISTORY_TTL = config.getint('granadilla.phonebook_history_ttl', 7 * 24 * 3600)
+
+# Where resized photos are stored.
+GRANADILLA_PHOTO_CACHE_DIR = config.getstr('granadilla.photo_cache_dir', os.path.join(BASE_DIR, 'photos'))
+
+# Where printable group directories are stored.
+GRANADILLA_EXPORT_CACHE_DIR = config.getstr('granadilla.export_cache_dir', os.path.join(BASE_DIR, 'exports'))
+
 # URL from which Granadilla's static media are served.
 GRANADILLA_MEDIA_PREFIX = os.path.join(STATIC_URL, 'granadilla')
 
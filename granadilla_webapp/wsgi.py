@@ -12,3 +12,10 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "granadilla_webapp.settings")
 
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
+
+# Background threads of the web process: the replica of the directory, and
+# the worker running the jobs queued (possibly before this process started).
+from granadilla.jobs import worker  # noqa: E402
+from granadilla.replica import replica  # noqa: E402
+replica.ensure_started()
+worker.start_worker()
@@ -94,9 +94,16 @@ setup(
         # Passwords
         'zxcvbn',
 
+        # Photos
+        'Pillow',
+
         # Command line
         'colorama',
     ],
+    extras_require={
+        # MessagePack phonebooks
+        'msgpack': ['msgpack'],
+    },
     classifiers=[
         "Development Status :: 4 - Beta",
         "Environment :: Web Environment",
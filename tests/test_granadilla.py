@@ -2,18 +2,42 @@ from __future__ import unicode_literals
 
 import contextlib
 import io
+import json
 import os.path
+import re
+import subprocess
 import sys
+import tempfile
+from unittest import mock
 
 from django.conf import settings
 from django.contrib.auth import models as auth_models
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connections
 from django.urls import reverse
 from django import test as django_test
+from django.utils import timezone
+from django.utils import translation
 
+import ldap
 import volatildap
+from PIL import Image
 
 from granadilla import cli
+from granadilla import forms
+from granadilla import ids
+from granadilla.jobs import worker as jobs_worker
+from granadilla.jobs.models import Job
 from granadilla import models
+from granadilla import photos
+from granadilla import pool
+from granadilla import provisioning
+from granadilla import replica
+from granadilla import search
+from granadilla import sync
+from granadilla import vcard
+from granadilla import views
 
 
 # Helpers
@@ -29,6 +53,46 @@ def replace_stdin(contents):
     sys.stdin = original_stdin
 
 
+class SearchCounter(object):
+    def __init__(self):
+        self.searches = 0
+        self.entries = 0
+        self.attrlists = []
+
+
+@contextlib.contextmanager
+def count_ldap_searches(using='ldap'):
+    """Count the LDAP searches (and entries fetched) within the block.
+
+    Both django-ldapdb's searches and models.paged_search() are counted.
+    """
+    connection = connections[using]
+    original_search_s = connection.search_s
+    original_paged_search = models.paged_search
+    counter = SearchCounter()
+
+    def counted(results, attrlist):
+        counter.searches += 1
+        counter.attrlists.append(attrlist)
+        for entry in results:
+            counter.entries += 1
+            yield entry
+
+    def search_s(base, scope, filterstr='(objectClass=*)', attrlist=None):
+        return counted(original_search_s(base, scope, filterstr, attrlist), attrlist)
+
+    def paged_search(db, base, scope, filterstr, attrlist):
+        results = original_paged_search(db, base, scope, filterstr, attrlist)
+        return counted(results, attrlist) if db.alias == using else results
+
+    connection.search_s = search_s
+    try:
+        with mock.patch.object(models, 'paged_search', paged_search):
+            yield counter
+    finally:
+        del connection.search_s
+
+
 class LdapBasedTestCase(django_test.TestCase):
 
     databases = ['default', 'ldap']
@@ -55,6 +119,7 @@ class LdapBasedTestCase(django_test.TestCase):
         settings.AUTH_LDAP_SERVER_URI = self.ldap_server.uri
         settings.AUTH_LDAP_BIND_DN = self.ldap_server.rootdn
         settings.AUTH_LDAP_BIND_PASSWORD = self.ldap_server.rootpw
+        caches[settings.GRANADILLA_CACHE_ALIAS].clear()
         cli.CLI().init()
 
 
@@ -114,6 +179,201 @@ class DeviceTests(LdapBasedTestCase):
         dg = models.LdapDeviceGroup.objects.get()
         self.assertEqual([device.dn, device2.dn], dg.members)
 
+    def create_device(self, name):
+        device = models.LdapDevice(
+            owner_dn=self.user.dn,
+            name=name,
+            owner_username='jdoe',
+            login='jdoe_%s' % name,
+        )
+        device.set_password()
+        device.save()
+        return device
+
+    @django_test.override_settings(GRANADILLA_ASYNC_PROVISIONING=True, GRANADILLA_JOBS_WORKER_THREAD=False)
+    def test_async_provisioning(self):
+        laptop = self.create_device('laptop')
+        models.LdapDeviceGroup(name=self.group.name, group_dn=self.group.dn, members=[laptop.dn]).save()
+        phone = self.create_device('phone')
+        tablet = self.create_device('tablet')
+
+        # Queued and coalesced, not propagated yet
+        self.assertEqual([laptop.dn], models.LdapDeviceGroup.objects.get().members)
+        self.assertEqual(1, Job.objects.count())
+        self.assertEqual({self.user.dn: Job.PENDING}, jobs_worker.owner_statuses([self.user.dn]))
+
+        # One job for the owner, then one per device group
+        self.assertEqual(2, jobs_worker.run_pending())
+        self.assertEqual([laptop.dn, phone.dn, tablet.dn], models.LdapDeviceGroup.objects.get().members)
+        self.assertFalse(Job.objects.exists())
+        self.assertEqual({}, jobs_worker.owner_statuses([self.user.dn]))
+
+    @django_test.override_settings(
+        GRANADILLA_ASYNC_PROVISIONING=True,
+        GRANADILLA_JOBS_WORKER_THREAD=False,
+        GRANADILLA_JOBS_MAX_ATTEMPTS=2,
+    )
+    def test_async_provisioning_retries(self):
+        laptop = self.create_device('laptop')
+        models.LdapDeviceGroup(name=self.group.name, group_dn=self.group.dn, members=[laptop.dn]).save()
+        phone = self.create_device('phone')
+
+        with mock.patch.object(models.LdapDeviceGroup, 'add_members', side_effect=ldap.SERVER_DOWN):
+            self.assertEqual(2, jobs_worker.run_pending())
+            job = Job.objects.get()
+            self.assertEqual((Job.PENDING, 1), (job.status, job.attempts))
+            # Retried later
+            self.assertEqual(0, jobs_worker.run_pending())
+            Job.objects.update(run_after=timezone.now())
+            self.assertEqual(1, jobs_worker.run_pending())
+        self.assertEqual(Job.FAILED, Job.objects.get().status)
+        self.assertEqual({self.user.dn: Job.FAILED}, jobs_worker.owner_statuses([self.user.dn]))
+
+        # A new request supersedes the failed job.
+        phone.save()
+        self.assertEqual(2, jobs_worker.run_pending())
+        self.assertEqual([laptop.dn, phone.dn], models.LdapDeviceGroup.objects.get().members)
+        self.assertFalse(Job.objects.exists())
+
+    @django_test.override_settings(GRANADILLA_ASYNC_PROVISIONING=True, GRANADILLA_JOBS_WORKER_THREAD=False)
+    def test_worker_picks_up_queued_jobs(self):
+        laptop = self.create_device('laptop')
+        models.LdapDeviceGroup(name=self.group.name, group_dn=self.group.dn, members=[laptop.dn]).save()
+        phone = self.create_device('phone')
+        # Claimed by a process that stopped before running it
+        Job.objects.update(status=Job.RUNNING, locked_until=timezone.now())
+
+        with django_test.override_settings(GRANADILLA_JOBS_WORKER_THREAD=True):
+            with mock.patch.object(jobs_worker.Worker, 'start'):
+                worker = jobs_worker.start_worker()
+        self.addCleanup(setattr, jobs_worker, '_worker', None)
+        self.assertIsNotNone(worker)
+
+        # First loop of the new thread, without any enqueue() call
+        with mock.patch.object(jobs_worker, 'close_old_connections'):
+            with mock.patch.object(worker.wake, 'wait', side_effect=lambda timeout: worker.stop()):
+                worker.run()
+        self.assertEqual([laptop.dn, phone.dn], models.LdapDeviceGroup.objects.get().members)
+        self.assertFalse(Job.objects.exists())
+
+    def test_resync_cost_independent_of_groups(self):
+        device = models.LdapDevice(
+            owner_dn=self.user.dn,
+            name="laptop",
+            owner_username='jdoe',
+            login='jdoe_laptop',
+        )
+        device.set_password()
+        device.save()
+        device_group = models.LdapDeviceGroup(
+            name=self.group.name,
+            group_dn=self.group.dn,
+        )
+        device_group.init()
+
+        with count_ldap_searches() as few_groups:
+            device_group.resync()
+
+        for i in range(20):
+            models.LdapGroup(gid=2000 + i, name='extra-%d' % i).save()
+
+        with count_ldap_searches() as many_groups:
+            device_group.resync()
+
+        self.assertEqual(few_groups.searches, many_groups.searches)
+        self.assertEqual(few_groups.entries, many_groups.entries)
+        self.assertEqual([device.dn], models.LdapDeviceGroup.objects.get().members)
+
+    def test_sync_device_groups(self):
+        other_user = models.LdapUser(
+            uid=124,
+            first_name="Jane",
+            last_name="Roe",
+            full_name="Jane Roe",
+            home_directory='/home/jroe',
+            email='jane.roe@example.org',
+            group=1234,
+            username='jroe',
+        )
+        other_user.save()
+        other_group = models.LdapGroup(gid=1235, name="other-group", usernames=['jdoe', 'jroe'])
+        other_group.save()
+
+        # Bypass LdapDevice.save(), which would resync on its own.
+        devices = []
+        for owner, login in [(self.user, 'jdoe_laptop'), (other_user, 'jroe_laptop')]:
+            device = models.LdapDevice(owner_dn=owner.dn, name="laptop", owner_username=owner.username, login=login)
+            device.set_password()
+            super(models.LdapDevice, device).save()
+            devices.append(device)
+
+        for group in [self.group, other_group]:
+            models.LdapDeviceGroup(name=group.name, group_dn=group.dn, members=[devices[0].dn]).save()
+
+        with count_ldap_searches() as counter:
+            changed = sync.sync_device_groups()
+
+        self.assertEqual(['other-group'], [dg.name for dg in changed])
+        # 4 bulk searches, then a fetch before the single write.
+        self.assertEqual(5, counter.searches)
+        members = {dg.name: dg.members for dg in models.LdapDeviceGroup.objects.all()}
+        self.assertEqual({
+            'test-group': [devices[0].dn],
+            'other-group': sorted(device.dn for device in devices),
+        }, members)
+
+        # Nothing left to do
+        self.assertEqual([], sync.sync_device_groups())
+
+    def test_device_changes_are_incremental(self):
+        laptop = models.LdapDevice(owner_dn=self.user.dn, name="laptop", owner_username='jdoe', login='jdoe_laptop')
+        laptop.set_password()
+        laptop.save()
+        device_group = models.LdapDeviceGroup(name=self.group.name, group_dn=self.group.dn)
+        device_group.init()
+
+        phone = models.LdapDevice(owner_dn=self.user.dn, name="phone", owner_username='jdoe', login='jdoe_phone')
+        phone.set_password()
+        with count_ldap_searches() as counter:
+            phone.save()
+        # Owner, their groups, the related device groups, and their devices.
+        self.assertEqual(4, counter.searches)
+        self.assertEqual([laptop.dn, phone.dn], models.LdapDeviceGroup.objects.get().members)
+
+        phone.delete()
+        self.assertEqual([laptop.dn], models.LdapDeviceGroup.objects.get().members)
+
+    def test_deluser(self):
+        jroe = models.LdapUser(
+            uid=124, first_name="Jane", last_name="Roe", full_name="Jane Roe", home_directory='/home/jroe',
+            group=1234, username='jroe',
+        )
+        jroe.save()
+        for gid in range(2000, 2010):
+            models.LdapGroup(gid=gid, name='other-%d' % gid, usernames=['jroe']).save()
+        models.LdapGroup(gid=1235, name="ops", usernames=['jdoe', 'jroe']).save()
+
+        devices = []
+        for owner in [self.user, jroe]:
+            device = models.LdapDevice(
+                owner_dn=owner.dn, name="laptop", owner_username=owner.username, login='%s_laptop' % owner.username,
+            )
+            device.set_password()
+            device.save()
+            devices.append(device)
+        models.LdapDeviceGroup(name='ops', group_dn=models.LdapGroup.objects.get(name='ops').dn).init()
+
+        with count_ldap_searches() as counter:
+            cli.CLI().deluser('jdoe')
+        # User, groups, devices, device groups
+        self.assertEqual(4, counter.searches)
+
+        self.assertEqual([], list(models.LdapUser.objects.filter(username='jdoe')))
+        self.assertEqual([devices[1].dn], [device.dn for device in models.LdapDevice.objects.all()])
+        self.assertEqual([devices[1].dn], models.LdapDeviceGroup.objects.get(name='ops').members)
+        self.assertEqual(['jroe'], models.LdapGroup.objects.get(name='ops').usernames)
+        self.assertEqual([], models.memberships.groups_of('jdoe'))
+
     def test_web_view_device(self):
         device = models.LdapDevice(
             owner_dn=self.user.dn,
@@ -297,6 +557,781 @@ class DeviceTests(LdapBasedTestCase):
         self.assertEqual([device.dn, device2.dn], dg.members)
 
 
+class MembershipTests(LdapBasedTestCase):
+    def test_membership_index(self):
+        models.LdapGroup(gid=1234, name="devs", usernames=['jdoe', 'jroe']).save()
+        models.LdapGroup(gid=1235, name="ops", usernames=['jdoe']).save()
+
+        self.assertEqual(['devs', 'ops'], models.memberships.groups_of('jdoe'))
+        with count_ldap_searches() as counter:
+            self.assertEqual(['devs'], models.memberships.groups_of('jroe'))
+            self.assertEqual(['jdoe', 'jroe'], models.memberships.members_of('devs'))
+        self.assertEqual(0, counter.searches)
+
+        # Saving a group invalidates the index
+        ops = models.LdapGroup.objects.get(name='ops')
+        ops.usernames = ['jdoe', 'jroe']
+        ops.save()
+        self.assertEqual(['devs', 'ops'], models.memberships.groups_of('jroe'))
+
+        # So does deleting it
+        ops.delete()
+        self.assertEqual(['devs'], models.memberships.groups_of('jroe'))
+
+    def create_users(self, *usernames):
+        for uid, username in enumerate(usernames, start=100):
+            models.LdapUser(
+                uid=uid,
+                first_name=username,
+                last_name="Doe",
+                full_name="%s Doe" % username,
+                home_directory='/home/%s' % username,
+                group=1234,
+                username=username,
+            ).save()
+
+    def test_bulk_move(self):
+        self.create_users('jdoe', 'jroe', 'aroe')
+        models.LdapGroup(gid=1234, name="devs", usernames=['jdoe', 'jroe', 'aroe']).save()
+        models.LdapGroup(gid=1235, name="ops", usernames=['aroe']).save()
+        pairs = [(username, 'devs') for username in ['jdoe', 'jroe', 'aroe']]
+
+        connection = connections['ldap']
+        with mock.patch.object(connection, 'modify_s', wraps=connection.modify_s) as modify_s:
+            added = provisioning.add_memberships([(username, 'ops') for username, _ in pairs] + [('nobody', 'ops')])
+            removed = provisioning.remove_memberships(pairs[:2])
+        # One modify per group
+        self.assertEqual(2, modify_s.call_count)
+        self.assertEqual({'ops': ['jdoe', 'jroe']}, added.changed)
+        self.assertEqual(['nobody'], added.unknown_users)
+        self.assertEqual({'devs': ['jdoe', 'jroe']}, removed.changed)
+        self.assertEqual(['aroe'], models.LdapGroup.objects.get(name='devs').usernames)
+        self.assertEqual(['devs', 'ops'], models.memberships.groups_of('aroe'))
+        self.assertEqual(['ops'], models.memberships.groups_of('jdoe'))
+
+    def test_bulk_move_devices(self):
+        self.create_users('jdoe', 'jroe')
+        jdoe, jroe = models.LdapUser.objects.get(username='jdoe'), models.LdapUser.objects.get(username='jroe')
+        devices = {}
+        for owner in (jdoe, jroe):
+            device = models.LdapDevice(
+                owner_dn=owner.dn, name="laptop", owner_username=owner.username, login='%s_laptop' % owner.username,
+            )
+            device.set_password()
+            device.save()
+            devices[owner.username] = device.dn
+        group = models.LdapGroup(gid=1234, name="devs", usernames=['jroe'])
+        group.save()
+        models.LdapDeviceGroup(name="devs-vpn", group_dn=group.dn, members=[devices['jroe']]).save()
+
+        # Only the moved users' devices are looked up: no full resync.
+        with mock.patch.object(sync, 'sync_device_groups') as sync_device_groups:
+            provisioning.add_memberships([('jdoe', 'devs')])
+            self.assertEqual(
+                sorted(devices.values()), sorted(models.LdapDeviceGroup.objects.get(name='devs-vpn').members),
+            )
+            provisioning.remove_memberships([('jdoe', 'devs')])
+            self.assertEqual([devices['jroe']], models.LdapDeviceGroup.objects.get(name='devs-vpn').members)
+        sync_device_groups.assert_not_called()
+
+    @django_test.override_settings(GRANADILLA_USE_ACLS=True)
+    def test_bulk_acls(self):
+        cli.CLI().init()
+        self.create_users('jdoe', 'jroe')
+        models.LdapGroup(gid=1234, name="devs", usernames=[]).save()
+        jdoe, jroe = models.LdapUser.objects.get(username='jdoe'), models.LdapUser.objects.get(username='jroe')
+
+        with replace_stdin('jdoe,devs\n# comment\njroe,devs\n'):
+            cli.CLI().bulk_addusergroup('-')
+        self.assertEqual(sorted([jdoe.dn, jroe.dn]), sorted(models.LdapAcl.objects.get(name='devs').members))
+
+        cli.CLI().delusergroup('jdoe', 'devs')
+        self.assertEqual([jroe.dn], models.LdapAcl.objects.get(name='devs').members)
+        cli.CLI().delusergroup('jroe', 'devs')
+        self.assertEqual([], list(models.LdapAcl.objects.filter(name='devs')))
+        self.assertEqual([], models.LdapGroup.objects.get(name='devs').usernames)
+
+
+class BatchShellTests(LdapBasedTestCase):
+    def test_batch(self):
+        commands = '\n'.join([
+            'addgroup devs',
+            '# comment',
+            '["catgroup", "devs"]',
+            'adduser "John Doe"',
+            'catgroup nogroup',
+            'bogus',
+            '["unterminated',
+        ])
+        output = io.StringIO()
+        with replace_stdin(commands + '\n'), contextlib.redirect_stdout(output):
+            status = cli.CLI().main(['granadilla-admin', 'shell', '--batch'])
+        self.assertEqual(1, status)
+
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([1, 3, 4, 5, 6, 7], [result['line'] for result in results])
+        self.assertEqual([0, 0, 1, 2, 1, 1], [result['status'] for result in results])
+        self.assertIn('cn: devs\n', results[1]['output'])
+        self.assertEqual(['adduser', 'John Doe'], results[2]['command'])
+        self.assertIn("batch mode", results[2]['errors'])
+        self.assertEqual("The requested group does not exist.\n", results[3]['errors'])
+        self.assertNotIn('\x1b', output.getvalue())
+
+
+class EntryCacheTests(LdapBasedTestCase):
+    def setUp(self):
+        super(EntryCacheTests, self).setUp()
+        for uid, username in enumerate(['jdoe', 'jroe'], start=100):
+            models.LdapUser(
+                uid=uid,
+                first_name="John",
+                last_name="Doe",
+                full_name="John Doe",
+                home_directory='/home/%s' % username,
+                group=1234,
+                username=username,
+            ).save()
+        models.entry_cache.hits = models.entry_cache.misses = 0
+
+    def test_read_through(self):
+        user = models.LdapUser.objects.cached(pk='jdoe')
+        with count_ldap_searches() as counter:
+            self.assertEqual(user.dn, models.LdapUser.objects.cached(pk='jdoe').dn)
+            self.assertEqual('jdoe', models.LdapUser.objects.cached(dn=user.dn).username)
+        self.assertEqual(0, counter.searches)
+        self.assertEqual({'hits': 2, 'misses': 1}, {
+            key: value for key, value in models.entry_cache.stats().items() if key in ('hits', 'misses')
+        })
+
+        with self.assertRaises(models.LdapUser.DoesNotExist):
+            models.LdapUser.objects.cached(pk='nobody')
+
+    def test_invalidation(self):
+        user = models.LdapUser.objects.cached(pk='jdoe')
+        user.mobile_phone = '+336'
+        user.save()
+        self.assertEqual('+336', models.LdapUser.objects.cached(pk='jdoe').mobile_phone)
+
+        group = models.LdapGroup(gid=1234, name="devs", usernames=['jdoe'])
+        group.save()
+        models.LdapGroup.objects.cached(pk='devs')
+        models.modify_values(group, 'usernames', added=['jroe'])
+        self.assertEqual(['jdoe', 'jroe'], models.LdapGroup.objects.cached(pk='devs').usernames)
+
+        group.delete()
+        with self.assertRaises(models.LdapGroup.DoesNotExist):
+            models.LdapGroup.objects.cached(pk='devs')
+
+    def test_writes_use_current_entries(self):
+        user = models.LdapUser.objects.cached(pk='jdoe')
+        # Changed by another process: the cached copy is stale.
+        connections['ldap'].modify_s(user.dn, [(ldap.MOD_REPLACE, 'sn', [b'Roe'])])
+
+        admin = auth_models.User.objects.create(username='admin', is_superuser=True)
+        admin.set_password('MAGIC!')
+        admin.save()
+        self.client.login(username='admin', password='MAGIC!')
+        response = self.client.post(reverse('granadilla:user', args=('jdoe',)), {
+            'phone': '+331', 'mobile_phone': '', 'internal_phone': '',
+        })
+        self.assertEqual(302, response.status_code)
+
+        user = models.LdapUser.objects.get(pk='jdoe')
+        self.assertEqual(('Roe', '+331'), (user.last_name, user.phone))
+
+    @django_test.override_settings(GRANADILLA_ENTRY_CACHE_SIZE=2)
+    def test_lru_eviction(self):
+        models.LdapUser.objects.cached(pk='jdoe')
+        models.LdapUser.objects.cached(pk='jroe')
+        with count_ldap_searches() as counter:
+            models.LdapUser.objects.cached(pk='jroe')
+            models.LdapUser.objects.cached(pk='jdoe')
+        # jdoe was evicted when jroe was stored
+        self.assertEqual(1, counter.searches)
+
+
+@django_test.override_settings(GRANADILLA_REPLICA_ENABLED=True)
+class ReplicaTests(LdapBasedTestCase):
+    def setUp(self):
+        super(ReplicaTests, self).setUp()
+        self.user = models.LdapUser(
+            uid=100,
+            first_name="John",
+            last_name="Doe",
+            full_name="John Doe",
+            home_directory='/home/jdoe',
+            group=1234,
+            username='jdoe',
+        )
+        self.user.save()
+        models.LdapGroup(gid=1234, name="devs", usernames=['jdoe']).save()
+        self.addCleanup(replica.replica.clear)
+        self.addCleanup(replica.replica.stop)
+
+    def test_served_without_searches(self):
+        # Not started: reads go to LDAP
+        self.assertFalse(replica.replica.serves(models.LdapUser))
+        self.assertIsNone(replica.replica._consumer)
+
+        replica.replica.refresh()
+        with count_ldap_searches() as counter:
+            self.assertEqual(self.user.dn, models.LdapUser.objects.cached(pk='jdoe').dn)
+            self.assertEqual(['devs'], models.memberships.groups_of('jdoe'))
+            with self.assertRaises(models.LdapUser.DoesNotExist):
+                models.LdapUser.objects.cached(pk='nobody')
+        self.assertEqual(0, counter.searches)
+
+        # Local writes are read from LDAP until the replica gets them.
+        self.user.mobile_phone = '+336'
+        self.user.save()
+        self.assertFalse(replica.replica.serves(models.LdapUser))
+        self.assertEqual('+336', models.LdapUser.objects.cached(pk='jdoe').mobile_phone)
+        replica.replica.refresh()
+        self.assertTrue(replica.replica.serves(models.LdapUser))
+        self.assertEqual('+336', models.LdapUser.objects.cached(pk='jdoe').mobile_phone)
+
+    def test_incremental_polling(self):
+        store = replica.Replica()
+        store.refresh()
+        memo = store.memoized('test', lambda store: object())
+
+        search = replica.Replica._search
+        with mock.patch.object(replica.Replica, '_search', side_effect=search) as spy:
+            store.refresh()
+        # Only modified entries are fetched in full, others are only listed.
+        for call in spy.call_args_list:
+            _conn, _base, filterstr, attrlist = call[0]
+            self.assertTrue(filterstr.startswith('(modifyTimestamp>=') or attrlist == ['entryUUID'])
+        # Nothing changed: values derived from the entries are kept.
+        self.assertIs(memo, store.memoized('test', lambda store: object()))
+
+        models.LdapGroup.objects.get(name='devs').delete()
+        store.refresh()
+        self.assertEqual([], store.all(models.LdapGroup))
+        self.assertEqual(['jdoe'], [entry.pk for entry in store.all(models.LdapUser)])
+        self.assertIsNot(memo, store.memoized('test', lambda store: object()))
+
+    def test_syncrepl_messages(self):
+        store = replica.Replica()
+        conn = replica.SyncreplConnection(self.ldap_server.uri, replica=store)
+        conn.refresh_started = store.start_refresh()
+        uuid = '0b7a2a86-5a3e-103b-8b2f-c5d3b8f2b9a1'
+        conn.syncrepl_entry(self.user.dn, {
+            'objectClass': [b'posixAccount', b'shadowAccount', b'inetOrgPerson'],
+            'uid': [b'jdoe'],
+            'uidNumber': [b'100'],
+            'jpegPhoto': [b'\xff\xd8\xff\xe0JFIF'],
+        }, uuid)
+        conn.syncrepl_refreshdone()
+        self.assertTrue(store.ready.is_set())
+        self.assertEqual(100, store.get(models.LdapUser, pk='jdoe').instance().uid)
+        # Only the digest of the photo is kept.
+        entry = store.get(models.LdapUser, pk='jdoe')
+        self.assertNotIn('jpegphoto', entry.attrs)
+        self.assertEqual(photos.photo_digest(b'\xff\xd8\xff\xe0JFIF'), entry.photo_digest)
+        self.assertTrue(entry.has('photo'))
+        self.assertIn('photo', entry.instance().get_deferred_fields())
+        self.assertEqual(self.user.dn, store.get(models.LdapUser, dn=self.user.dn).instance().dn)
+
+        conn.syncrepl_delete([uuid])
+        self.assertIsNone(store.get(models.LdapUser, pk='jdoe'))
+
+    def test_entry_model(self):
+        attrs = {'objectclass': [b'posixAccount', b'shadowAccount', b'inetOrgPerson']}
+        users_dn = settings.GRANADILLA_USERS_DN
+        self.assertIs(models.LdapUser, replica.entry_model('uid=doe\\, john,%s' % users_dn, attrs))
+        self.assertIsNone(replica.entry_model('uid=jdoe,ou=a\\,b,%s' % users_dn, attrs))
+
+    @django_test.override_settings(GRANADILLA_REPLICA_POLL_INTERVAL=60)
+    def test_polling_fallback(self):
+        # The test server has no syncprov overlay: the sync control is rejected.
+        replica.replica.ensure_started()
+        self.assertTrue(replica.replica.ready.wait(timeout=10))
+        self.assertTrue(replica.replica._consumer.polling)
+        self.assertEqual('jdoe', models.LdapUser.objects.cached(pk='jdoe').username)
+
+
+class ConnectionPoolTests(LdapBasedTestCase):
+    def setUp(self):
+        super(ConnectionPoolTests, self).setUp()
+        connections['ldap'].close()
+        self.pool = connections['ldap'].get_pool()
+        self.pool.clear()
+        self.pool.counters = dict.fromkeys(self.pool.counters, 0)
+
+    def test_reuse(self):
+        for _request in range(3):
+            list(models.LdapGroup.objects.all())
+            connections['ldap'].close()
+        stats = self.pool.stats()
+        self.assertEqual((1, 2, 1, 0), (stats['created'], stats['reused'], stats['idle'], stats['in_use']))
+
+    @django_test.override_settings(GRANADILLA_LDAP_POOL_MAX_AGE=0)
+    def test_recycling(self):
+        list(models.LdapGroup.objects.all())
+        connections['ldap'].close()
+        self.assertEqual({'created': 1, 'recycled': 1, 'idle': 0}, {
+            key: value for key, value in self.pool.stats().items() if key in ('created', 'recycled', 'idle')
+        })
+
+    @django_test.override_settings(GRANADILLA_LDAP_POOL_CHECK_INTERVAL=-1)
+    def test_health_check(self):
+        with pool.borrow('ldap') as broken:
+            broken.whoami_s = mock.Mock(side_effect=ldap.SERVER_DOWN)
+        with pool.borrow('ldap') as connection:
+            self.assertIsNot(broken, connection)
+            self.assertTrue(connection.whoami_s())
+        stats = self.pool.stats()
+        self.assertEqual((2, 1), (stats['created'], stats['failed_checks']))
+
+
+class GroupViewTests(LdapBasedTestCase):
+    def setUp(self):
+        super(GroupViewTests, self).setUp()
+        names = [('jdoe', "John", "Doe"), ('aroe', "Anna", "Roe"), ('bdoe', "Bob", "Doe")]
+        for uid, (username, first_name, last_name) in enumerate(names, start=100):
+            models.LdapUser(
+                uid=uid,
+                first_name=first_name,
+                last_name=last_name,
+                full_name="%s %s" % (first_name, last_name),
+                home_directory='/home/%s' % username,
+                group=1234,
+                username=username,
+                mobile_phone='+3360000%04d' % uid,
+            ).save()
+        models.LdapGroup(gid=1234, name="staff", usernames=[username for username, _f, _l in names]).save()
+
+        viewer = auth_models.User.objects.create(username='viewer')
+        viewer.set_password('secret')
+        viewer.save()
+        self.client.login(username='viewer', password='secret')
+
+    def test_paginated_members(self):
+        url = reverse('granadilla:group', args=('staff',))
+        with mock.patch.object(views.GroupView, 'paginate_by', 2):
+            response = self.client.get(url)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(['bdoe', 'jdoe'], [member.username for member in response.context['members']])
+            self.assertTrue(response.context['is_paginated'])
+            self.assertContains(response, '+33600000100')
+
+            response = self.client.get(url, {'page': 2})
+            self.assertEqual(['aroe'], [member.username for member in response.context['members']])
+
+    def test_index(self):
+        with django_test.override_settings(GRANADILLA_USERS_GROUP='staff'):
+            response = self.client.get(reverse('granadilla:index'))
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.context['home'])
+        self.assertEqual(['bdoe', 'jdoe', 'aroe'], [member.username for member in response.context['members']])
+
+    def test_printable_members(self):
+        response = self.client.get(reverse('granadilla:group_print', args=('staff',)))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['bdoe', 'jdoe', 'aroe'], [member.username for member in response.context['members']])
+        self.assertFalse(response.context['is_paginated'])
+
+    def test_vcards_export(self):
+        with count_ldap_searches() as counter:
+            response = self.client.get(reverse('granadilla:group_cards', args=('staff',)))
+            content = b''.join(response.streaming_content)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, content.count(b'BEGIN:VCARD'))
+        self.assertIn(b'FN:Anna Roe', content)
+        self.assertIn(b'TEL;TYPE=CELL:+33600000101', content)
+        self.assertFalse(any('jpegPhoto' in attrlist for attrlist in counter.attrlists))
+
+        response = self.client.get(reverse('granadilla:group_cards', args=('nope',)))
+        self.assertEqual(404, response.status_code)
+
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with mock.patch('sys.stdout', stdout):
+            cli.CLI().group_vcards('staff')
+        self.assertEqual(content, stdout.buffer.getvalue())
+
+    def test_print_exports(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        settings_override = django_test.override_settings(GRANADILLA_EXPORT_CACHE_DIR=cache_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        url = reverse('granadilla:group_print_export', args=('staff', 'csv'))
+        with count_ldap_searches() as counter:
+            content = b''.join(self.client.get(url).streaming_content)
+        lines = content.decode('utf-8').splitlines()
+        self.assertEqual(['bdoe', 'jdoe', 'aroe'], [line.split(',')[0] for line in lines[1:]])
+        self.assertIn('aroe,Anna Roe,,+33600000101,', lines)
+        self.assertFalse(any('jpegPhoto' in attrlist for attrlist in counter.attrlists))
+
+        # Unchanged: served from disk, after a search of the modification times.
+        with count_ldap_searches() as counter:
+            self.assertEqual(content, b''.join(self.client.get(url).streaming_content))
+        self.assertEqual(1, counter.searches)
+
+        group = models.LdapGroup.objects.get(name='staff')
+        group.usernames = ['aroe', 'jdoe']
+        group.save()
+        content = b''.join(self.client.get(url).streaming_content)
+        self.assertEqual(3, len(content.splitlines()))
+        self.assertEqual(1, len(os.listdir(cache_dir.name)))
+
+        # Headers are translated: one file per language
+        with translation.override('fr'):
+            french = b''.join(self.client.get(url).streaming_content)
+        self.assertIn('téléphone interne', french.decode('utf-8').splitlines()[0])
+        self.assertEqual(content, b''.join(self.client.get(url).streaming_content))
+        self.assertEqual(2, len(os.listdir(cache_dir.name)))
+
+        response = self.client.get(reverse('granadilla:group_print_export', args=('staff', 'pdf')))
+        self.assertEqual('application/pdf', response['Content-Type'])
+        content = b''.join(response.streaming_content)
+        self.assertTrue(content.startswith(b'%PDF-'))
+        self.assertTrue(content.endswith(b'%%EOF\n'))
+
+    def test_phonebook_deltas(self):
+        url = reverse('granadilla:group_phonebook', args=('staff', 'json'))
+        full = self.client.get(url).json()
+        self.assertEqual(['aroe', 'bdoe', 'jdoe'], [member['username'] for member in full['members']])
+        self.assertEqual('+33600000101', full['members'][0]['mobile_phone'])
+        self.assertIsNone(full['members'][0]['photo'])
+        version = full['version']
+
+        # Unchanged: an empty delta, or nothing at all with the ETag.
+        response = self.client.get(url, {'since': version})
+        self.assertEqual({'version': version, 'since': version, 'changed': [], 'removed': []}, response.json())
+        response = self.client.get(url, {'since': version}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+
+        user = models.LdapUser.objects.get(username='aroe')
+        user.photo = b'\xff\xd8\xff\xe0JFIF'
+        user.save()
+        group = models.LdapGroup.objects.get(name='staff')
+        group.usernames = ['aroe', 'bdoe']
+        group.save()
+
+        delta = self.client.get(url, {'since': version}).json()
+        self.assertNotEqual(version, delta['version'])
+        self.assertEqual(['aroe'], [member['username'] for member in delta['changed']])
+        self.assertEqual(photos.photo_digest(user.photo), delta['changed'][0]['photo'])
+        self.assertEqual(['jdoe'], delta['removed'])
+
+        # Unknown versions get the full phonebook.
+        self.assertEqual(2, len(self.client.get(url, {'since': 'unknown'}).json()['members']))
+        self.assertEqual(404, self.client.get(reverse('granadilla:group_phonebook', args=('nope', 'json'))).status_code)
+
+
+class SearchTests(LdapBasedTestCase):
+    def setUp(self):
+        super(SearchTests, self).setUp()
+        names = [('jdoe', "John", "Doe"), ('bdoe', "Bob", "Doe"), ('ezola', "Émile", "Zola")]
+        for uid, (username, first_name, last_name) in enumerate(names, start=100):
+            self.create_user(uid, username, first_name, last_name)
+        search.directory_index.clear()
+        self.addCleanup(search.directory_index.clear)
+
+        viewer = auth_models.User.objects.create(username='viewer')
+        viewer.set_password('secret')
+        viewer.save()
+        self.client.login(username='viewer', password='secret')
+
+    def create_user(self, uid, username, first_name, last_name):
+        user = models.LdapUser(
+            uid=uid,
+            first_name=first_name,
+            last_name=last_name,
+            full_name="%s %s" % (first_name, last_name),
+            home_directory='/home/%s' % username,
+            group=1234,
+            username=username,
+            mobile_phone='+33 6 00 00 %04d' % uid,
+        )
+        user.save()
+        return user
+
+    def query(self, text):
+        response = self.client.get(reverse('granadilla:search_json'), {'q': text})
+        self.assertEqual(200, response.status_code)
+        return [result['username'] for result in response.json()['results']]
+
+    def test_search(self):
+        self.assertEqual(['bdoe', 'jdoe'], self.query('doe'))
+        with count_ldap_searches() as counter:
+            self.assertEqual(['ezola'], self.query('EMILE'))
+            self.assertEqual(['jdoe'], self.query('jhon do'))
+            self.assertEqual(['ezola'], self.query('0102'))
+            self.assertEqual([], self.query('nobody'))
+        self.assertEqual(0, counter.searches)
+
+        response = self.client.get(reverse('granadilla:search'), {'q': 'zola'})
+        self.assertContains(response, reverse('granadilla:user', args=['ezola']))
+
+    def test_incremental_refresh(self):
+        self.assertEqual([], self.query('roe'))
+        user = self.create_user(103, 'aroe', "Anna", "Roe")
+        with count_ldap_searches() as counter:
+            self.assertEqual(['aroe'], self.query('roe'))
+        self.assertEqual(1, counter.searches)
+
+        user.delete()
+        self.assertEqual([], self.query('roe'))
+
+        # Changes made by other processes are picked up periodically.
+        with mock.patch.object(search.directory_index, 'mark_dirty'):
+            self.create_user(104, 'jroe', "Jane", "Roe")
+        self.assertEqual([], self.query('roe'))
+        with django_test.override_settings(GRANADILLA_SEARCH_REFRESH_INTERVAL=-1):
+            self.assertEqual(['jroe'], self.query('roe'))
+
+    @django_test.override_settings(GRANADILLA_REPLICA_ENABLED=True)
+    def test_replica_changes(self):
+        self.addCleanup(replica.replica.clear)
+        replica.replica.refresh()
+        with count_ldap_searches() as counter:
+            self.assertEqual(['bdoe', 'jdoe'], self.query('doe'))
+        self.assertEqual(0, counter.searches)
+        index = search.directory_index._replica_index
+
+        # Changes received by the replica are applied to the same index.
+        user = self.create_user(103, 'aroe', "Anna", "Roe")
+        replica.replica.refresh()
+        self.assertEqual(['aroe'], self.query('roe'))
+        user.full_name = "Anna Doe"
+        user.save()
+        replica.replica.refresh()
+        self.assertEqual(['aroe', 'bdoe', 'jdoe'], [result['username'] for result in self.complete('doe')])
+        user.delete()
+        replica.replica.refresh()
+        self.assertEqual([], self.query('roe'))
+        self.assertIs(index, search.directory_index._replica_index)
+
+    def complete(self, text, limit=10):
+        response = self.client.get(reverse('granadilla:autocomplete_json'), {'q': text, 'limit': limit})
+        self.assertEqual(200, response.status_code)
+        return response.json()['results']
+
+    def test_autocomplete(self):
+        self.assertEqual(['bdoe', 'jdoe'], [result['username'] for result in self.complete('do')])
+        with count_ldap_searches() as counter:
+            self.assertEqual([{
+                'username': 'ezola',
+                'full_name': "Émile Zola",
+                'phone': '',
+                'mobile_phone': '+33 6 00 00 0102',
+                'internal_phone': '',
+            }], self.complete('emile z'))
+            # National and international forms of phone numbers
+            self.assertEqual(['jdoe', 'bdoe'], [result['username'] for result in self.complete('06 00 00 01', limit=2)])
+            self.assertEqual(['ezola'], [result['username'] for result in self.complete('+336000001 02')])
+            self.assertEqual([], self.complete('z0'))
+        self.assertEqual(0, counter.searches)
+
+    def test_autocomplete_updates(self):
+        self.assertEqual([], self.complete('roe'))
+        user = self.create_user(103, 'aroe', "Anna", "Roe")
+        self.assertEqual(['aroe'], [result['username'] for result in self.complete('roe')])
+        user.full_name = "Anna Doe"
+        user.save()
+        self.assertEqual([], self.complete('roe'))
+        self.assertEqual(['aroe', 'bdoe', 'jdoe'], [result['username'] for result in self.complete('doe')])
+
+
+class ProjectionTests(LdapBasedTestCase):
+    def setUp(self):
+        super(ProjectionTests, self).setUp()
+        for uid, username in enumerate(['zed', 'amy'], start=100):
+            user = models.LdapUser(
+                uid=uid,
+                first_name=username.title(),
+                last_name="Smith",
+                full_name="%s Smith" % username.title(),
+                home_directory='/home/%s' % username,
+                group=1234,
+                username=username,
+            )
+            if username == 'amy':
+                user.photo = b'\xff\xd8\xff\xe0JFIF'
+            user.save()
+
+    def test_only_restricts_attributes(self):
+        with count_ldap_searches() as counter:
+            users = list(models.LdapUser.objects.order_by('username').only('username', 'email'))
+        self.assertEqual(['amy', 'zed'], [user.username for user in users])
+        self.assertEqual(1, counter.searches)
+        self.assertEqual({'uid', 'mail'}, set(counter.attrlists[0]))
+
+        # Deferred fields are fetched on access
+        self.assertEqual("Amy", users[0].first_name)
+
+    def test_defer_and_save(self):
+        user = models.LdapUser.objects.defer('photo').get(username='amy')
+        user.email = 'amy@example.org'
+        user.save()
+
+        user = models.LdapUser.objects.get(username='amy')
+        self.assertEqual('amy@example.org', user.email)
+        self.assertEqual(b'\xff\xd8\xff\xe0JFIF', user.photo)
+
+    def test_photo_presence(self):
+        amy = models.LdapUser.objects.get(username='amy')
+        with count_ldap_searches() as counter:
+            self.assertEqual({amy.dn}, models.LdapUser.objects.dns_with('photo'))
+        self.assertEqual([['1.1']], counter.attrlists)
+
+
+def make_jpeg(size):
+    output = io.BytesIO()
+    Image.new('RGB', (size, size), color=(200, 100, 50)).save(output, format='JPEG')
+    return output.getvalue()
+
+
+class PhotoTests(LdapBasedTestCase):
+    def setUp(self):
+        super(PhotoTests, self).setUp()
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        settings_override = django_test.override_settings(GRANADILLA_PHOTO_CACHE_DIR=cache_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = models.LdapUser(
+            uid=123,
+            first_name="John",
+            last_name="Doe",
+            full_name="John Doe",
+            home_directory='/home/jdoe',
+            group=1234,
+            username='jdoe',
+            photo=make_jpeg(512),
+        )
+        self.user.set_password('yay')
+        self.user.save()
+        self.client.login(username='jdoe', password='yay')
+
+    def test_thumbnail(self):
+        url = reverse('granadilla:photo', args=('jdoe',))
+        response = self.client.get(url, {'size': 'thumbnail'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual((128, 128), Image.open(io.BytesIO(response.content)).size)
+        etag = response['ETag']
+
+        # Only the modification time is fetched
+        with count_ldap_searches() as counter:
+            response = self.client.get(url, {'size': 'thumbnail'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual([['modifyTimestamp']], counter.attrlists)
+
+        # Known variants are served from disk
+        with count_ldap_searches() as counter:
+            response = self.client.get(url, {'size': 'thumbnail'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(etag, response['ETag'])
+        self.assertEqual([['modifyTimestamp']], counter.attrlists)
+
+        # The full-size photo has another tag
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.user.photo, response.content)
+
+        response = self.client.get(url, {'size': 'huge'})
+        self.assertEqual(404, response.status_code)
+
+    def test_upload_generates_variants(self):
+        new_photo = make_jpeg(256)
+        form = forms.LdapUserForm(
+            {'phone': '', 'mobile_phone': '', 'internal_phone': ''},
+            {'new_photo': SimpleUploadedFile('me.jpg', new_photo, content_type='image/jpeg')},
+            instance=models.LdapUser.objects.get(username='jdoe'),
+        )
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+
+        digest = photos.photo_digest(new_photo)
+        modified = models.LdapUser.objects.filter(pk='jdoe').modify_timestamps()
+        self.assertEqual(digest, photos.store.known_digest('jdoe', modified[self.user.dn]))
+        self.assertIsNotNone(photos.store.read(digest, 'thumbnail'))
+
+    def test_last_modified(self):
+        url = reverse('granadilla:photo', args=('jdoe',))
+        response = self.client.get(url)
+        self.assertEqual('private, no-cache', response['Cache-Control'])
+        last_modified = response['Last-Modified']
+        etag = response['ETag']
+
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(304, response.status_code)
+
+        # A new photo invalidates the old tag
+        form = forms.LdapUserForm(
+            {'phone': '', 'mobile_phone': '', 'internal_phone': ''},
+            {'new_photo': SimpleUploadedFile('me.jpg', make_jpeg(256), content_type='image/jpeg')},
+            instance=models.LdapUser.objects.get(username='jdoe'),
+        )
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+
+        response = self.client.get(reverse('granadilla:photo', args=('nobody',)))
+        self.assertEqual(404, response.status_code)
+
+    def test_versioned_url(self):
+        group = models.LdapGroup(name='test', gid=1000, usernames=['jdoe'])
+        group.save()
+        # Unknown digest: plain URL
+        response = self.client.get(reverse('granadilla:group', args=('test',)))
+        member, = response.context['members']
+        self.assertEqual(reverse('granadilla:photo', args=('jdoe',)) + '?size=thumbnail', member.photo_url)
+
+        self.client.get(member.photo_url)
+        response = self.client.get(reverse('granadilla:group', args=('test',)))
+        member, = response.context['members']
+        self.assertIn('v=%s' % photos.photo_digest(self.user.photo), member.photo_url)
+
+        response = self.client.get(member.photo_url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('private, max-age=31536000, immutable', response['Cache-Control'])
+
+
+class VCardTests(django_test.SimpleTestCase):
+    def test_render(self):
+        card = vcard.VCard()
+        card['full_name'] = "Doe, John; Jr.\\"
+        card['names'] = [["John"], ["Doe"], [], [], []]
+        card['cell'] = '+336'
+        card['email'] = ''
+        self.assertEqual(
+            b'BEGIN:VCARD\r\nVERSION:3.0\r\n'
+            b'FN:Doe\\, John\\; Jr.\\\\\r\nN:John;Doe;;;\r\nTEL;TYPE=CELL:+336\r\n'
+            b'END:VCARD',
+            card.render_bytes(),
+        )
+
+    def test_render_many(self):
+        cards = []
+        for name in ["Anna", "Bob", "Émile"]:
+            card = vcard.VCard()
+            card['full_name'] = name
+            cards.append(card)
+        chunks = list(vcard.render_many(cards, batch_size=2))
+        self.assertEqual(2, len(chunks))
+        self.assertEqual(b''.join(card.render_bytes() + b'\r\n' for card in cards), b''.join(chunks))
+
+
+class CliStartupTests(django_test.SimpleTestCase):
+    def test_help_without_django(self):
+        script = (
+            "import sys; from granadilla import cli; cli.CLI().main(['granadilla-admin', 'help']); "
+            "print(sorted(name for name in sys.modules if name.split('.')[0] in ('django', 'ldap', 'ldapdb')))"
+        )
+        env = dict(os.environ)
+        env.pop('DJANGO_SETTINGS_MODULE', None)
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=settings.CHECKOUT_DIR, env=env)
+        self.assertIn(b'adduser <username>', output)
+        self.assertTrue(output.endswith(b'[]\n'))
+
+
 class UserTests(LdapBasedTestCase):
     def test_cli_adduser(self):
         lines = [
@@ -316,3 +1351,177 @@ class UserTests(LdapBasedTestCase):
         self.assertEqual("Doe", user.last_name)
         self.assertIsNotNone(user.samba_ntpassword)
         self.assertEqual('', user.samba_lmpassword)
+
+    def test_cli_ndjson_listing(self):
+        for uid, username in enumerate(['jdoe', 'jroe'], start=100):
+            models.LdapUser(
+                uid=uid,
+                first_name="John",
+                last_name="Doe",
+                full_name="John Doe",
+                home_directory='/home/%s' % username,
+                group=1234,
+                username=username,
+            ).save()
+
+        output = io.StringIO()
+        with count_ldap_searches() as counter, contextlib.redirect_stdout(output):
+            cli.CLI().lsuser('--format=ndjson', '--fields=username,uid')
+        self.assertEqual([['uid', 'uidNumber']], counter.attrlists)
+        records = sorted((json.loads(line) for line in output.getvalue().splitlines()), key=lambda r: r['uid'])
+        self.assertEqual([{'username': 'jdoe', 'uid': 100}, {'username': 'jroe', 'uid': 101}], records)
+
+        # Entries are yielded as each page arrives
+        original_result3 = ldap.ldapobject.SimpleLDAPObject.result3
+        with mock.patch.object(connections['ldap'], 'page_size', 1), mock.patch.object(
+            ldap.ldapobject.SimpleLDAPObject, 'result3', autospec=True, side_effect=original_result3,
+        ) as result3:
+            entries = models.LdapUser.objects.entries('username')
+            usernames = [next(entries)[1]['username']]
+            self.assertEqual(1, result3.call_count)
+            usernames.extend(values['username'] for _dn, values in entries)
+            self.assertEqual(['jdoe', 'jroe'], sorted(usernames))
+            self.assertGreaterEqual(result3.call_count, 2)
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(1, cli.CLI().lsgroups('--format=xml'))
+            self.assertEqual(1, cli.CLI().lsgroups('--format=ndjson', '--fields=name,nope'))
+            # Text output has a fixed layout
+            self.assertEqual(1, cli.CLI().lsgroups('--fields=name'))
+
+
+class IdAllocationTests(LdapBasedTestCase):
+    def create_user(self, username, uid):
+        models.LdapUser(
+            uid=uid,
+            first_name="John",
+            last_name="Doe",
+            full_name="John Doe",
+            home_directory='/home/%s' % username,
+            group=1234,
+            username=username,
+        ).save()
+
+    def test_without_pool(self):
+        self.create_user('jdoe', 10100)
+        with count_ldap_searches() as counter:
+            self.assertEqual(10101, ids.allocate('uid'))
+        self.assertEqual([['uidNumber']], counter.attrlists)
+        # The "test" group was created by init
+        self.assertEqual(10001, ids.allocate('gid'))
+
+    @django_test.override_settings(GRANADILLA_ID_POOL_NAME='NextFreeUnixId')
+    def test_pool(self):
+        self.create_user('jdoe', 10100)
+        pool = ids.create_pool()
+        self.assertEqual((10101, 10001), (pool.uid, pool.gid))
+
+        self.assertEqual(10101, ids.allocate('uid'))
+        self.assertEqual(10102, ids.allocate('uid'))
+        self.assertEqual(10001, ids.allocate('gid'))
+
+        # Ids assigned behind the pool's back are skipped
+        self.create_user('jroe', 10103)
+        self.assertEqual(10104, ids.allocate('uid'))
+
+    @django_test.override_settings(GRANADILLA_ID_POOL_NAME='NextFreeUnixId')
+    def test_concurrent_allocation(self):
+        ids.create_pool()
+        connection = connections['ldap']
+        original_modify_s = connection.modify_s
+        concurrent = []
+
+        def modify_s(dn, modlist):
+            if concurrent == []:
+                # Another process takes the id between our read and our write.
+                concurrent.append(None)
+                concurrent[0] = ids.allocate('uid')
+            return original_modify_s(dn, modlist)
+
+        with mock.patch.object(connection, 'modify_s', modify_s):
+            allocated = ids.allocate('uid')
+        self.assertEqual([10000], concurrent)
+        self.assertEqual(10001, allocated)
+
+    @django_test.override_settings(GRANADILLA_ID_POOL_NAME='NextFreeUnixId')
+    def test_allocate_block(self):
+        ids.create_pool()
+        self.create_user('jdoe', 10001)
+        self.assertEqual([10000, 10002, 10003], ids.allocate_block('uid', 3))
+        self.assertEqual(10004, ids.allocate('uid'))
+
+
+class BulkUserTests(LdapBasedTestCase):
+    def test_bulk_adduser(self):
+        models.LdapUser(
+            uid=10000,
+            first_name="John",
+            last_name="Doe",
+            full_name="John Doe",
+            home_directory='/home/jdoe',
+            group=1234,
+            username='jdoe',
+        ).save()
+        csv_text = '\n'.join([
+            'username,first_name,last_name,mobile_phone,password',
+            'aroe,Anna,Roe,+336123,',
+            'jdoe,John,Doe,,',
+            'bdoe,Bob,,,',
+            'cdoe,Carl,Doe,,carl',
+            'aroe,Anna,Roe,,',
+            'edoe,Émile,Doe,,this password is amazing!',
+        ])
+
+        stdout = io.StringIO()
+        with replace_stdin(csv_text), mock.patch('sys.stdout', stdout):
+            cli.CLI().bulk_adduser('-')
+
+        self.assertIn("2 users created, 4 failed", stdout.getvalue())
+        aroe = models.LdapUser.objects.get(username='aroe')
+        self.assertEqual("Anna Roe", aroe.full_name)
+        self.assertEqual('+336123', aroe.mobile_phone)
+        self.assertEqual('/home/aroe', aroe.home_directory)
+        self.assertEqual(models.LdapGroup.objects.get(name=settings.GRANADILLA_USERS_GROUP).gid, aroe.group)
+        self.assertEqual(10001, aroe.uid)
+        # Generated passwords are reported.
+        password = re.search(r'1: aroe: created .*, password: (\w+)', stdout.getvalue()).group(1)
+        self.assertTrue(aroe.check_password(password))
+        edoe_line, = [line for line in stdout.getvalue().splitlines() if ': edoe: created' in line]
+        self.assertNotIn('password', edoe_line)
+        edoe = models.LdapUser.objects.get(username='edoe')
+        self.assertEqual(10002, edoe.uid)
+        self.assertTrue(edoe.check_password('this password is amazing!'))
+        self.assertEqual('emile.doe@example.org', edoe.email)
+
+    def test_json_report(self):
+        rows = provisioning.parse_rows(
+            '[{"username": "aroe", "first_name": "Anna", "last_name": "Roe"}, {"username": "x", "nickname": "y"}]'
+        )
+        results = provisioning.bulk_create_users(rows)
+        self.assertEqual([(1, 'aroe', True), (2, 'x', False)], [result[:3] for result in results])
+        self.assertEqual("Unknown fields: nickname", results[1].message)
+
+        # Values of other types are rejected before any write.
+        rows = provisioning.parse_rows(json.dumps([
+            {"username": "broe", "first_name": "Bob", "last_name": "Roe", "phone": None},
+            {"username": "croe", "first_name": "Carl", "last_name": "Roe", "phone": 33612345678},
+            {"username": "droe", "first_name": ["Dan"], "last_name": "Roe", "email": {}},
+        ]))
+        with mock.patch.object(models, 'add_entries', wraps=models.add_entries) as add_entries:
+            results = provisioning.bulk_create_users(rows)
+        self.assertEqual(
+            [(1, 'broe', True), (2, 'croe', False), (3, 'droe', False)], [result[:3] for result in results],
+        )
+        self.assertEqual("Expected text values for: phone", results[1].message)
+        self.assertEqual("Expected text values for: email, first_name", results[2].message)
+        self.assertEqual(['broe'], [user.username for user in add_entries.call_args[0][0]])
+
+    def test_unparsable_input(self):
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            with replace_stdin('[1, 2]'):
+                self.assertEqual(1, cli.CLI().bulk_adduser('-'))
+            with replace_stdin('jdoe,devs,extra\n'):
+                self.assertEqual(1, cli.CLI().bulk_addusergroup('-'))
+            with replace_stdin('jdoe\n'):
+                self.assertEqual(1, cli.CLI().bulk_delusergroup('-'))
+        self.assertEqual(3, stderr.getvalue().count("Unable to parse -"))